@@ -0,0 +1,442 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from statistics import median
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLIENT_DIR = os.path.join(ROOT, "client")
+sys.path.insert(1, CLIENT_DIR)
+sys.path.insert(1, ROOT)
+import framing
+import client
+import table
+import cc
+
+# End to end load generator: plays N four player tables against a running
+# croupier with the real client (client.Client) and the automatic mode of
+# client/table.py, so every table goes through register, create_table /
+# join_table, confirm_players, the relayed shuffle, validate_pre_game and
+# the game. Every player is a thread; --processes spreads the tables over
+# a pool of processes.
+#
+# Reported: tables finished per second, messages (sent and received by all
+# the players) per second, and per intent the latency from sending a
+# message until the croupier's next message reaches that player.
+#
+# The players are software tokens (cc.Software_Token) instead of citizen
+# cards. By default they come from a software CA kept in --ca-dir (its keys
+# readable by the owner only), whose root the clients trust for the run
+# from a temporary directory. The croupier has to trust it too: with
+# --install-trust the root goes into the croupier's trusted certificates
+# and the CA's (empty) CRLs into its CRL directory, and both are taken out
+# again when the run is over. With --cards they sign with the keys in a
+# directory instead: every <name>.key (PEM) with its <name>.der certificate
+# is a card, the other .der files are their chain.
+#
+# Every seat gets its own software token, so every registration validates
+# a chain the croupier has not seen (nothing comes from its validation
+# cache). --players N makes N tokens per process and reuses them across the
+# tables, as --cards does with its cards: registrations after a card's
+# first may then be answered by the cache. The report says which it was.
+#
+# --register-only skips the tables: every player registers, asks for the
+# table list (answered once the registration is done) and leaves.
+#
+# --trace appends the phase timeline of every player (tracing.py) to FILE.
+#
+# usage: python3 bench/load.py TABLES [--cards DIR | --players N]
+#                              [--processes P] [--register-only] [--install-trust]
+#                              [--dir DIR] [--trace FILE] [-o results.json]
+
+SERVER_IP = 'localhost'
+SERVER_PORT = 50000
+TIMEOUT = 300
+CROUPIER_DIR = os.path.join(ROOT, "croupier")
+CA_DIR = os.path.join(ROOT, "bench", "software_ca")
+
+
+#########################################################################
+## Players
+
+def load_cards(directory):
+    cards = []
+    chain = []
+    for name in sorted(os.listdir(directory)):
+        stem, ext = os.path.splitext(name)
+        if ext != '.der':
+            continue
+        with open(os.path.join(directory, name), 'rb') as f:
+            cert = f.read()
+        key_path = os.path.join(directory, stem + '.key')
+        if not os.path.isfile(key_path):
+            chain.append(cert)
+            continue
+        with open(key_path, 'rb') as f:
+            key = serialization.load_pem_private_key(f.read(), None, default_backend())
+        cards.append((cert, key))
+
+    if not cards:
+        raise SystemExit("No cards (<name>.key with <name>.der) in " + directory)
+    return [cc.CitizenCard(cc.Software_Token(cert, key, chain)) for cert, key in cards]
+
+
+def software_cards(ca_dir, count):
+    ca = cc.Software_CA(ca_dir)
+    return [cc.CitizenCard(ca.token()) for _ in range(count)]
+
+
+# What the players of one process measured
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.sent = 0
+        self.received = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.tables = []
+        self.registrations = 0
+        self.failed = 0
+
+    def add_latency(self, intent, seconds):
+        with self.lock:
+            self.latencies.setdefault(intent, []).append(seconds)
+
+    def as_dict(self):
+        return {
+            'latencies': self.latencies,
+            'sent': self.sent,
+            'received': self.received,
+            'bytes_out': self.bytes_out,
+            'bytes_in': self.bytes_in,
+            'tables': self.tables,
+            'registrations': self.registrations,
+            'failed': self.failed,
+        }
+
+
+# Counts the frames a player receives and closes its pending latencies
+class Timed_Decoder(framing.FrameDecoder):
+    def __init__(self, player):
+        super().__init__()
+        self.player = player
+
+    def feed(self, data):
+        frames = super().feed(data)
+        if frames:
+            self.player.received(frames, len(data))
+        return frames
+
+
+class Bot_Client(client.Client):
+    def __init__(self, card, stats):
+        self.stats = stats
+        self.pending = []
+        super().__init__(SERVER_IP, 0, card)
+        self.decoder = Timed_Decoder(self)
+
+    def send_payload(self, payload, signature=b'', kind=framing.SIGNATURE):
+        intent = self.encoding.loads(payload).get('intent')
+        self.pending.append((intent, time.perf_counter()))
+        super().send_payload(payload, signature, kind)
+        with self.stats.lock:
+            self.stats.sent += 1
+            self.stats.bytes_out += len(payload) + len(signature)
+
+    def received(self, frames, size):
+        now = time.perf_counter()
+        for intent, sent in self.pending:
+            self.stats.add_latency(intent, now - sent)
+        self.pending = []
+        with self.stats.lock:
+            self.stats.received += len(frames)
+            self.stats.bytes_in += size
+
+
+#########################################################################
+## Tables
+
+def play_table(cards, stats, timeout):
+    created = threading.Event()
+    table_info = {}
+    finished = []
+
+    def player(num):
+        c = Bot_Client(cards[num], stats)
+        try:
+            play(c, num)
+        finally:
+            c.sock.close()
+
+    def play(c, num):
+        if not c.join_server(SERVER_IP, SERVER_PORT):
+            return
+        if num == 0:
+            reply = c.create_table()
+            table_info.update(reply or {})
+            created.set()
+        else:
+            if not created.wait(timeout) or 'table_id' not in table_info:
+                return
+            reply = c.join_table(table_info['table_id'])
+        if not reply:
+            return
+        table.Table(client=c, table_info=reply, auto=True).start()
+        finished.append(num)
+
+    start = time.perf_counter()
+    threads = []
+    for num in range(4):
+        thread = threading.Thread(target=player, args=(num,), daemon=True)
+        thread.start()
+        threads.append(thread)
+        # The creator goes first, the others join in its table
+        if num == 0:
+            created.wait(timeout)
+
+    deadline = start + timeout
+    for thread in threads:
+        thread.join(max(0, deadline - time.perf_counter()))
+
+    with stats.lock:
+        if len(finished) == 4:
+            stats.tables.append(time.perf_counter() - start)
+        else:
+            stats.failed += 1
+
+
+# Four players register and leave, no table
+def register_players(cards, stats, timeout):
+    def player(card):
+        c = Bot_Client(card, stats)
+        try:
+            c.sock.settimeout(timeout)
+            if c.join_server(SERVER_IP, SERVER_PORT) and c.get_tables() is not None:
+                with stats.lock:
+                    stats.registrations += 1
+        finally:
+            c.sock.close()
+
+    threads = [threading.Thread(target=player, args=(card,), daemon=True) for card in cards]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+# Plays count tables at the same time, returns what was measured
+def run_tables(count, cards, first_card, timeout, register_only=False):
+    # Headless: table.py waits on stdin too, give it one that never has input
+    read_end, write_end = os.pipe()
+    stdin, stdout = sys.stdin, sys.stdout
+
+    stats = Stats()
+    started = time.time()
+    with os.fdopen(read_end) as headless, open(os.devnull, 'w') as devnull:
+        sys.stdin, sys.stdout = headless, devnull
+        try:
+            threads = []
+            for i in range(count):
+                start = first_card + 4 * i
+                seats = [cards[(start + n) % len(cards)] for n in range(4)]
+                target = register_players if register_only else play_table
+                thread = threading.Thread(target=target, args=(seats, stats, timeout), daemon=True)
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.stdin, sys.stdout = stdin, stdout
+            os.close(write_end)
+
+    result = stats.as_dict()
+    result['started'] = started
+    result['ended'] = time.time()
+    return result
+
+
+def run_process(args):
+    count, cards_dir, software, players, first_card, timeout, register_only, trace, trust_dir = args
+    table.TRACE_FILE = trace
+    if trust_dir is not None:
+        cc.trust_store.dirs.append(trust_dir)
+    if not software:
+        cards = load_cards(cards_dir)
+    else:
+        # One per seat unless told how many to reuse
+        cards = software_cards(cards_dir, players or 4 * count)
+    return run_tables(count, cards, first_card, timeout, register_only)
+
+
+#########################################################################
+## Trust of the croupier
+
+# Puts the software CA in the croupier's directories, returns the files
+# that were not there before (the ones to take out afterwards)
+def install_trust(ca, croupier_dir):
+    installed = []
+    for directory, install in ((os.path.join(croupier_dir, "server_trusted_certs"), ca.install),
+                               (os.path.join(croupier_dir, "CRL"), ca.install_crls)):
+        before = set(os.listdir(directory)) if os.path.isdir(directory) else set()
+        install(directory)
+        installed += [os.path.join(directory, name)
+                      for name in sorted(os.listdir(directory)) if name not in before]
+    return installed
+
+
+def remove_files(paths):
+    for path in paths:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+#########################################################################
+## Report
+
+def merge(results):
+    total = Stats().as_dict()
+    for result in results:
+        for intent, latencies in result['latencies'].items():
+            total['latencies'].setdefault(intent, []).extend(latencies)
+        for key in ('sent', 'received', 'bytes_out', 'bytes_in', 'registrations', 'failed'):
+            total[key] += result[key]
+        total['tables'] += result['tables']
+    # From the first process starting its players to the last one done
+    total['elapsed'] = max(r['ended'] for r in results) - min(r['started'] for r in results)
+    return total
+
+
+def percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def summary(total):
+    elapsed = total['elapsed']
+    intents = {}
+    for intent, latencies in sorted(total['latencies'].items(), key=lambda i: str(i[0])):
+        latencies = sorted(latencies)
+        intents[str(intent)] = {
+            'count': len(latencies),
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+        }
+    messages = total['sent'] + total['received']
+    return {
+        'tables': len(total['tables']),
+        'failed': total['failed'],
+        'elapsed': elapsed,
+        'tables_per_sec': len(total['tables']) / elapsed,
+        'registrations': total['registrations'],
+        'registrations_per_sec': total['registrations'] / elapsed,
+        'messages': messages,
+        'messages_per_sec': messages / elapsed,
+        'bytes_out': total['bytes_out'],
+        'bytes_in': total['bytes_in'],
+        'table_time_p50': median(total['tables']) if total['tables'] else None,
+        'intents': intents,
+    }
+
+
+def print_summary(result):
+    print("Players: {}".format(result['players']))
+    print("Tables: {} finished, {} failed in {:.1f} s".format(
+        result['tables'], result['failed'], result['elapsed']))
+    print("Tables/sec:   {:.2f}".format(result['tables_per_sec']))
+    if result['registrations']:
+        print("Registrations/sec: {:.1f} ({} registrations)".format(
+            result['registrations_per_sec'], result['registrations']))
+    print("Messages/sec: {:.1f} ({} messages)".format(result['messages_per_sec'], result['messages']))
+    if result['table_time_p50'] is not None:
+        print("Table time (p50): {:.2f} s".format(result['table_time_p50']))
+    print()
+    print("{:<20} {:>8} {:>12} {:>12}".format("intent", "count", "p50 ms", "p99 ms"))
+    for intent, latency in result['intents'].items():
+        print("{:<20} {:>8} {:>12.2f} {:>12.2f}".format(
+            intent, latency['count'], latency['p50_ms'], latency['p99_ms']))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plays tables against a running croupier")
+    parser.add_argument('tables', type=int, help="number of tables")
+    parser.add_argument('--cards', help="directory with the players' keys and certificates")
+    parser.add_argument('--players', type=int,
+                        help="software tokens per process, reused across the tables (default: one per seat)")
+    parser.add_argument('--ca-dir', default=CA_DIR, help="where the software CA is kept")
+    parser.add_argument('--croupier-dir', default=CROUPIER_DIR,
+                        help="directory the croupier runs in, for --install-trust")
+    parser.add_argument('--install-trust', action='store_true',
+                        help="make the croupier trust the software CA during the run")
+    parser.add_argument('--register-only', action='store_true', help="only register, no tables")
+    parser.add_argument('--processes', type=int, default=1, help="processes to spread the tables over")
+    parser.add_argument('--dir', default=CLIENT_DIR,
+                        help="directory the clients run in, with client_trusted_certificates (default client/)")
+    parser.add_argument('--timeout', type=float, default=TIMEOUT, help="seconds a table may take")
+    parser.add_argument('--trace', help="append the players' phase timelines to this JSON lines file")
+    parser.add_argument('-o', '--output', help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    installed = []
+    trust_dir = None
+    if args.cards:
+        cards_dir = os.path.abspath(args.cards)
+        players = "the cards in {}, reused across the tables".format(cards_dir)
+    elif args.players:
+        cards_dir = os.path.abspath(args.ca_dir)
+        players = "{} software tokens per process, reused across the tables".format(args.players)
+    else:
+        cards_dir = os.path.abspath(args.ca_dir)
+        players = "a software token per seat"
+    if args.cards or args.players:
+        players += " (the croupier's validation cache answers repeated registrations)"
+    print("Players:", players)
+
+    if not args.cards:
+        # Made here once, the processes load it
+        ca = cc.Software_CA(cards_dir)
+        trust_dir = tempfile.mkdtemp(prefix='load-trust-')
+        ca.install(trust_dir)
+        if args.install_trust:
+            installed = install_trust(ca, os.path.abspath(args.croupier_dir))
+        else:
+            print("The croupier has to trust {} (or use --install-trust)".format(
+                os.path.join(cards_dir, "root.der")))
+    trace = os.path.abspath(args.trace) if args.trace else None
+
+    try:
+        os.chdir(args.dir)
+        processes = max(1, min(args.processes, args.tables))
+        shares = [args.tables // processes + (i < args.tables % processes) for i in range(processes)]
+        jobs = []
+        first_card = 0
+        for share in shares:
+            jobs.append((share, cards_dir, not args.cards, args.players, first_card,
+                         args.timeout, args.register_only, trace, trust_dir))
+            first_card += 4 * share
+
+        if processes == 1:
+            results = [run_process(jobs[0])]
+        else:
+            with multiprocessing.Pool(processes) as pool:
+                results = pool.map(run_process, jobs)
+        result = summary(merge(results))
+        result['players'] = players
+    finally:
+        remove_files(installed)
+        if trust_dir is not None:
+            shutil.rmtree(trust_dir)
+
+    print_summary(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+        print("Results written to", args.output)
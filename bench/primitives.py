@@ -0,0 +1,286 @@
+import gc
+import os
+import sys
+import json
+import time
+import string
+import random
+import argparse
+import datetime
+import platform
+from statistics import median
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa, padding
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import security
+
+# Microbenchmarks of the security.py primitives on the hot paths. Each one
+# runs for a while per payload size and reports operations per second and
+# the latency percentiles of single calls.
+#
+# A single timing of a fast primitive moves by tens of percent between runs
+# of the same code (frequency scaling, other processes, allocator state), so
+# every primitive is timed in several rounds, one after another over all of
+# them, and the median round is reported with its spread: half the range of
+# the rounds, relative to the median. Results can be written as JSON and
+# compared against a previous run (the baseline): a primitive counts as a
+# regression only when it is slower than the baseline by more than the
+# spreads of both runs together plus the threshold, and then the exit
+# status is 1.
+#
+# usage: python3 bench/primitives.py [-o results.json] [-b baseline.json]
+#                                     [--sizes 64,1024,16384] [-k filter]
+#                                     [--repeats N] [--duration S]
+
+SIZES = [64, 1024, 16384]
+DURATION = 0.5
+REPEATS = 5
+MIN_RUNS = 20
+THRESHOLD = 0.05
+
+
+def payload(size):
+    return ''.join(random.choice(string.ascii_letters) for _ in range(size))
+
+
+#########################################################################
+## Setups, each returns the function to time for a payload size
+
+def rsa_encrypt(size):
+    pub = security.RSA_generate_pub(keys['rsa'])
+    text = payload(size)
+    return lambda: security.RSA_encrypt(pub, text)
+
+
+def rsa_decrypt(size):
+    ciphered = security.RSA_encrypt(security.RSA_generate_pub(keys['rsa']), payload(size))
+    return lambda: security.RSA_decrypt(keys['rsa'], ciphered)
+
+
+def aes_encrypt(size):
+    pwd, iv = os.urandom(32), os.urandom(16)
+    text = payload(size)
+    return lambda: security.AES_encrypt(pwd, iv, text)
+
+
+def aes_decrypt(size):
+    pwd, iv = os.urandom(32), os.urandom(16)
+    ciphered = security.AES_encrypt(pwd, iv, payload(size))
+    return lambda: security.AES_decrypt(pwd, iv, ciphered)
+
+
+def dh_encrypt(size):
+    text = payload(size)
+    peer = keys['peer'].public_key
+    return lambda: keys['dh'].encrypt(text, peer)
+
+
+def dh_decrypt(size):
+    peer = keys['peer'].public_key
+    iv = keys['peer'].iv
+    ciphered = keys['peer'].encrypt(payload(size), keys['dh'].public_key)
+    return lambda: keys['dh'].decrypt(ciphered, peer, iv)
+
+
+def dh_sign(size):
+    msg = payload(size)
+    return lambda: keys['dh'].sign(msg)
+
+
+def dh_valid_signature(size):
+    msg = payload(size)
+    signature = keys['dh'].sign(msg)
+    params = security.DH_Params()
+    params.load_key(keys['dh'].share_key())
+    return lambda: params.valid_signature(msg, signature)
+
+
+# Signed like the card does: PKCS#1 v1.5 over the SHA-1 digest of the message
+def cc_sign(size):
+    msg = payload(size).encode()
+    hasher = hashes.Hash(security.chosen_hash, default_backend())
+    hasher.update(msg)
+    signature = keys['cc'].sign(hasher.finalize(), padding.PKCS1v15(), security.chosen_hash)
+    return lambda: security.validate_cc_sign(msg, signature, keys['cc_cert'])
+
+
+def bit_commit(size):
+    data = payload(size)
+    return lambda: security.bit_commit(data)
+
+
+def rand_ciphered(size):
+    return lambda: security.rand_ciphered()
+
+
+# name, setup, whether it depends on the payload size
+BENCHMARKS = [
+    ("RSA_encrypt", rsa_encrypt, True),
+    ("RSA_decrypt", rsa_decrypt, True),
+    ("AES_encrypt", aes_encrypt, True),
+    ("AES_decrypt", aes_decrypt, True),
+    ("Diffie_Hellman.encrypt", dh_encrypt, True),
+    ("Diffie_Hellman.decrypt", dh_decrypt, True),
+    ("Diffie_Hellman.sign", dh_sign, True),
+    ("DH_Params.valid_signature", dh_valid_signature, True),
+    ("validate_cc_sign", cc_sign, True),
+    ("bit_commit", bit_commit, True),
+    ("rand_ciphered", rand_ciphered, False),
+]
+
+keys = {}
+
+
+def make_keys():
+    keys['rsa'] = security.RSA_generate_priv()
+    keys['dh'] = security.Diffie_Hellman()
+    keys['dh'].generate_keys()
+    keys['peer'] = security.Diffie_Hellman()
+    keys['peer'].generate_keys()
+
+    # Self signed stand in for a citizen card certificate
+    key = rsa.generate_private_key(65537, 2048, default_backend())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "Benchmark")])
+    now = datetime.datetime.utcnow()
+    cert = (x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now)
+            .not_valid_after(now + datetime.timedelta(days=1))
+            .sign(key, hashes.SHA256(), default_backend()))
+    keys['cc'] = key
+    keys['cc_cert'] = cert.public_bytes(serialization.Encoding.DER)
+
+
+#########################################################################
+## Measuring
+
+# Times single calls for duration seconds (and at least MIN_RUNS calls),
+# returns the time of each call in ns
+def measure(func, duration):
+    times = []
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        while True:
+            t = time.perf_counter_ns()
+            func()
+            times.append(time.perf_counter_ns() - t)
+            if len(times) >= MIN_RUNS and time.perf_counter() - start >= duration:
+                break
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return times
+
+
+# Median and spread of the rounds, percentiles of every call
+def summarize(rounds):
+    ops = sorted(len(times) / (sum(times) / 1e9) for times in rounds)
+    middle = median(ops)
+    times = sorted(t for round_times in rounds for t in round_times)
+    return {
+        'runs': len(times),
+        'ops_per_sec': middle,
+        'spread': (ops[-1] - ops[0]) / 2 / middle,
+        'rounds': ops,
+        'p50_us': percentile(times, 50) / 1000,
+        'p99_us': percentile(times, 99) / 1000,
+    }
+
+
+def percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def run(sizes, duration, repeats, name_filter=None):
+    funcs = {}
+    for name, setup, sized in BENCHMARKS:
+        if name_filter and name_filter not in name:
+            continue
+        for size in (sizes if sized else [None]):
+            key = name if size is None else "{}/{}".format(name, size)
+            funcs[key] = setup(size)
+            # Warm up
+            funcs[key]()
+
+    # Round by round over every benchmark, so what slows the machine down
+    # for a while does not land on a single one
+    rounds = {key: [] for key in funcs}
+    for _ in range(repeats):
+        for key, func in funcs.items():
+            rounds[key].append(measure(func, duration))
+
+    results = {}
+    for key in funcs:
+        results[key] = summarize(rounds[key])
+        print_result(key, results[key])
+    return results
+
+
+def print_result(key, result):
+    print("{:<36} {:>12.1f} ops/s ±{:>5.1%}   p50 {:>10.1f} us   p99 {:>10.1f} us".format(
+        key, result['ops_per_sec'], result['spread'], result['p50_us'], result['p99_us']))
+
+
+# Benchmarks slower than the baseline by more than the noise of both runs
+# (baselines without a spread count as noiseless) and threshold
+def compare(results, baseline, threshold):
+    regressions = []
+    print()
+    print("Against the baseline:")
+    for key, result in results.items():
+        old = baseline.get(key)
+        if old is None:
+            continue
+        change = result['ops_per_sec'] / old['ops_per_sec'] - 1
+        noise = result['spread'] + old.get('spread', 0)
+        slower = change < -(noise + threshold)
+        print("{:<36} {:>+8.1%}   noise ±{:>5.1%}{}".format(
+            key, change, noise, "   REGRESSION" if slower else ""))
+        if slower:
+            regressions.append(key)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the security.py primitives")
+    parser.add_argument('-o', '--output', help="write the results to this JSON file")
+    parser.add_argument('-b', '--baseline', help="JSON results to compare against")
+    parser.add_argument('-k', '--filter', help="only benchmarks with this in their name")
+    parser.add_argument('--sizes', default=','.join(str(s) for s in SIZES),
+                        help="payload sizes in bytes (default %(default)s)")
+    parser.add_argument('--duration', type=float, default=DURATION,
+                        help="seconds per benchmark and round (default %(default)s)")
+    parser.add_argument('--repeats', type=int, default=REPEATS,
+                        help="rounds per benchmark (default %(default)s)")
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help="slowdown beyond the noise counted as a regression (default %(default)s)")
+    args = parser.parse_args()
+
+    make_keys()
+    sizes = [int(s) for s in args.sizes.split(',')]
+    results = run(sizes, args.duration, args.repeats, args.filter)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'machine': platform.platform(),
+                'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                'results': results,
+            }, f, indent=2)
+        print("Results written to", args.output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
@@ -0,0 +1,133 @@
+import os
+import sys
+import time
+import socket
+import subprocess
+from statistics import median
+
+# Startup benchmark: how long until the croupier and the clients can work.
+#
+#   import      time to import security (and the modules that import it)
+#   listen      from starting croupier/server.py until it accepts connections
+#   connect     from starting a client process (same imports as main.py)
+#               until its socket reaches the croupier. Reading the citizen
+#               card is left out, it needs the card.
+#
+# usage: python3 bench/startup.py [RUNS]
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CROUPIER_DIR = os.path.join(ROOT, "croupier")
+CLIENT_DIR = os.path.join(ROOT, "client")
+SERVER_ADDR = ('localhost', 50000)
+TIMEOUT = 60
+
+IMPORTS = [
+    ("security", CROUPIER_DIR, "import security"),
+    ("croupier", CROUPIER_DIR, "import server"),
+    ("client", CLIENT_DIR, "import client, table, player"),
+]
+
+CLIENT_CONNECT = """
+import sys, socket
+from client import Client
+from table import Table
+from player import Player
+import security
+s = socket.create_connection(('localhost', int(sys.argv[1])))
+s.sendall(b'x')
+s.recv(1)
+"""
+
+
+def python(code, cwd, *args, **kwargs):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, env.get('PYTHONPATH')]))
+    return subprocess.Popen(
+        [sys.executable, "-c", code] + [str(a) for a in args],
+        cwd=cwd, env=env, **kwargs)
+
+
+# Seconds the import takes inside a fresh interpreter
+def import_time(cwd, statement):
+    code = ("import time\nt = time.perf_counter()\n" + statement
+            + "\nprint(time.perf_counter() - t)")
+    child = python(code, cwd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    out, _ = child.communicate(timeout=TIMEOUT)
+    if child.returncode != 0:
+        raise RuntimeError("'{}' failed in {}".format(statement, cwd))
+    return float(out.decode().split()[-1])
+
+
+def time_to_listen():
+    if can_connect():
+        raise RuntimeError("Something already listens on port {}".format(SERVER_ADDR[1]))
+
+    start = time.perf_counter()
+    child = subprocess.Popen(
+        [sys.executable, "server.py"],
+        cwd=CROUPIER_DIR,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while not can_connect():
+            if child.poll() is not None:
+                raise RuntimeError("The croupier exited with {}".format(child.returncode))
+            if time.perf_counter() - start > TIMEOUT:
+                raise RuntimeError("The croupier did not listen in {} s".format(TIMEOUT))
+            time.sleep(0.002)
+        return time.perf_counter() - start
+    finally:
+        child.kill()
+        child.wait()
+
+
+def can_connect():
+    try:
+        socket.create_connection(SERVER_ADDR, timeout=1).close()
+        return True
+    except OSError:
+        return False
+
+
+# A listening socket stands in for the croupier
+def time_to_connect():
+    listener = socket.socket()
+    listener.bind(('localhost', 0))
+    listener.listen(1)
+    listener.settimeout(TIMEOUT)
+
+    start = time.perf_counter()
+    child = python(CLIENT_CONNECT, CLIENT_DIR, listener.getsockname()[1],
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        conn, _ = listener.accept()
+        conn.recv(1)
+        elapsed = time.perf_counter() - start
+        conn.sendall(b'x')
+        conn.close()
+        return elapsed
+    finally:
+        child.wait(timeout=TIMEOUT)
+        listener.close()
+
+
+def report(name, samples):
+    print("{:<20} median {:8.1f} ms   min {:8.1f} ms   max {:8.1f} ms".format(
+        name,
+        median(samples) * 1000,
+        min(samples) * 1000,
+        max(samples) * 1000))
+
+
+if __name__ == "__main__":
+    runs = 5
+    if len(sys.argv) > 1:
+        runs = int(sys.argv[1])
+
+    for name, cwd, statement in IMPORTS:
+        try:
+            report("import " + name, [import_time(cwd, statement) for _ in range(runs)])
+        except RuntimeError as e:
+            print("import " + name + ":", e)
+
+    report("croupier listen", [time_to_listen() for _ in range(runs)])
+    report("client connect", [time_to_connect() for _ in range(runs)])
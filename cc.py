@@ -1,45 +1,141 @@
 
 import os
 import platform
-from PyKCS11 import *
+import datetime
+import itertools
 
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.serialization import load_der_public_key, Encoding, PublicFormat
-from cryptography.hazmat.primitives.asymmetric import padding, rsa, utils
+from cryptography.hazmat.primitives.serialization import load_pem_private_key, Encoding, PrivateFormat, NoEncryption
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
 from cryptography import x509
-from cryptography.x509.oid import NameOID
+from cryptography.x509.oid import NameOID, ExtendedKeyUsageOID
 from termcolor import colored
 from base64 import b64decode, b64encode
+import trust
+
+# The PKCS#11 wrapper, imported by the first PKCS11_Backend: software tokens
+# work without it
+PyKCS11 = None
 
 PKCS11_LIB_LINUX = "/usr/local/lib/libpteidpkcs11.so"
 PKCS11_LIB_WINDOWS = "c:\\Windows\\System32\\pteidpkcs11.dll"
 
+# Certificates trusted by the client
+trust_store = trust.TrustStore(["client_trusted_certificates"])
+path_builder = trust.Path_Builder(trust_store)
+
+# Chains of other players already validated (the same people play again)
+validation_cache = trust.Validation_Cache()
+
+# Where the certificates and the signatures of a card come from: the
+# citizen card itself, through PKCS#11 (PKCS11_Backend), or keys kept in
+# memory (Software_Token)
+class Card_Backend:
+    # DER of the authentication certificate
+    def certificate(self):
+        raise NotImplementedError
+
+    # DER of the certificates above it, up to the root
+    def chain(self):
+        raise NotImplementedError
+
+    # RSA PKCS#1 v1.5 signature of data with SHA-1 (CKM_SHA1_RSA_PKCS)
+    def sign(self, data):
+        raise NotImplementedError
+
+
 class CitizenCard:
+    def __init__(self, backend=None):
+        if backend is None:
+            backend = PKCS11_Backend()
+        self.backend = backend
+        self.certificate = backend.certificate()
+        self.sendable_cert = b64encode( self.certificate ).decode('utf-8')
+        cert = x509.load_der_x509_certificate(self.certificate, default_backend())
+        subject = cert.subject.get_attributes_for_oid(NameOID.COMMON_NAME)[0].value
+        self.subject = subject
+        self.name = subject
+        self.pub_cc_key = cert.public_key()
+        self.chain = []
+        self.sendable_chain = []
+        for chain_cert in backend.chain():
+            self.chain.append(chain_cert)
+            self.sendable_chain.append(b64encode(chain_cert).decode('utf-8'))
+
+
+    # Sign a message with the private citizen authentication key
+    def sign(self, msg):#msg_fields=[]):
+        hashing = hashes.Hash(hashes.SHA1(), default_backend())
+        #for field in msg_fields:
+        #    hashing.update(field.encode())
+        if type(msg) is str:
+            msg = msg.encode()
+        hashing.update(msg)
+        digest = hashing.finalize()
+        return self.backend.sign(digest)
+
+
+    # Verify a certificate and its chain
+    def validate_cert(self, certificate, chain):
+        if type(certificate) is str:
+            certificate = b64decode( certificate )
+        key = validation_cache.key(certificate, chain)
+        trust_store.check()
+        valid = validation_cache.get(key, trust_store.version)
+        if valid is None:
+            valid = self._validate_cert(certificate, chain)
+            validation_cache.put(key, trust_store.version, valid)
+        return valid
+
+
+    def _validate_cert(self, certificate, chain):
+        # Path from the certificate to one trusted by the client
+        path = path_builder.build(certificate, chain)
+        if path is None:
+            return False
+
+        cert_name = path[-1].subject.get_attributes_for_oid(NameOID.COMMON_NAME)[0].value+".cer"
+        print(" > CERTIFICATE \'{}\' IS VALID".format(cert_name))
+        return True
+
+
+# The citizen card in the reader, through the PKCS#11 library
+class PKCS11_Backend(Card_Backend):
     def __init__(self):
+        global PyKCS11
+        import PyKCS11
         self.PKCS11_LIB = None
         self.pkcs11 = None
         self.slot = None
         self.PKCS11_session = None
-        self.name = None
         print("============================")
         if  self._check_lib_files() and \
             self._load_lib_files():
             self.get_session()
             self.extract_certificates()
         print("============================\n")
-        self.certificate = self.get_certificate('AUTHENTICATION')
-        self.sendable_cert = b64encode( self.certificate ).decode('utf-8')
-        cert = x509.load_der_x509_certificate(self.certificate, default_backend())
-        subject = cert.subject.get_attributes_for_oid(NameOID.COMMON_NAME)[0].value
-        self.subject = subject
-        self.name = subject
-        self.pub_cc_key = cert.public_key()
-        self.chain = []
-        self.sendable_chain = []
-        for chain_cert in self.get_chain(subject):
-            self.chain.append(chain_cert)
-            self.sendable_chain.append(b64encode(chain_cert).decode('utf-8'))
+
+    def certificate(self):
+        return self.get_certificate('AUTHENTICATION')
+
+    def chain(self):
+        cert = x509.load_der_x509_certificate(self.certificate(), default_backend())
+        return self.get_chain(cert)
+
+    def sign(self, data):
+        if self.PKCS11_session is not None:
+            try:
+                label = "CITIZEN AUTHENTICATION KEY"
+                priv_k = self.PKCS11_session.findObjects([(PyKCS11.CKA_CLASS, PyKCS11.CKO_PRIVATE_KEY), (PyKCS11.CKA_LABEL, label)])[0]
+                mechanism = PyKCS11.Mechanism(PyKCS11.CKM_SHA1_RSA_PKCS)
+                # self.PKCS11_session.initPin()
+                return bytes(self.PKCS11_session.sign(priv_k, data, mechanism))
+                
+            except PyKCS11.PyKCS11Error as e:
+                print("Could not sign the message: ", e )
+            except IndexError:
+                print( "CITIZEN AUTHENTICATION PRIVATE KEY not found\n" )
 
     def _check_lib_files(self):
         print("Checking PKCS11 necessary files")
@@ -170,113 +266,242 @@ class CitizenCard:
         return True
 
 
-    # Get the chain of a given certificate
+    # Get the chain of a given certificate, up to the self signed root,
+    # from the certificates extracted from the card
     def get_chain(self, cert):
-        path = os.path.join("client_certificates")
-        cert = open(path+"/ECs de Autenticação/"+cert+".cer", 'rb').read()
-
-        # Start chain
-        chain = []
-
-        # Get issuer
-        issuer = self.get_issuer(cert)
-
-        trusted_certs = [
-            f 
-            for f in os.listdir("client_certificates") 
-            if os.path.isfile(os.path.join("client_certificates", f))
-        ]
-        
-        while True:
-            try:
-                with open(os.path.join(path, issuer+".cer"), 'rb') as f:
-                    chain.append(f.read())
-            except FileNotFoundError:
-                with open(os.path.join(path, "ECs de Autenticação/" +issuer+".cer"), 'rb') as f:
-                    chain.append(f.read())
-            
-            cert = chain[-1]
-            
-            issuer = self.get_issuer(cert)
-            if issuer == self.get_subject(cert):
-                break
-
-        return chain
-
-
-    # Get the issuer of a given certificate
-    def get_issuer(self, cert):
-        certificate = x509.load_der_x509_certificate(cert, default_backend())
-        issuer = certificate.issuer.get_attributes_for_oid(NameOID.COMMON_NAME)[0].value
-        return issuer
-
-
-    # Get the subject of a given certificate
-    def get_subject(self, cert):
-        certificate = x509.load_der_x509_certificate(cert, default_backend())
-        subject = certificate.subject.get_attributes_for_oid(NameOID.COMMON_NAME)[0].value
-        return subject   
+        card_certs = trust.TrustStore([
+            "client_certificates",
+            "client_certificates/ECs de Autenticação",
+        ])
+        path = trust.Path_Builder(card_certs).build(
+            cert, is_anchor=lambda c: c.issuer == c.subject)
+        if path is None:
+            print(colored("Could not find the chain of the certificate", 'red'))
+            return []
+        return [c.public_bytes(Encoding.DER) for c in path[1:]]
 
 
     # Get the certificate of the type in args
     def get_certificate(self,typeOfCert):
         session = self.PKCS11_session
         certHandle = session.findObjects(
-            [(CKA_CLASS, CKO_CERTIFICATE),
-            (CKA_LABEL, 'CITIZEN ' + str(typeOfCert) + ' CERTIFICATE')]
+            [(PyKCS11.CKA_CLASS, PyKCS11.CKO_CERTIFICATE),
+            (PyKCS11.CKA_LABEL, 'CITIZEN ' + str(typeOfCert) + ' CERTIFICATE')]
         )[0]
-        return bytes(session.getAttributeValue( certHandle, [CKA_VALUE], True )[0])
-
-
-    # Sign a message with the private citizen authentication key
-    def sign(self, msg):#msg_fields=[]):
-        hashing = hashes.Hash(hashes.SHA1(), default_backend())
-        #for field in msg_fields:
-        #    hashing.update(field.encode())
-        hashing.update(msg.encode())
-        digest = hashing.finalize()
-
-        if self.PKCS11_session is not None:
-            try:
-                label = "CITIZEN AUTHENTICATION KEY"
-                priv_k = self.PKCS11_session.findObjects([(CKA_CLASS, CKO_PRIVATE_KEY), (CKA_LABEL, label)])[0]
-                mechanism = PyKCS11.Mechanism(CKM_SHA1_RSA_PKCS)
-                # self.PKCS11_session.initPin()
-                return bytes(self.PKCS11_session.sign(priv_k, digest, mechanism))
-                
-            except PyKCS11.PyKCS11Error as e:
-                print("Could not sign the message: ", e )
-            except IndexError:
-                print( "CITIZEN AUTHENTICATION PRIVATE KEY not found\n" )
+        return bytes(session.getAttributeValue( certHandle, [PyKCS11.CKA_VALUE], True )[0])
+
+
+#########################################################################
+## Software token: a card without the card, for tests and benchmarks
+#
+# Software_CA makes a hierarchy shaped like the Cartão de Cidadão one: a
+# self signed root (ECRaizEstado), a "Cartão de Cidadão" CA under it and an
+# "EC de Autenticação do Cartão de Cidadão" under that one, which issues
+# the authentication certificates of the citizens. Its CAs are numbered
+# 9xxx, numbers the real hierarchy does not use. Each Software_Token is a
+# citizen whose key is kept in memory and signs in the process.
+#
+# The croupier and the clients only accept the tokens once the root is in
+# their trusted certificates (install).
+
+SOFTWARE_CA_NUMBER = 9001
+CRL_URL = "http://pki.cartaodecidadao.pt/publico/lrc/"
+CA_VALIDITY = datetime.timedelta(days=12 * 365)
+CITIZEN_VALIDITY = datetime.timedelta(days=5 * 365)
+
+
+class Software_CA:
+    # Loads the hierarchy from directory when it is there, otherwise makes
+    # a new one (and saves it there, if given)
+    def __init__(self, directory=None, key_size=2048):
+        self.key_size = key_size
+        self.numbers = itertools.count(1)
+        if directory is not None and self.load(directory):
+            return
+        self.generate()
+        if directory is not None:
+            self.save(directory)
+
+    def generate(self):
+        number = SOFTWARE_CA_NUMBER
+        self.root_key = self.new_key()
+        self.root = ca_certificate(
+            ca_name(C="PT", O="SCEE - Sistema de Certificação Electrónica do Estado", CN="ECRaizEstado {}".format(number)),
+            self.root_key, None, None, None)
+
+        self.ca_key = self.new_key()
+        self.ca = ca_certificate(
+            ca_name(C="PT", O="SCEE - Sistema de Certificação Electrónica do Estado", OU="ECEstado",
+                 CN="Cartão de Cidadão {}".format(number)),
+            self.ca_key, self.root, self.root_key, 1,
+            "ecraizestado_crl{}.crl".format(number))
+
+        self.auth_key = self.new_key()
+        self.auth = ca_certificate(
+            ca_name(C="PT", O="Cartão de Cidadão", OU="subECEstado",
+                 CN="EC de Autenticação do Cartão de Cidadão {}".format(number)),
+            self.auth_key, self.ca, self.ca_key, 0,
+            "cc_ec_cidadao_crl{}_crl.crl".format(number))
+
+    def new_key(self, key_size=None):
+        return rsa.generate_private_key(65537, key_size or self.key_size, default_backend())
+
+    def files(self, directory):
+        return [
+            (os.path.join(directory, attr + ".der"), os.path.join(directory, attr + ".key"), attr)
+            for attr in ("root", "ca", "auth")
+        ]
 
+    def load(self, directory):
+        files = self.files(directory)
+        if not all(os.path.isfile(cert) and os.path.isfile(key) for cert, key, attr in files):
+            return False
+        for cert_path, key_path, attr in files:
+            with open(cert_path, 'rb') as f:
+                setattr(self, attr, x509.load_der_x509_certificate(f.read(), default_backend()))
+            with open(key_path, 'rb') as f:
+                setattr(self, attr + "_key", load_pem_private_key(f.read(), None, default_backend()))
+        return True
 
-    # Verify a certificate and its chain
-    def validate_cert(self, certificate, chain):
-        # Check if certificate is in trusted certificates list
-        # Transform bytes into certificate
-        if type(certificate) is str:
-            certificate = b64decode( certificate ).encode()
-            
-        cert = x509.load_der_x509_certificate(certificate, default_backend())
-        cert_name = cert.subject.get_attributes_for_oid(NameOID.COMMON_NAME)[0].value+".cer"
-
-        # Get list of trusted certifiates by the client        
-        trusted_certs = [
-            f 
-            for f in os.listdir("client_trusted_certificates") 
-            if os.path.isfile(os.path.join("client_trusted_certificates", f))
+    # The keys are not encrypted, only the owner may read them
+    def save(self, directory):
+        if not os.path.exists(directory):
+            os.makedirs(directory, 0o700)
+        for cert_path, key_path, attr in self.files(directory):
+            with open(cert_path, 'wb') as f:
+                f.write(getattr(self, attr).public_bytes(Encoding.DER))
+            with open(os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f:
+                f.write(getattr(self, attr + "_key").private_bytes(
+                    Encoding.PEM, PrivateFormat.PKCS8, NoEncryption()))
+
+    # Puts the root in a directory of trusted certificates
+    def install(self, directory):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        cn = self.root.subject.get_attributes_for_oid(NameOID.COMMON_NAME)[0].value
+        with open(os.path.join(directory, cn + ".cer"), 'wb') as f:
+            f.write(self.root.public_bytes(Encoding.DER))
+
+    # Puts an empty CRL of every CA in a directory of CRLs, named as the
+    # distribution points of the certificates they issue say
+    def install_crls(self, directory):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        crls = [
+            (self.root, self.root_key, "ecraizestado_crl{}.crl"),
+            (self.ca, self.ca_key, "cc_ec_cidadao_crl{}_crl.crl"),
+            (self.auth, self.auth_key, "cc_sub-ec_cidadao_autenticacao_crl{}_p0001.crl"),
         ]
-        
-        if cert_name in trusted_certs:
-            with open(os.path.join("client_trusted_certificates", cert_name),"rb") as f:
-                if cert == x509.load_der_x509_certificate( f.read(), default_backend() ):
-                    print(" > CERTIFICATE \'{}\' IS VALID".format(cert_name))
-                    return True # Only need the lowest trusted
-
-        # Verify the chain
-        if len(chain) != 0:
-            try:
-                return self.validate_cert(chain[0],chain[1:])
-            except Exception as e:
-                raise Exception(e)
-
+        now = datetime.datetime.utcnow()
+        for cert, key, name in crls:
+            crl = (x509.CertificateRevocationListBuilder()
+                .issuer_name(cert.subject)
+                .last_update(now - datetime.timedelta(days=1))
+                .next_update(now + CA_VALIDITY)
+                .sign(key, hashes.SHA256(), default_backend()))
+            with open(os.path.join(directory, name.format(SOFTWARE_CA_NUMBER)), 'wb') as f:
+                f.write(crl.public_bytes(Encoding.DER))
+
+    # DER of the CA certificates, from the one that issues citizens to the root
+    def chain(self):
+        return [c.public_bytes(Encoding.DER) for c in (self.auth, self.ca, self.root)]
+
+    # New citizen with an authentication certificate issued by the hierarchy
+    def token(self, given_name=None, surname="SOFTWARE", key_size=None):
+        number = next(self.numbers)
+        if given_name is None:
+            given_name = "CIDADÃO {}".format(number)
+        key = self.new_key(key_size)
+        now = datetime.datetime.utcnow()
+        crl = "cc_sub-ec_cidadao_autenticacao_crl{}_p0001.crl".format(SOFTWARE_CA_NUMBER)
+        delta = "cc_sub-ec_cidadao_autenticacao_crl{}_delta_p0001.crl".format(SOFTWARE_CA_NUMBER)
+        cert = (x509.CertificateBuilder()
+            .subject_name(x509.Name([
+                x509.NameAttribute(NameOID.COUNTRY_NAME, "PT"),
+                x509.NameAttribute(NameOID.ORGANIZATION_NAME, "Cartão de Cidadão"),
+                x509.NameAttribute(NameOID.ORGANIZATIONAL_UNIT_NAME, "Cidadão Português"),
+                x509.NameAttribute(NameOID.ORGANIZATIONAL_UNIT_NAME, "Autenticação do Cidadão"),
+                x509.NameAttribute(NameOID.SURNAME, surname),
+                x509.NameAttribute(NameOID.GIVEN_NAME, given_name),
+                x509.NameAttribute(NameOID.SERIAL_NUMBER, "BI{:08d}".format(number)),
+                x509.NameAttribute(NameOID.COMMON_NAME, "{} {}".format(given_name, surname)),
+            ]))
+            .issuer_name(self.auth.subject)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + CITIZEN_VALIDITY)
+            .add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=True)
+            .add_extension(key_usage(digital_signature=True), critical=True)
+            .add_extension(x509.ExtendedKeyUsage([ExtendedKeyUsageOID.CLIENT_AUTH]), critical=False)
+            .add_extension(x509.SubjectKeyIdentifier.from_public_key(key.public_key()), critical=False)
+            .add_extension(x509.AuthorityKeyIdentifier.from_issuer_public_key(self.auth_key.public_key()), critical=False)
+            .add_extension(distribution_points(x509.CRLDistributionPoints, crl), critical=False)
+            .add_extension(distribution_points(x509.FreshestCRL, delta), critical=False)
+            .sign(self.auth_key, hashes.SHA256(), default_backend()))
+        return Software_Token(cert.public_bytes(Encoding.DER), key, self.chain())
+
+
+class Software_Token(Card_Backend):
+    def __init__(self, certificate, key, chain):
+        self._certificate = certificate
+        self.key = key
+        self._chain = list(chain)
+
+    def certificate(self):
+        return self._certificate
+
+    def chain(self):
+        return self._chain
+
+    def sign(self, data):
+        return self.key.sign(data, padding.PKCS1v15(), hashes.SHA1())
+
+
+def ca_name(C=None, O=None, OU=None, CN=None):
+    attributes = [
+        (NameOID.COUNTRY_NAME, C),
+        (NameOID.ORGANIZATION_NAME, O),
+        (NameOID.ORGANIZATIONAL_UNIT_NAME, OU),
+        (NameOID.COMMON_NAME, CN),
+    ]
+    return x509.Name([x509.NameAttribute(oid, value) for oid, value in attributes if value is not None])
+
+
+def key_usage(digital_signature=False, cert_sign=False):
+    return x509.KeyUsage(
+        digital_signature=digital_signature, content_commitment=False,
+        key_encipherment=False, data_encipherment=False, key_agreement=False,
+        key_cert_sign=cert_sign, crl_sign=cert_sign,
+        encipher_only=False, decipher_only=False)
+
+
+def distribution_points(extension, crl_name):
+    return extension([x509.DistributionPoint(
+        full_name=[x509.UniformResourceIdentifier(CRL_URL + crl_name)],
+        relative_name=None, reasons=None, crl_issuer=None)])
+
+
+# CA certificate issued by issuer (self signed when issuer is None)
+def ca_certificate(subject, key, issuer, issuer_key, path_length, crl_name=None):
+    now = datetime.datetime.utcnow()
+    if issuer is None:
+        issuer_name, issuer_key = subject, key
+    else:
+        issuer_name = issuer.subject
+    builder = (x509.CertificateBuilder()
+        .subject_name(subject)
+        .issuer_name(issuer_name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + CA_VALIDITY)
+        .add_extension(x509.BasicConstraints(ca=True, path_length=path_length), critical=True)
+        .add_extension(key_usage(cert_sign=True), critical=True)
+        .add_extension(x509.SubjectKeyIdentifier.from_public_key(key.public_key()), critical=False))
+    if issuer is not None:
+        builder = builder.add_extension(
+            x509.AuthorityKeyIdentifier.from_issuer_public_key(issuer_key.public_key()), critical=False)
+    if crl_name is not None:
+        builder = builder.add_extension(distribution_points(x509.CRLDistributionPoints, crl_name), critical=False)
+    return builder.sign(issuer_key, hashes.SHA256(), default_backend())
@@ -1,22 +1,19 @@
 import socket
 import json
-import time
-import datetime
 import os, sys, select
-from base64 import b64encode, b64decode
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.backends import default_backend
 sys.path.insert(1, os.path.join(sys.path[0], '..'))
 import security
+import framing
+import wire
 from cc import CitizenCard
 
 BUFFER_SIZE = 64 * 1024
 
-EOM = '---EOM---'
-
 class Client:
-    def __init__(self, ip, port):
-        self.cc = CitizenCard()
+    def __init__(self, ip, port, card=None):
+        if card is None:
+            card = CitizenCard()
+        self.cc = card
         self.sock = socket.socket(
             socket.AF_INET, 
             socket.SOCK_STREAM
@@ -30,6 +27,11 @@ class Client:
         self.dh.generate_keys()
         self.sv_dh = None
         self.buffer = []
+        self.decoder = framing.FrameDecoder()
+        self.encoding = wire.DEFAULT
+        self.session = None
+        # Timeline of the table being played (tracing.Timeline), if any
+        self.trace = None
 
 
     def join_server(self, ip, port):
@@ -44,6 +46,8 @@ class Client:
         self.sv_dh = security.DH_Params()
         self.sv_dh.load_key(reply['message']['pub_key'])
         self.sv_dh.load_iv(reply['message']['iv'])
+        encoding = wire.choose(reply['message'].get('encodings', []))
+        session_modes = reply['message'].get('session_modes', [])
         
         msg = {
             'intent': 'register',
@@ -51,30 +55,28 @@ class Client:
             'pub_key': self.dh.share_key(),
             'iv': self.dh.share_iv(),
             'certificate': self.cc.sendable_cert,
-            'chain': self.cc.sendable_chain
+            'chain': self.cc.sendable_chain,
+            'encoding': encoding.name,
         }
-
-        signature = self.cc.sign(json.dumps(msg))
-        signature = b64encode(signature).decode('utf-8')
-
-        # Send message
-        msg = {
-            'message' : msg,
-            'signature' : signature
-        }
-        msg = json.dumps(msg) + EOM
-        self.sock.send(msg.encode())
+        if security.SESSION_MAC in session_modes:
+            msg['session'] = security.SESSION_MAC
+
+        # The card signs the exact bytes the croupier will receive
+        payload = wire.DEFAULT.dumps(msg)
+        signature = self.cc.sign(payload)
+        self.send_payload(payload, signature)
+
+        # Everything after the register message uses the chosen encoding
+        # and, when agreed, the session MACs
+        self.encoding = encoding
+        if 'session' in msg:
+            self.session = security.Session_MAC(self.dh, self.sv_dh.public_key)
         return True
     
     
     def get_tables(self):
-        request = {
-            'message': {
-                'intent' : 'get_table_list'
-            }
-        }
-        request = json.dumps(request) + EOM
-        self.sock.send(request.encode())
+        request = {'intent' : 'get_table_list'}
+        self.send(request)
         reply = self.wait_for_reply()
         return reply['message']['table_list']
 
@@ -84,16 +86,7 @@ class Client:
             'intent' : 'join_table',
             'table_id' : table_id
         }           
-        signature = self.dh.sign(json.dumps(msg))
-        signature = b64encode(signature).decode('utf-8')
-        
-        request = {
-            'message': msg,
-            'signature': signature,
-        }
-        
-        request = json.dumps(request) + EOM
-        self.sock.send(request.encode())
+        self.sign_and_send(msg)
         reply = self.wait_for_reply()
         if not reply:
             return False
@@ -104,15 +97,7 @@ class Client:
 
     def create_table(self):
         msg = {'intent': 'create_table'}
-        signature = self.dh.sign(json.dumps(msg))
-        signature = b64encode(signature).decode('utf-8')
-        request = {
-            'message': msg,
-            'signature': signature,
-        }
-
-        request = json.dumps(request) + EOM
-        self.sock.send(request.encode())
+        self.sign_and_send(msg)
         reply = self.wait_for_reply()
         if not reply:
             return False
@@ -130,16 +115,7 @@ class Client:
             'relay_to': dst,
             'relay': data,
         }
-        signature = self.dh.sign(json.dumps(msg))
-        signature = b64encode(signature).decode('utf-8')
-        
-        msg = {
-            'message': msg,
-            'signature': signature,
-        }
-
-        msg = json.dumps(msg) + EOM
-        self.sock.send(msg.encode())
+        self.sign_and_send(msg)
 
 
     def load_relayed_data(self, ciph_data, dh):    
@@ -155,17 +131,7 @@ class Client:
             'table_id': table_id,
             'data': data,
         }
-
-        signature = self.dh.sign(json.dumps(msg))
-        signature = b64encode(signature).decode('utf-8')
-        
-        msg = {
-            'message': msg,
-            'signature': signature,
-        }
-
-        msg = json.dumps(msg) + EOM
-        self.sock.send(msg.encode())
+        self.sign_and_send(msg)
 
 
     def make_play(self, table_id, card):
@@ -174,18 +140,51 @@ class Client:
             'table_id': table_id,
             'card': card,
         }
+        # Other players get this signature as proof of the play
+        self.sign_and_send(play, proof=True)
 
-        signature = self.dh.sign(json.dumps(play))
-        signature = b64encode(signature).decode('utf-8')
 
-        msg = {
-            'message': play,
+    # Reads from the server until at least one whole message arrived
+    def receive(self):
+        while True:
+            received = self.sock.recv(BUFFER_SIZE)
+            if not received:
+                return None
+
+            #print("\nReceived:", received)
+            frames = self.decoder.feed(received)
+            if self.trace is not None:
+                self.trace.count_in(len(received), len(frames))
+            if frames:
+                return frames
+
+
+    # Checks the signature over the received bytes, then decodes them.
+    # Messages that were pushed back are already decoded.
+    def open_frame(self, frame):
+        if type(frame) is dict:
+            return frame
+
+        kind, signature, payload = framing.unpack_signed(frame)
+        if not signature:
+            print("Unsigned message")
+            return None
+
+        if kind == framing.MAC:
+            if self.session is None or not self.session.valid_signature(payload, signature):
+                print("Invalid MAC!")
+                return None
+        elif self.sv_dh is not None:
+            if not self.sv_dh.valid_signature(payload, signature):
+                print("Invalid signature!")
+                return None
+
+        return {
+            'message': self.encoding.loads(payload),
             'signature': signature,
+            'payload': payload,
         }
 
-        msg = json.dumps(msg) + EOM
-        self.sock.send(msg.encode())
-
 
     # Waits for a reply from server (blocking)
     def wait_for_reply(self, bypass_buffer=False):
@@ -193,33 +192,18 @@ class Client:
             reply = self.buffer.pop(0)
             #print("Processing: ", reply)
         else:
-            received, addr = self.sock.recvfrom(BUFFER_SIZE)
-            if not received:
+            frames = self.receive()
+            if not frames:
                 print("Server side error!\nClosing client")
                 exit()
 
-            #print("\nReceived:", received)
-            reply = received.decode().rstrip()
-            reply = reply.split(EOM)
-            
-            if len(reply) > 1:
-                self.buffer += reply[1:-1]
-            reply = reply[0]
-        
-        reply = json.loads(reply)
+            self.buffer += frames[1:]
+            reply = frames[0]
         
-        if 'signature' not in reply.keys():
-            print("Unsigned message")
+        reply = self.open_frame(reply)
+        if not reply:
             return False
 
-        if self.sv_dh is not None:
-            signature = b64decode(reply['signature'])
-            if not self.sv_dh.valid_signature(
-                    json.dumps(reply['message']), 
-                    signature):
-                print("Invalid signature!")
-                return False
-
         if 'error' in reply['message'].keys():
             print("ERROR:", reply['message']['error'])
             return False
@@ -247,36 +231,51 @@ class Client:
                             else:
                                 print("Invalid command!")
                     else:
-                        received = s.recv(BUFFER_SIZE).decode().rstrip()
-                        print("Received:", received)
+                        received = s.recv(BUFFER_SIZE)
                         if not received:
                             print("Server disconnected")
                             exit()
-                        reply = received.split(EOM)
-                        if len(reply) > 1:
-                            self.buffer += reply[1:-1]
-                        reply = reply[0]
+                        frames = self.decoder.feed(received)
+                        if self.trace is not None:
+                            self.trace.count_in(len(received), len(frames))
+                        if frames:
+                            self.buffer += frames[1:]
+                            reply = frames[0]
                         
             if reply:
-                reply = json.loads(reply)
+                reply = self.open_frame(reply)
+                if not reply:
+                    return False, False
+
+                print("Received:", reply['message'])
                 if 'error' in reply['message'].keys():
                     print("ERROR:", reply['message']['error'])
                     return False, False
-                
-                if 'signature' not in reply.keys():
-                    print("Unsigned message")
-                    return False, False
 
-                signature = b64decode(reply['signature'])
+                return reply, None
 
-                if not self.sv_dh.valid_signature(
-                        json.dumps(reply['message']), 
-                        signature):
-                    #print("Invalid signature!")
-                    return False, False
 
-                return reply, None
+    # Puts a message back in the buffer to be processed later
+    def push_back(self, msg):
+        self.buffer.append(msg)
+
+
+    def send_payload(self, payload, signature=b'', kind=framing.SIGNATURE):
+        frame = framing.encode_signed_frame(payload, signature, kind)
+        self.sock.sendall(frame)
+        if self.trace is not None:
+            self.trace.count_out(len(frame))
+
 
     def send(self, msg):
-        msg = json.dumps(msg) + EOM
-        self.sock.send(msg.encode())
+        self.send_payload(self.encoding.dumps(msg))
+
+
+    # Signs the encoded message once and sends those same bytes.
+    # With a session only proofs get an ECDSA signature, the rest a MAC.
+    def sign_and_send(self, msg, proof=False):
+        payload = self.encoding.dumps(msg)
+        if self.session is not None and not proof:
+            self.send_payload(payload, self.session.sign(payload), framing.MAC)
+        else:
+            self.send_payload(payload, self.dh.sign(payload))
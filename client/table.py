@@ -16,12 +16,17 @@ from player import Player
 from hearts import Hearts
 sys.path.insert(1, os.path.join(sys.path[0], '..'))
 import security
+import tracing
 
 # Chances
 PICK_CHANCE = 0.2
 SWAP_CHANCE = 0.5
 COMMIT_CHANCE = 0.5
 
+# Phase timelines of the tables played (tracing.py) are appended to this
+# file as JSON lines. None: they are not written.
+TRACE_FILE = None
+
 
 def decide_to_pick():
     return rand.random() < PICK_CHANCE
@@ -98,19 +103,39 @@ class Table:
         self.passing_data = {'commits': {}, 'deck_keys': {}}
         
 
+    # Every phase is a span of the table's timeline, with the messages and
+    # bytes the client exchanged during it
     def start(self):
-        self.wait_in_lobby()
-        self.player_auth()
-        self.player_confirmation()
-        
-        self.deck_encrypting()
-        self.card_selection()
-        self.commit_deck()
-        self.share_deck_key()
-        self.verify_equal_info()
-        self.update_player_info()
-        self.decrypt_hand()
-        self.start_game()
+        trace = tracing.Timeline(self.table_id, 'player', TRACE_FILE, self.myself)
+        self.c.trace = trace
+        outcome = 'failed'
+        try:
+            trace.enter('wait_in_lobby')
+            self.wait_in_lobby()
+            trace.enter('player_auth')
+            self.player_auth()
+            trace.enter('player_confirmation')
+            self.player_confirmation()
+
+            trace.enter('deck_encrypting')
+            self.deck_encrypting()
+            trace.enter('card_selection')
+            self.card_selection()
+            trace.enter('commit_deck')
+            self.commit_deck()
+            trace.enter('share_deck_key')
+            self.share_deck_key()
+            trace.enter('verify_equal_info')
+            self.verify_equal_info()
+
+            trace.enter('play')
+            self.update_player_info()
+            self.decrypt_hand()
+            self.start_game()
+            outcome = 'game_over'
+        finally:
+            trace.end(outcome)
+            self.c.trace = None
 
 
     def update_state(self, new_state):
@@ -185,7 +210,9 @@ class Table:
             'certificate': self.c.cc.sendable_cert,
             'chain': self.c.cc.sendable_chain,
         }
-        my_sig = self.c.cc.sign(json.dumps(my_auth))
+        # Relayed as the signed text itself, so others check these exact bytes
+        my_auth = json.dumps(my_auth)
+        my_sig = self.c.cc.sign(my_auth)
         my_sig = b64encode(my_sig).decode('utf-8')
 
         my_msg = {
@@ -219,7 +246,7 @@ class Table:
 
             # Cycle buffer before checking for new msg
             if 'table_update' in msg['message'].keys():
-                self.c.buffer.append(json.dumps(msg))
+                self.c.push_back(msg)
                 count_reads = True
                 continue
             
@@ -227,7 +254,8 @@ class Table:
             
             relayed = msg['message']['relayed']
             signature = b64decode(relayed['signature'])
-            relayed = relayed['message']
+            signed_auth = relayed['message']
+            relayed = json.loads(signed_auth)
 
             # Build chain
             cert = b64decode(relayed['certificate'])
@@ -240,7 +268,7 @@ class Table:
                 print("Invalid certificate / chain from player:", src)
                 exit()
 
-            if not security.validate_cc_sign(json.dumps(relayed), signature, cert):
+            if not security.validate_cc_sign(signed_auth, signature, cert):
                 print("Invalid signature from player:", src)
                 exit()
 
@@ -267,12 +295,6 @@ class Table:
             'table_id': self.table_id,
             'identities': identities,
         }
-        signature = self.c.dh.sign(json.dumps(confirmation))
-        signature = b64encode(signature).decode('utf-8')
-        my_confirmation = {
-            'message': confirmation,
-            'signature': signature,
-        }
         
         confirms = 0
         confirmed = False
@@ -282,7 +304,7 @@ class Table:
         while confirms < self.max_players or self.state=='FULL':
             # Automatic mode: send confirmation
             if self.auto and not confirmed and self.state == 'FULL':
-                self.c.send(my_confirmation)
+                self.c.sign_and_send(confirmation)
                 confirmed = True
             
             if count_reads and buffer_reads >= len(self.c.buffer):
@@ -303,7 +325,7 @@ class Table:
             
             # User input
             if cmd and cmd == 'confirm' and not confirmed:
-                self.c.send(my_confirmation)
+                self.c.sign_and_send(confirmation)
                 confirmed = True
             
             # Received a message from server
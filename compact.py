@@ -0,0 +1,253 @@
+import struct
+
+# Compact binary encoding of the values found in messages (None, bools,
+# ints, floats, strings, bytes, lists and dicts). The layout follows the
+# MessagePack format so captures can be read with standard tools.
+
+_u8 = struct.Struct('!B')
+_u16 = struct.Struct('!H')
+_u32 = struct.Struct('!I')
+_u64 = struct.Struct('!Q')
+_i8 = struct.Struct('!b')
+_i16 = struct.Struct('!h')
+_i32 = struct.Struct('!i')
+_i64 = struct.Struct('!q')
+_f64 = struct.Struct('!d')
+
+
+def dumps(obj):
+    out = bytearray()
+    _pack(obj, out)
+    return bytes(out)
+
+
+def loads(data):
+    if type(data) is not bytes:
+        data = bytes(data)
+    obj, pos = _unpack(data, 0)
+    if pos != len(data):
+        raise ValueError("Trailing bytes after compact value")
+    return obj
+
+
+def _pack_size(size, out, fix_base, fix_max, c16, c32):
+    if size <= fix_max:
+        out.append(fix_base | size)
+    elif size < 0x10000:
+        out.append(c16)
+        out += _u16.pack(size)
+    else:
+        out.append(c32)
+        out += _u32.pack(size)
+
+
+def _pack(obj, out):
+    t = type(obj)
+
+    if t is str:
+        data = obj.encode('utf-8')
+        size = len(data)
+        if size < 32:
+            out.append(0xa0 | size)
+        elif size < 0x100:
+            out.append(0xd9)
+            out.append(size)
+        elif size < 0x10000:
+            out.append(0xda)
+            out += _u16.pack(size)
+        else:
+            out.append(0xdb)
+            out += _u32.pack(size)
+        out += data
+
+    elif t is int:
+        if 0 <= obj < 0x80:
+            out.append(obj)
+        elif -32 <= obj < 0:
+            out.append(obj & 0xff)
+        elif obj >= 0:
+            if obj < 0x100:
+                out.append(0xcc)
+                out.append(obj)
+            elif obj < 0x10000:
+                out.append(0xcd)
+                out += _u16.pack(obj)
+            elif obj < 0x100000000:
+                out.append(0xce)
+                out += _u32.pack(obj)
+            elif obj < 0x10000000000000000:
+                out.append(0xcf)
+                out += _u64.pack(obj)
+            else:
+                raise ValueError("Integer too big for compact encoding")
+        else:
+            if obj >= -0x80:
+                out.append(0xd0)
+                out += _i8.pack(obj)
+            elif obj >= -0x8000:
+                out.append(0xd1)
+                out += _i16.pack(obj)
+            elif obj >= -0x80000000:
+                out.append(0xd2)
+                out += _i32.pack(obj)
+            elif obj >= -0x8000000000000000:
+                out.append(0xd3)
+                out += _i64.pack(obj)
+            else:
+                raise ValueError("Integer too big for compact encoding")
+
+    elif t is dict:
+        _pack_size(len(obj), out, 0x80, 15, 0xde, 0xdf)
+        for key, value in obj.items():
+            _pack(key, out)
+            _pack(value, out)
+
+    elif t is list or t is tuple:
+        _pack_size(len(obj), out, 0x90, 15, 0xdc, 0xdd)
+        for value in obj:
+            _pack(value, out)
+
+    elif obj is None:
+        out.append(0xc0)
+
+    elif obj is True:
+        out.append(0xc3)
+
+    elif obj is False:
+        out.append(0xc2)
+
+    elif t is float:
+        out.append(0xcb)
+        out += _f64.pack(obj)
+
+    elif t is bytes or t is bytearray:
+        size = len(obj)
+        if size < 0x100:
+            out.append(0xc4)
+            out.append(size)
+        elif size < 0x10000:
+            out.append(0xc5)
+            out += _u16.pack(size)
+        else:
+            out.append(0xc6)
+            out += _u32.pack(size)
+        out += obj
+
+    else:
+        raise TypeError("Cannot encode {} in compact format".format(t.__name__))
+
+
+# Fixed size scalars: type byte -> (struct, payload size)
+_SCALARS = {
+    0xcc: (_u8, 1),
+    0xcd: (_u16, 2),
+    0xce: (_u32, 4),
+    0xcf: (_u64, 8),
+    0xd0: (_i8, 1),
+    0xd1: (_i16, 2),
+    0xd2: (_i32, 4),
+    0xd3: (_i64, 8),
+    0xcb: (_f64, 8),
+}
+
+# Length prefixed values: type byte -> (kind, length struct, length size)
+_SIZED = {
+    0xd9: (0, _u8, 1),
+    0xda: (0, _u16, 2),
+    0xdb: (0, _u32, 4),
+    0xc4: (1, _u8, 1),
+    0xc5: (1, _u16, 2),
+    0xc6: (1, _u32, 4),
+    0xdc: (2, _u16, 2),
+    0xdd: (2, _u32, 4),
+    0xde: (3, _u16, 2),
+    0xdf: (3, _u32, 4),
+}
+
+_CONSTANTS = {0xc0: None, 0xc2: False, 0xc3: True}
+
+
+def _unpack(data, pos):
+    try:
+        b = data[pos]
+    except IndexError:
+        raise ValueError("Truncated compact value")
+    pos += 1
+
+    # Most common types first
+    if 0xa0 <= b <= 0xbf:
+        end = pos + (b & 0x1f)
+        if end > len(data):
+            raise ValueError("Truncated compact value")
+        return data[pos:end].decode('utf-8'), end
+    if b < 0x80:
+        return b, pos
+    if b <= 0x8f:
+        return _take_map(data, pos, b & 0x0f)
+    if b <= 0x9f:
+        return _take_array(data, pos, b & 0x0f)
+    if b >= 0xe0:
+        return b - 0x100, pos
+
+    if b in _CONSTANTS:
+        return _CONSTANTS[b], pos
+
+    if b in _SCALARS:
+        fmt, size = _SCALARS[b]
+        if pos + size > len(data):
+            raise ValueError("Truncated compact value")
+        return fmt.unpack_from(data, pos)[0], pos + size
+
+    if b in _SIZED:
+        kind, fmt, size = _SIZED[b]
+        if pos + size > len(data):
+            raise ValueError("Truncated compact value")
+        length = fmt.unpack_from(data, pos)[0]
+        pos += size
+        if kind == 2:
+            return _take_array(data, pos, length)
+        if kind == 3:
+            return _take_map(data, pos, length)
+        end = pos + length
+        if end > len(data):
+            raise ValueError("Truncated compact value")
+        if kind == 0:
+            return data[pos:end].decode('utf-8'), end
+        return data[pos:end], end
+
+    raise ValueError("Unknown compact type byte: 0x{:02x}".format(b))
+
+
+def _take_array(data, pos, length):
+    items = []
+    append = items.append
+    for _ in range(length):
+        value, pos = _unpack(data, pos)
+        append(value)
+    return items, pos
+
+
+def _take_map(data, pos, length):
+    items = {}
+    for _ in range(length):
+        key, pos = _unpack(data, pos)
+        value, pos = _unpack(data, pos)
+        items[key] = value
+    return items, pos
+
+
+# The msgpack C extension speaks the same format, use it when installed
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+if msgpack is not None:
+    def dumps(obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def loads(data):
+        try:
+            return msgpack.unpackb(data, raw=False, strict_map_key=False)
+        except (msgpack.ExtraData, msgpack.FormatError, msgpack.StackError) as e:
+            raise ValueError(str(e))
@@ -0,0 +1,269 @@
+import os
+import sys
+import json
+import time
+import types
+import socket
+import asyncio
+import threading
+from collections import Counter, deque
+
+# Admin console of a running croupier on a local unix socket (only the
+# owner of the croupier may connect). One command per connection, the reply
+# is sent back and the connection closed:
+#
+#   profile SECONDS          cProfile of the event loop thread (the dispatch
+#                            loop) for SECONDS, written as a .pstats file
+#   sample SECONDS [all]     samples the stack of the event loop thread (or
+#                            of every thread) SAMPLE_RATE times a second,
+#                            written as collapsed stacks (.folded)
+#   tracemalloc start [N]    starts tracing allocations, N frames deep
+#   tracemalloc [TOP]        top allocators by line, and every traced
+#                            traceback written as collapsed stacks weighted
+#                            by bytes (.folded)
+#   tracemalloc stop
+#   help
+#
+# plus the commands the croupier adds (tables, clients). Profiles go to
+# PROFILE_DIR and the reply says where. .pstats files load into snakeviz,
+# gprof2dot or flameprof; .folded files into flamegraph.pl or speedscope.
+#
+# usage: python3 admin.py SOCKET COMMAND [ARGS...]
+
+PROFILE_DIR = 'profiles'
+SAMPLE_RATE = 200
+MAX_SECONDS = 600
+TRACEMALLOC_FRAMES = 25
+TRACEMALLOC_TOP = 25
+
+# Shared by everything, not counted in the size of what references them
+NOT_OWNED = (types.ModuleType, type, types.FunctionType, types.BuiltinFunctionType, types.MethodType)
+
+
+class Admin:
+    def __init__(self, name, directory=PROFILE_DIR):
+        self.name = name
+        self.directory = directory
+        self.loop_thread = None
+        # A single profile or sample at a time
+        self.profiling = False
+        self.commands = {
+            'help': self.help,
+            'profile': self.profile,
+            'sample': self.sample,
+            'tracemalloc': self.tracemalloc,
+        }
+
+    # func(*args) returns the reply: text, or something turned into JSON
+    # lines (a list is one line per item). It may be a coroutine.
+    def command(self, name, func):
+        self.commands[name] = func
+
+    async def serve(self, path):
+        if os.path.exists(path):
+            os.unlink(path)
+        self.loop_thread = threading.get_ident()
+        server = await asyncio.start_unix_server(self.handle_command, path)
+        os.chmod(path, 0o600)
+        return server
+
+    async def handle_command(self, reader, writer):
+        try:
+            line = await reader.readline()
+            words = line.decode('utf-8', 'replace').split()
+            if not words:
+                reply = self.help()
+            elif words[0] not in self.commands:
+                reply = "Unknown command '{}'\n{}".format(words[0], self.help())
+            else:
+                try:
+                    reply = self.commands[words[0]](*words[1:])
+                    if asyncio.iscoroutine(reply):
+                        reply = await reply
+                except (TypeError, ValueError) as e:
+                    reply = "Error: {}".format(e)
+
+            writer.write(format_reply(reply).encode('utf-8'))
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def help(self):
+        return "Commands: " + ', '.join(sorted(self.commands))
+
+    # New file in the profile directory, named after the croupier and the time
+    def output_path(self, kind, ext):
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        return os.path.abspath(os.path.join(
+            self.directory, '{}-{}-{}.{}'.format(self.name, kind, stamp, ext)))
+
+
+    #####################################################################
+    ## Profiles
+
+    async def profile(self, seconds):
+        import cProfile
+        seconds = profile_seconds(seconds)
+        if self.profiling:
+            return "Error: a profile is already running"
+
+        self.profiling = True
+        profiler = cProfile.Profile()
+        try:
+            # Runs in the loop thread, so everything the loop dispatches
+            # while we sleep is in it (the crypto pools are other threads)
+            profiler.enable()
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+            self.profiling = False
+
+        path = self.output_path('profile', 'pstats')
+        profiler.dump_stats(path)
+        return path
+
+    async def sample(self, seconds, threads='loop'):
+        seconds = profile_seconds(seconds)
+        if threads not in ('loop', 'all'):
+            raise ValueError("threads must be 'loop' or 'all'")
+        if self.profiling:
+            return "Error: a profile is already running"
+
+        self.profiling = True
+        try:
+            only = self.loop_thread if threads == 'loop' else None
+            stacks = await asyncio.get_running_loop().run_in_executor(
+                None, sample_stacks, seconds, 1 / SAMPLE_RATE, only)
+        finally:
+            self.profiling = False
+
+        path = self.output_path('sample', 'folded')
+        write_folded(path, stacks)
+        return "{} ({} samples)".format(path, sum(stacks.values()))
+
+
+    #####################################################################
+    ## Memory
+
+    def tracemalloc(self, action=None, value=None):
+        import tracemalloc
+        if action == 'start':
+            frames = int(value) if value is not None else TRACEMALLOC_FRAMES
+            tracemalloc.start(frames)
+            return "Tracing allocations ({} frames)".format(frames)
+        if action == 'stop':
+            tracemalloc.stop()
+            return "Stopped tracing allocations"
+        if not tracemalloc.is_tracing():
+            return "Error: not tracing allocations, 'tracemalloc start' first"
+
+        top = int(action) if action is not None else TRACEMALLOC_TOP
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<unknown>'),
+        ])
+
+        stacks = Counter()
+        for stat in snapshot.statistics('traceback'):
+            # Oldest frame first, as collapsed stacks want them
+            stack = ';'.join(
+                '{}:{}'.format(os.path.basename(frame.filename), frame.lineno)
+                for frame in stat.traceback)
+            stacks[stack] += stat.size
+        path = self.output_path('tracemalloc', 'folded')
+        write_folded(path, stacks)
+
+        current, peak = tracemalloc.get_traced_memory()
+        lines = ["Traced: {:.1f} KiB (peak {:.1f} KiB), stacks in {}".format(
+            current / 1024, peak / 1024, path)]
+        for stat in snapshot.statistics('lineno')[:top]:
+            frame = stat.traceback[0]
+            lines.append("{:>10.1f} KiB {:>8} blocks  {}:{}".format(
+                stat.size / 1024, stat.count, frame.filename, frame.lineno))
+        return '\n'.join(lines)
+
+
+def profile_seconds(seconds):
+    seconds = float(seconds)
+    if not 0 < seconds <= MAX_SECONDS:
+        raise ValueError("seconds must be between 0 and {}".format(MAX_SECONDS))
+    return seconds
+
+
+# Collapsed stack -> samples, taking the stacks of the threads (only the
+# one with the given id if there is one) every interval seconds
+def sample_stacks(seconds, interval, only=None):
+    stacks = Counter()
+    me = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me or (only is not None and ident != only):
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{} ({}:{})'.format(
+                    code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            stacks[';'.join(reversed(stack))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+# One "frame;frame;... weight" line per stack, as flamegraph.pl reads them
+def write_folded(path, stacks):
+    with open(path, 'w') as f:
+        for stack, weight in stacks.most_common():
+            f.write('{} {}\n'.format(stack, weight))
+
+
+def format_reply(reply):
+    if type(reply) is str:
+        return reply + '\n'
+    if type(reply) is not list:
+        reply = [reply]
+    return ''.join(json.dumps(item) + '\n' for item in reply)
+
+
+# Approximate memory held by obj and what it references, without going into
+# the objects of the types in skip (nor modules, classes and functions)
+def deep_size(obj, skip=(), seen=None):
+    if seen is None:
+        seen = set()
+    if id(obj) in seen or isinstance(obj, skip) or isinstance(obj, NOT_OWNED):
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += deep_size(key, skip, seen) + deep_size(value, skip, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        for item in obj:
+            size += deep_size(item, skip, seen)
+    elif hasattr(obj, '__dict__'):
+        size += deep_size(vars(obj), skip, seen)
+    return size
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("usage: python3 admin.py SOCKET COMMAND [ARGS...]")
+        sys.exit(1)
+
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.connect(sys.argv[1])
+    s.sendall((' '.join(sys.argv[2:]) + '\n').encode('utf-8'))
+    while True:
+        data = s.recv(64 * 1024)
+        if not data:
+            break
+        sys.stdout.write(data.decode('utf-8', 'replace'))
+    s.close()
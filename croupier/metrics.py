@@ -0,0 +1,189 @@
+import time
+import asyncio
+import threading
+from bisect import bisect_left
+
+# Metrics of the croupier, served in the Prometheus text format over HTTP on
+# a local admin port (GET /metrics). Counters and histograms are updated
+# where things happen, gauges are read from the croupier's state when
+# scraped. Series are keyed by their label values.
+
+LATENCY_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+BYTES_BUCKETS = [256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216]
+
+# Biggest HTTP request the admin port reads
+MAX_REQUEST = 8 * 1024
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = list(labels)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, *values):
+        with self.lock:
+            self.series[values] = self.series.get(values, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            series = dict(self.series)
+        for values, value in sorted(series.items()):
+            yield self.name, self.labels, values, value
+
+
+# Value read from a callback when scraped: a number, or a dict of label
+# values -> number when the gauge has labels
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), read=None):
+        self.name = name
+        self.help = help
+        self.labels = list(labels)
+        self.read = read
+
+    def samples(self):
+        value = self.read()
+        if not self.labels:
+            yield self.name, [], (), value
+            return
+        for values, v in sorted(value.items()):
+            if type(values) is not tuple:
+                values = (values,)
+            yield self.name, self.labels, values, v
+
+
+# Counter kept by someone else (a stats() method), read when scraped
+class Read_Counter(Gauge):
+    kind = 'counter'
+
+
+# Cumulative buckets as Prometheus wants them: every observation counts in
+# the first bucket it fits and the ones after it
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = list(labels)
+        self.buckets = list(buckets)
+        # Label values -> [count per bucket..., count above the last, sum]
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *values):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(values)
+            if series is None:
+                series = self.series[values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[i] += 1
+            series[-1] += value
+
+    # Runs func(*args) and observes how long it took
+    def time(self, values, func, *args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.observe(time.perf_counter() - start, *values)
+
+    def samples(self):
+        with self.lock:
+            series = {values: list(s) for values, s in self.series.items()}
+        labels = self.labels + ['le']
+        for values, s in sorted(series.items()):
+            total = 0
+            for bound, count in zip(self.buckets + ['+Inf'], s[:-1]):
+                total += count
+                yield self.name + '_bucket', labels, values + (format_value(bound),), total
+            yield self.name + '_sum', self.labels, values, s[-1]
+            yield self.name + '_count', self.labels, values, total
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name, help, read, labels=()):
+        return self.add(Gauge(name, help, labels, read))
+
+    def read_counter(self, name, help, read, labels=()):
+        return self.add(Read_Counter(name, help, labels, read))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    # Every metric in the Prometheus text exposition format (0.0.4)
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for name, labels, values, value in metric.samples():
+                if labels:
+                    name += '{' + ','.join(
+                        '{}="{}"'.format(label, escape(str(v)))
+                        for label, v in zip(labels, values)) + '}'
+                lines.append('{} {}'.format(name, format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+    #####################################################################
+    ## Admin port
+
+    async def serve(self, host, port):
+        return await asyncio.start_server(
+            self.handle_request, host, port, limit=MAX_REQUEST, reuse_address=True)
+
+    async def handle_request(self, reader, writer):
+        try:
+            request = await reader.readuntil(b'\r\n\r\n')
+            method, path = request.split(b' ', 2)[:2]
+            if method != b'GET':
+                status, body = '405 Method Not Allowed', ''
+            elif path.split(b'?')[0] != b'/metrics':
+                status, body = '404 Not Found', ''
+            else:
+                status, body = '200 OK', self.render()
+
+            body = body.encode('utf-8')
+            writer.write((
+                'HTTP/1.1 {}\r\n'
+                'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                'Content-Length: {}\r\n'
+                'Connection: close\r\n\r\n').format(status, len(body)).encode('ascii') + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if type(value) is str:
+        return value
+    if type(value) is float and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+registry = Registry()
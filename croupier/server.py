@@ -1,15 +1,18 @@
-import socket 
-import json
-import select, os, sys
+import asyncio
+import os, sys
 from sys import argv
-import time, datetime
+import time
+from collections import deque
 from base64 import b64decode, b64encode
 from termcolor import colored
-from cryptography import x509
-from cryptography.hazmat.primitives import hashes  
-from cryptography.hazmat.backends import default_backend
 sys.path.insert(1, os.path.join(sys.path[0], '..'))
 import security
+import framing
+import shards
+import metrics
+import admin
+import tracing
+import wire
 from hearts import Hearts
 
 # Global vars
@@ -17,7 +20,9 @@ table_id_counter = 0
 tables = {}
 pre_registers = {}
 clients = {}
-buffer = []
+
+# Set in each worker when running with several processes
+shard = None
 
 # Address
 IP = 'localhost'
@@ -26,29 +31,144 @@ SV_ADDR = (IP, SERVER_PORT)
 
 # Socket configs
 BUFFER_SIZE = 64 * 1024
+BACKLOG = 1024
+
+# Outbound buffer per connection: above the high watermark we stop reading
+# from that client until it gets back under the low one. A client that lets
+# more than MAX_WRITE_BUFFER pile up is not reading at all and is dropped.
+WRITE_HIGH_WATER = 256 * 1024
+WRITE_LOW_WATER = 64 * 1024
+MAX_WRITE_BUFFER = 8 * 1024 * 1024
+
+# Threads doing signatures and their checks (None: one per CPU)
+CRYPTO_POOL_SIZE = None
+
+# Threads validating certificate chains of new clients. Kept apart from the
+# crypto pool so slow chains (CRL parsing) never hold up game messages.
+REGISTRATION_POOL_SIZE = 4
+
+# Seconds between looks at the CRL directory for new or changed CRLs
+CRL_REFRESH_INTERVAL = 10
 
-# TCP Socket
-sock = socket.socket(
-    socket.AF_INET, 
-    socket.SOCK_STREAM
-)
-sock.setsockopt(
-    socket.SOL_SOCKET,
-    socket.SO_REUSEADDR, 
-    1
-)
-sock.bind(SV_ADDR)
+# Admin port with the metrics in the Prometheus text format (GET /metrics),
+# only on IP. Worker i of a multi-process croupier uses METRICS_PORT + i.
+# None turns it off.
+METRICS_PORT = 50100
+
+# Unix socket of the admin console (admin.py): profiles, allocations and the
+# live tables and clients. Worker i uses croupier-i.sock. None turns it off.
+ADMIN_SOCKET = 'croupier.sock'
+
+# Phase timelines of the tables (tracing.py) are appended to this file as
+# JSON lines when a table is over. None: they are not written.
+TRACE_FILE = None
 
 # Server diffie hellman
 dh = security.Diffie_Hellman()
 dh.generate_keys()
 
-# End of message token
-EOM = '---EOM---' 
+crypto_pool = security.Crypto_Pool(CRYPTO_POOL_SIZE)
+# Every registration on its own, a slow chain holds back no other
+registration_pool = security.Crypto_Pool(REGISTRATION_POOL_SIZE, batch=False)
+
+# Registration goes through these stages, each one timed:
+#   hello        connection accepted until the croupier key is sent
+#   register     until the client's register message arrives
+#   certificate  certificate chain validation (registration pool)
+#   signature    card signature check (crypto pool)
+#   admit        moved from pre_registers to clients
+REGISTRATION_STAGES = ['hello', 'register', 'certificate', 'signature', 'admit']
+
+# Stage -> [count, total seconds, max seconds]
+registration_latency = {stage: [0, 0.0, 0.0] for stage in REGISTRATION_STAGES}
+
+# Intents known to the croupier, anything else is counted as 'other'
+INTENTS = ['register', 'get_table_list', 'join_table', 'create_table', 'confirm_players',
+           'relay', 'validate_pre_game', 'bit_commit', 'play']
+
+# Connections being served by this process
+open_connections = 0
+
+
+#########################################################################
+## Metrics
+
+intent_latency = metrics.registry.histogram(
+    'croupier_intent_seconds',
+    'Time handling a message, from its signature check until its handler returns',
+    ['intent'])
+signature_latency = metrics.registry.histogram(
+    'croupier_signature_seconds',
+    'Time signing messages and checking their signatures',
+    ['operation', 'kind'])
+registration_stage_latency = metrics.registry.histogram(
+    'croupier_registration_stage_seconds',
+    'Time a registration spent in each stage',
+    ['stage'])
+bytes_received = metrics.registry.counter(
+    'croupier_received_bytes_total', 'Bytes read from the clients')
+bytes_sent = metrics.registry.counter(
+    'croupier_sent_bytes_total', 'Bytes written to the clients')
+connection_bytes = metrics.registry.histogram(
+    'croupier_connection_bytes',
+    'Bytes moved by a connection until it closed',
+    ['direction'],
+    metrics.BYTES_BUCKETS)
+
+
+def tables_by_state():
+    states = {}
+    for table in tables.values():
+        states[table.state] = states.get(table.state, 0) + 1
+    return states
+
+
+metrics.registry.gauge(
+    'croupier_open_connections', 'Connections being served',
+    lambda: open_connections)
+metrics.registry.gauge(
+    'croupier_pre_registers', 'Connections that have not registered yet',
+    lambda: len(pre_registers))
+metrics.registry.gauge(
+    'croupier_clients', 'Registered clients',
+    lambda: len(clients))
+metrics.registry.gauge(
+    'croupier_tables', 'Tables by state',
+    tables_by_state, ['state'])
+metrics.registry.gauge(
+    'croupier_crypto_queue_depth', 'Jobs waiting in or running on the crypto pools',
+    lambda: {'crypto': crypto_pool.queue_depth, 'registration': registration_pool.queue_depth},
+    ['pool'])
+metrics.registry.read_counter(
+    'croupier_validation_cache_hits_total', 'Certificate validations answered from the cache',
+    lambda: security.validation_cache.stats()['hits'])
+metrics.registry.read_counter(
+    'croupier_validation_cache_misses_total', 'Certificate validations that had to be done',
+    lambda: security.validation_cache.stats()['misses'])
+metrics.registry.gauge(
+    'croupier_validation_cache_entries', 'Validation results in the cache',
+    lambda: security.validation_cache.stats()['entries'])
+
+
+# Records the time a pre-registered client spent in a stage
+def end_stage(client, stage):
+    now = time.monotonic()
+    elapsed = now - client.stage_start
+    client.stage_start = now
+    client.stage_times[stage] = elapsed
+
+    latency = registration_latency[stage]
+    latency[0] += 1
+    latency[1] += elapsed
+    if elapsed > latency[2]:
+        latency[2] = elapsed
+    registration_stage_latency.observe(elapsed, stage)
 
 
 def pre_register_client(client_socket):
     new_client = Client(client_socket)
+    new_client.stage_start = time.monotonic()
+    new_client.stage_times = {}
     pre_registers[client_socket] = new_client
 
 
@@ -58,26 +178,26 @@ def send_pub_key(client_socket):
     msg = {
         'pub_key': dh.share_key(),
         'iv': dh.share_iv(),
+        'encodings': wire.names(),
+        'session_modes': [security.SESSION_MAC],
     }
-    signature = dh.sign(json.dumps(msg))
-    signature = b64encode(signature).decode('utf-8')
+    c.sign_and_send(msg)
+    end_stage(c, 'hello')
 
-    msg = {
-        'message': msg,
-        'signature': signature,
-    }
 
-    msg = json.dumps(msg) + EOM 
-    msg = msg.encode()
-    client_socket.send(msg)
+# Certificate chain check of a registration (runs in the registration pool)
+def validate_certificate(cl_cert, chain):
+    try:
+        return security.validate_cert(cl_cert , chain)
+    except ValueError:
+        return False
 
 
-def register_client(msg, client_socket):
+async def register_client(msg, payload, signature, client_socket):
     c = pre_registers[ client_socket ]
+    end_stage(c, 'register')
 
     # Get all necessary fields
-    signature = b64decode(msg['signature'])
-    msg = msg['message']
     intent = msg['intent']
     name = msg['name']
     client_dh = security.DH_Params()
@@ -90,15 +210,28 @@ def register_client(msg, client_socket):
     chain = []
     for chain_cert in msg['chain']:
         chain.append(b64decode(chain_cert))
-    
-    if not security.validate_cert(cl_cert , chain):
+
+    # Other connections keep being served while this one is validated,
+    # the client stays in pre_registers meanwhile
+    valid = await registration_pool.submit(validate_certificate, cl_cert, chain)
+    if client_socket not in pre_registers:
+        return
+    end_stage(c, 'certificate')
+
+    if not valid:
         print(colored("Client '"+str(name)+"' certificate could not be verified", 'red'))
         del pre_registers[client_socket]
         return
 
     # Validate signature
-    msg = json.dumps(msg)
-    if not security.validate_cc_sign(msg, signature, cl_cert):
+    valid = await crypto_pool.submit(
+        signature_latency.time, ('verify', 'cc'),
+        security.validate_cc_sign, payload, signature, cl_cert)
+    if client_socket not in pre_registers:
+        return
+    end_stage(c, 'signature')
+
+    if not valid:
         print(colored("Client '"+str(name)+"' signature could not be verified", 'red'))
         del pre_registers[client_socket]
         return
@@ -107,19 +240,35 @@ def register_client(msg, client_socket):
     c.name = name
     c.dh = client_dh
     c.chain = chain
+    c.encoding = wire.get(msg.get('encoding'))
+    if msg.get('session') == security.SESSION_MAC:
+        c.session = security.Session_MAC(dh, client_dh.public_key, croupier=True)
     clients[client_socket] = c
     del pre_registers[client_socket]
+    end_stage(c, 'admit')
+
+    print("Client '{}' registered ({})".format(name, ', '.join(
+        "{} {:.1f} ms".format(stage, c.stage_times[stage] * 1000)
+        for stage in REGISTRATION_STAGES)))
+
+
+def table_list_entry(table):
+    return {
+        'id': table.table_id,
+        'title': table.title,
+        'player_count': table.player_count,
+        'max_players': table.max_players}
 
 
 def send_table_list(client_socket):
-    table_list = []
-    for table in tables.values():
-        if table.state == 'OPEN':
-            table_list.append({
-                'id': table.table_id,
-                'title': table.title,
-                'player_count': table.player_count,
-                'max_players': table.max_players})
+    if shard is not None:
+        table_list = list(shard.open_tables())
+    else:
+        table_list = [
+            table_list_entry(table)
+            for table in tables.values()
+            if table.state == 'OPEN'
+        ]
 
     msg = {'table_list': table_list}
 
@@ -129,12 +278,24 @@ def send_table_list(client_socket):
 def get_new_table_id():
     global table_id_counter
     new_id = table_id_counter
+    if shard is not None:
+        new_id = shard.table_id(table_id_counter)
     table_id_counter += 1
     return new_id
 
+
+# Keeps the table list of the other workers up to date
+def publish_table(table):
+    if shard is None:
+        return
+    if table.state == 'OPEN':
+        shard.publish_table(table.table_id, table_list_entry(table))
+    else:
+        shard.remove_table(table.table_id)
+
     
-def broadcast_new_player(players):
-    player = players[-1]
+def broadcast_new_player(table):
+    player = table.players[-1]
     new_player = {
         'name': player.client.name,
         'num': player.num,
@@ -144,31 +305,28 @@ def broadcast_new_player(players):
         },
     }
 
-    for p in players[:-1]:
-        msg = {
-            'table_update': {
-                'update': 'new_player', 
-                'new_player': new_player}}
-        p.client.sign_and_send(msg)
+    msg = {
+        'table_update': {
+            'update': 'new_player', 
+            'new_player': new_player}}
+    table.broadcast(msg, table.players[:-1])
 
 
 
-def broadcast_player_confirmation(players, pl_num):
-    for p in players:
-        msg = {
-            'table_update': {
-                'update': 'player_confirmation', 
-                'player_num': pl_num}}
-        p.client.sign_and_send(msg)
+def broadcast_player_confirmation(table, pl_num):
+    msg = {
+        'table_update': {
+            'update': 'player_confirmation', 
+            'player_num': pl_num}}
+    table.broadcast(msg)
 
 
-def broadcast_state_change(players, new_state):
-    for p in players:
-        msg = {
-            'table_update': {
-                'update': 'table_state', 
-                'table_state': new_state}}
-        p.client.sign_and_send(msg)
+def broadcast_state_change(table, new_state):
+    msg = {
+        'table_update': {
+            'update': 'table_state', 
+            'table_state': new_state}}
+    table.broadcast(msg)
 
 
 def generate_deck():
@@ -185,6 +343,12 @@ def generate_deck():
 
 def join_table_handler (msg, client):
     table_id = msg['table_id']
+
+    # Table lives in another worker, the connection is moved there
+    if shard is not None and not shard.is_local(table_id):
+        client.handoff = table_id
+        return
+
     if table_id not in tables.keys():
         reply = {'error': 'Table not found'}
         client.send(reply)
@@ -203,11 +367,14 @@ def join_table_handler (msg, client):
     }
     client.sign_and_send(reply)
     
-    broadcast_new_player(table.players)
+    broadcast_new_player(table)
 
     if table.is_full():
         table.state = 'FULL'
-        broadcast_state_change(table.players, 'FULL')
+        table.trace.enter('player_confirmation')
+        broadcast_state_change(table, 'FULL')
+
+    publish_table(table)
         
 
 def create_table_handler(msg, client):
@@ -216,6 +383,7 @@ def create_table_handler(msg, client):
     new_table.new_player(client)
     
     tables[table_id] = new_table
+    publish_table(new_table)
 
     reply = {
         'table_info': new_table.get_table_info(client)
@@ -243,10 +411,11 @@ def player_confirmation_handler(msg, client):
         return
     
     pl_num = table.get_player_num(client)
-    broadcast_player_confirmation(table.players, pl_num)
+    broadcast_player_confirmation(table, pl_num)
     
     if table.all_confirmed():
-        broadcast_state_change(table.players, 'SHUFFLE')
+        table.trace.enter('shuffle')
+        broadcast_state_change(table, 'SHUFFLE')
         deck = generate_deck()
         msg = {
             'from': 'croupier',
@@ -298,25 +467,32 @@ def bit_commit_handler(msg, client):
 
 def client_left_handler(client_sock):
     leavable_states = ['OPEN']
-    client = clients[client_sock]
-    for t in tables.values():
+    client = clients.pop(client_sock)
+    for t in list(tables.values()):
+        if not t.player_exists(client):
+            continue
         if t.state in leavable_states:
             player = t.get_player(client)
             t.player_left(player.num)
-            broadcast_player_left(t.players, player.num)
-            del clients[client_sock]
+            broadcast_player_left(t, player.num)
+            publish_table(t)
 
+        # Nobody is left to play it
+        if not any(p.client.socket in clients for p in t.players):
+            del tables[t.table_id]
+            if shard is not None:
+                shard.remove_table(t.table_id)
 
-def broadcast_player_left(players, player_num):
-    for p in players:
-        msg = {
-            'table_update': {
-                'update': 'player_left', 
-                'player_left': player_num}}
-        p.client.sign_and_send(msg)
+
+def broadcast_player_left(table, player_num):
+    msg = {
+        'table_update': {
+            'update': 'player_left', 
+            'player_left': player_num}}
+    table.broadcast(msg)
 
 
-def broadcast_game_abort(players, reason):
+def broadcast_game_abort(table, reason):
     pass
 
 
@@ -336,6 +512,8 @@ def pre_game_handler(msg, client):
 
     player = table.get_player(client)
     table.pre_game_infos[player.num] = msg['data']
+    if table.trace.phase() == 'shuffle':
+        table.trace.enter('verify_equal_info')
 
 
     if len(table.pre_game_infos) == table.max_players:
@@ -354,9 +532,9 @@ def pre_game_handler(msg, client):
 
         if valid:
             table.start_game()
-            broadcast_state_change(table.players, 'game')
+            broadcast_state_change(table, 'game')
         else:
-            broadcast_game_abort(table.players, 'MISMATCH VALIDATIONS')
+            broadcast_game_abort(table, 'MISMATCH VALIDATIONS')
 
 
 def play_handler(full_msg, client):
@@ -384,57 +562,66 @@ def play_handler(full_msg, client):
         return
 
     game.new_play(player, card)
-    broadcast_play(table.players, player, card, full_msg)
+    broadcast_play(table, player, card, full_msg)
 
     if game.full_trick():
         print("FULL TRICK!")
         player_num, points = game.trick_outcome()
-        broadcast_trick_outcome(table.players, player_num, points)
+        broadcast_trick_outcome(table, player_num, points)
 
     if game.is_over():
         print("GAME OVER")
         winners, losers = game.game_outcome()
-        broadcast_game_outcome(table.players, winners)
+        broadcast_game_outcome(table, winners)
+        table.trace.end('game_over')
         
 
 
-def broadcast_play(players, player, card, msg):
-    proof = msg
-    for p in players:
-        msg = {
-            'type': 'play',
-            'from': player,
-            'card': card, 
-            'proof': proof,
-        }
-        p.client.sign_and_send(msg)
+def broadcast_play(table, player, card, msg):
+    # The player's signature goes with the exact bytes it covers
+    proof = {
+        'message': msg['message'],
+        'signature': b64encode(msg['signature']).decode('utf-8'),
+        'payload': b64encode(msg['payload']).decode('utf-8'),
+    }
+    msg = {
+        'type': 'play',
+        'from': player,
+        'card': card, 
+        'proof': proof,
+    }
+    table.broadcast(msg)
 
 
-def broadcast_trick_outcome(players, player, points):
-    for p in players:
-        msg = {
-            'type': 'trick_outcome',
-            'player': player,
-            'points': points,
-        }
-        p.client.sign_and_send(msg)
+def broadcast_trick_outcome(table, player, points):
+    msg = {
+        'type': 'trick_outcome',
+        'player': player,
+        'points': points,
+    }
+    table.broadcast(msg)
 
 
-def broadcast_game_outcome(players, winners):
-    for p in players:
-        msg = {
-            'type': 'game_outcome',
-            'winners': winners
-        }
-        p.client.sign_and_send(msg)    
+def broadcast_game_outcome(table, winners):
+    msg = {
+        'type': 'game_outcome',
+        'winners': winners
+    }
+    table.broadcast(msg)
 
 
 #########################################################################
 ## Client functions
 
+# Frame with the croupier's signature (runs in the crypto pool)
+def signed_frame(payload):
+    signature = signature_latency.time(('sign', 'ecdsa'), dh.sign, payload)
+    return framing.encode_signed_frame(payload, signature)
+
+
 class Client:
     def __init__ (self, socket):
-        # Pre-register fields
+        # Pre-register fields (socket is the connection's StreamWriter)
         self.socket = socket
         self.dh = security.DH_Params()
 
@@ -443,24 +630,96 @@ class Client:
         self.cert = None
         self.chain = None
 
+        # Table id of another worker this client has to be moved to
+        self.handoff = None
 
-    def send(self, msg):
-        msg = json.dumps(msg) + EOM
-        msg = msg.encode()
-        try:
-            self.socket.send(msg)
-        except socket.error:
+        # Message encoding and session MAC keys, negotiated when registering
+        self.encoding = wire.DEFAULT
+        self.session = None
+
+        # Timeline of the table this client plays at
+        self.trace = None
+
+        # Frames waiting for the end of the current loop iteration. Frames
+        # still being signed are futures and hold back the ones after them.
+        self.outbox = deque()
+        self.waiting = None
+
+        # Bytes read from and written to this connection
+        self.bytes_in = 0
+        self.bytes_out = 0
+        socket.transport.set_write_buffer_limits(
+            high=WRITE_HIGH_WATER, low=WRITE_LOW_WATER)
+
+
+    # Frames sent in the same loop iteration are written together
+    def send_frame(self, frame):
+        if self.socket.is_closing():
             print("This client is not connected!")
+            return
+        if not self.outbox:
+            asyncio.get_running_loop().call_soon(self.flush)
+        self.outbox.append(frame)
+
+
+    def flush(self):
+        frames = []
+        while self.outbox:
+            frame = self.outbox[0]
+            if isinstance(frame, asyncio.Future):
+                if not frame.done():
+                    if self.waiting is not frame:
+                        self.waiting = frame
+                        frame.add_done_callback(lambda f: self.flush())
+                    break
+                self.outbox.popleft()
+                # A frame that could not be signed is dropped, the rest go on
+                if frame.cancelled() or frame.exception() is not None:
+                    error = 'cancelled' if frame.cancelled() else repr(frame.exception())
+                    print(colored("Could not sign a frame for '"+str(self.name)+"': "+error, 'red'))
+                    continue
+                frames.append(frame.result())
+            else:
+                frames.append(frame)
+                self.outbox.popleft()
+
+        if not frames or self.socket.is_closing():
+            return
+
+        self.socket.writelines(frames)
+        size = sum(map(len, frames))
+        self.bytes_out += size
+        bytes_sent.inc(size)
+        if self.trace is not None:
+            self.trace.count_out(size, len(frames))
+        if self.socket.transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+            print(colored("Client '"+str(self.name)+"' is not reading, dropping it", 'red'))
+            self.socket.close()
+
+
+    def send_payload(self, payload, signature=b''):
+        self.send_frame(framing.encode_signed_frame(payload, signature))
+
+
+    def send(self, msg):
+        self.send_payload(self.encoding.dumps(msg))
+
 
+    # Frame with the session MAC of an encoded message, None without session
+    def mac_frame(self, payload):
+        if self.session is None:
+            return None
+        signature = signature_latency.time(('sign', 'mac'), self.session.sign, payload)
+        return framing.encode_signed_frame(payload, signature, framing.MAC)
 
+
+    # Signs the encoded message once and sends those same bytes
     def sign_and_send(self, msg):
-        signature = dh.sign(json.dumps(msg))
-        signature = b64encode(signature).decode('utf-8')
-        msg = {
-            'message': msg,
-            'signature': signature,
-        }
-        self.send(msg)
+        payload = self.encoding.dumps(msg)
+        frame = self.mac_frame(payload)
+        if frame is None:
+            frame = crypto_pool.submit(signed_frame, payload)
+        self.send_frame(frame)
 
     def __eq__(self, other):
         if isinstance(other, Player):
@@ -502,6 +761,10 @@ class Table:
         self.pre_game_infos = {}
         self.game = None
 
+        # Phases of the table, with the messages and bytes of its players
+        self.trace = tracing.Timeline(table_id, 'croupier', TRACE_FILE)
+        self.trace.enter('wait_in_lobby')
+
     def new_player (self, client):
         if client in self.players:
             return 'Already inside'
@@ -511,10 +774,35 @@ class Table:
         
         self.players.append(Player(client, self.player_count))
         self.player_count += 1
+        client.trace = self.trace
     
         return None
     
 
+    # Sends the same message to every player (or the ones given).
+    # It is encoded and signed once per encoding in use, not per player.
+    # Players with a session get the cheap MAC instead.
+    def broadcast(self, msg, players=None):
+        if players is None:
+            players = self.players
+
+        payloads = {}
+        frames = {}
+        for p in players:
+            encoding = p.client.encoding
+            if encoding.name not in payloads:
+                payloads[encoding.name] = encoding.dumps(msg)
+            payload = payloads[encoding.name]
+
+            frame = p.client.mac_frame(payload)
+            if frame is None:
+                if encoding.name not in frames:
+                    frames[encoding.name] = crypto_pool.submit(
+                        signed_frame, payload)
+                frame = frames[encoding.name]
+            p.client.send_frame(frame)
+
+
     def player_exists (self, client):
         return client in self.players
         
@@ -528,6 +816,7 @@ class Table:
 
 
     def player_left (self, num):
+        self.players[num].client.trace = None
         del self.players[num]
         for p in self.players:
             p.confirmed = False
@@ -617,6 +906,7 @@ class Table:
 
     def start_game(self):
         self.state = 'game'
+        self.trace.enter('play')
         self.game = Hearts()
         self.game.set_players(self.players)
         
@@ -624,37 +914,97 @@ class Table:
 #########################################################################
 ## Main server functions
 
-def redirect_messages (full_msg, client_socket):
-    try:
-        msg = full_msg['message']
-        intent = msg['intent']
-    except:
-        print("Invalid message format:\n", full_msg)
-        return
+# Starts checking the signature of a frame from a registered client and
+# returns a future with the outcome. ECDSA goes to the crypto pool, MACs are
+# cheap enough to check right away. None if the client is not registered.
+def check_frame(frame, client_socket):
+    client = clients.get(client_socket)
+    if client is None:
+        return None
+
+    kind, signature, payload = framing.unpack_signed(frame)
+    if signature and kind != framing.MAC:
+        return crypto_pool.submit(
+            signature_latency.time, ('verify', 'ecdsa'),
+            client.dh.valid_signature, payload, signature)
+
+    valid = True
+    if signature:
+        valid = client.session is not None and signature_latency.time(
+            ('verify', 'mac'), client.session.valid_signature, payload, signature)
+    future = asyncio.get_running_loop().create_future()
+    future.set_result(valid)
+    return future
+
+
+# Handles a message and times it by intent ('invalid' when it could not
+# be read or its signature is wrong)
+async def redirect_messages (frame, client_socket, check=None):
+    start = time.perf_counter()
+    intent = await dispatch_message(frame, client_socket, check)
+    if intent is None:
+        intent = 'invalid'
+    elif intent not in INTENTS:
+        intent = 'other'
+    intent_latency.observe(time.perf_counter() - start, intent)
+
+
+# Returns the intent of the message, None if it was not handled
+async def dispatch_message (frame, client_socket, check=None):
+    kind, signature, payload = framing.unpack_signed(frame)
 
     # New client
-    if intent == 'register':
-        register_client (full_msg, client_socket)
+    if client_socket in pre_registers:
+        try:
+            msg = wire.DEFAULT.loads(payload)
+            intent = msg['intent']
+        except:
+            print("Invalid message format:\n", payload)
+            return
+        print("Received:\n", msg,"\n")
+
+        if intent == 'register':
+            await register_client (msg, payload, signature, client_socket)
+        return intent
 
     # Registered client
     elif client_socket in clients.keys():
         client = clients[client_socket]
 
-        # Doesnt require signature
-        if intent == 'get_table_list':
-            send_table_list (client)
+        # The signature covers the received bytes, check it before decoding
+        if check is None:
+            check = check_frame(frame, client_socket)
+        if not await check:
+            print("Invalid signature!")
             return
 
         try:
-            signature = b64decode(full_msg['signature'])
+            msg = client.encoding.loads(payload)
+            intent = msg['intent']
         except:
-            print("Invalid message format:\n", full_msg)
-            return
-        if not client.dh.valid_signature(
-                json.dumps(msg), 
-                signature):
-            print("Invalid signature!")
+            print("Invalid message format:\n", payload)
             return
+        print("Received:\n", msg,"\n")
+
+        full_msg = {
+            'message': msg,
+            'signature': signature,
+            'payload': payload,
+        }
+
+        # Doesnt require signature
+        if intent == 'get_table_list':
+            send_table_list (client)
+            return intent
+
+        if not signature:
+            print("Unsigned message:\n", msg)
+            return intent
+
+        # Plays are shown to the other players, a MAC proves nothing to them
+        if intent == 'play' and kind != framing.SIGNATURE:
+            print("Play without signature:\n", msg)
+            return intent
 
         # Following requests require signature
         if intent == 'join_table':
@@ -681,58 +1031,254 @@ def redirect_messages (full_msg, client_socket):
         else:
             pass
 
+        return intent
+
+
+
+def client_disconnected(client_socket):
+    if client_socket in pre_registers:
+        print("Unregistered user has disconnected")
+        del pre_registers[client_socket]
+    elif client_socket in clients:
+        client = clients[client_socket]
+        client_left_handler(client_socket)
+        # A player leaving a table that left the lobby ends it
+        if client.trace is not None:
+            client.trace.end('disconnected')
+    print("Client has disconnected")
+
+
+async def handle_connection(reader, writer):
+    print("Connection from", writer.get_extra_info('peername'))
+    pre_register_client(writer)
+    send_pub_key(writer)
+    await serve_connection(reader, writer)
+
+
+# Serves a single connection, messages are handled in the order they arrive
+async def serve_connection(reader, writer, data=b''):
+    global open_connections
+    open_connections += 1
+    decoder = framing.FrameDecoder()
+    handed_off = False
+    # Client of this connection, kept after it leaves pre_registers/clients
+    connection = None
+    try:
+        while True:
+            frames = decoder.feed(data)
+            if connection is not None and connection.trace is not None:
+                connection.trace.count_in(len(data), len(frames))
+
+            # Frames read together have their signatures checked in parallel,
+            # then are handled one by one in the order they came
+            checks = [check_frame(frame, writer) for frame in frames]
+            for i, frame in enumerate(frames):
+                await redirect_messages(frame, writer, checks[i])
+
+                client = clients.get(writer)
+                if client is not None and client.handoff is not None:
+                    pending = b''.join(map(framing.encode_frame, frames[i:]))
+                    await hand_off_client(client, reader, pending + decoder.pending())
+                    handed_off = True
+                    return
+
+            # Stop reading from clients that are not keeping up with replies
+            client = clients.get(writer) or pre_registers.get(writer)
+            if client is not None:
+                client.flush()
+                connection = client
+            await writer.drain()
+
+            data = await reader.read(BUFFER_SIZE)
+            if not data:
+                break
+            bytes_received.inc(len(data))
+            if connection is not None:
+                connection.bytes_in += len(data)
+    except (ConnectionError, framing.FrameError):
+        pass
+    finally:
+        open_connections -= 1
+        if not handed_off:
+            client_disconnected(writer)
+            if connection is not None:
+                connection_bytes.observe(connection.bytes_in, 'in')
+                connection_bytes.observe(connection.bytes_out, 'out')
+        writer.close()
+
+
+# Moves a registered client to the worker that owns the table it asked for.
+# The message that triggered the move is processed again over there.
+async def hand_off_client(client, reader, pending):
+    writer = client.socket
+    # Nothing more is read here, whatever arrives stays in the socket for
+    # the new owner
+    writer.transport.pause_reading()
+
+    # Replies still being signed go out before the socket moves
+    for frame in list(client.outbox):
+        if isinstance(frame, asyncio.Future):
+            await asyncio.wait([frame])
+    client.flush()
+    await writer.drain()
+
+    # Bytes the reader got from the socket but nobody read yet go along.
+    # With the end of the stream marked reading them does not wait; it may
+    # resume the transport, paused again before it gets anything.
+    reader.feed_eof()
+    pending += await reader.read()
+    writer.transport.pause_reading()
+
+    state = {
+        'name': client.name,
+        'pub_key': client.dh.share_key(),
+        'iv': client.dh.share_iv(),
+        'chain': [b64encode(c).decode('utf-8') for c in client.chain],
+        'encoding': client.encoding.name,
+        'session': client.session is not None,
+        'bytes_in': client.bytes_in,
+        'bytes_out': client.bytes_out,
+        'pending': b64encode(pending).decode('utf-8'),
+    }
+    shard.hand_off(client.handoff, state, writer.get_extra_info('socket'))
+    # Leaves its tables here like any client that goes away
+    client_left_handler(writer)
+    print("Client '"+str(client.name)+"' moved to worker", shard.owner(client.handoff))
+
+
+# Takes over a client handed off by another worker
+async def adopt_client(state, sock):
+    reader, writer = await asyncio.open_connection(sock=sock)
+    c = Client(writer)
+    c.name = state['name']
+    c.dh.load_key(state['pub_key'])
+    c.dh.load_iv(state['iv'])
+    c.chain = [b64decode(cert) for cert in state['chain']]
+    c.encoding = wire.get(state['encoding'])
+    if state['session']:
+        # Workers share the croupier keys, the session keys come out the same
+        c.session = security.Session_MAC(dh, c.dh.public_key, croupier=True)
+    c.bytes_in = state.get('bytes_in', 0)
+    c.bytes_out = state.get('bytes_out', 0)
+    clients[writer] = c
+    await serve_connection(reader, writer, b64decode(state['pending']))
+
 
+#########################################################################
+## Admin console
+
+# Live tables with the memory they hold (the players' connections apart)
+def list_tables():
+    return [{
+        'id': table.table_id,
+        'title': table.title,
+        'state': table.state,
+        'players': [p.client.name for p in table.players],
+        'confirmed': table.players_confirmed,
+        'phase': table.trace.phase(),
+        'size': admin.deep_size(table, (Client,)),
+    } for table in tables.values()]
+
+
+# Live connections, pre-registered and registered, with what they hold
+def list_clients():
+    listing = []
+    for registered, group in ((False, pre_registers), (True, clients)):
+        for c in group.values():
+            listing.append({
+                'name': c.name,
+                'peer': str(c.socket.get_extra_info('peername')),
+                'registered': registered,
+                'encoding': c.encoding.name,
+                'session': c.session is not None,
+                'bytes_in': c.bytes_in,
+                'bytes_out': c.bytes_out,
+                'outbox': len(c.outbox),
+                'write_buffer': c.socket.transport.get_write_buffer_size(),
+                'size': admin.deep_size(c, (asyncio.StreamWriter, asyncio.Future, wire.Encoding)),
+            })
+    return listing
 
-print ("Starting table manager...")
-sock.listen(1)
-print ("Listening on port",SERVER_PORT,"\n")
 
-read_list = [sock]
+async def start_admin():
+    name = 'croupier'
+    path = ADMIN_SOCKET
+    if shard is not None:
+        name += '-' + str(shard.index)
+        root, ext = os.path.splitext(ADMIN_SOCKET)
+        path = root + '-' + str(shard.index) + ext
+
+    console = admin.Admin(name)
+    console.command('tables', list_tables)
+    console.command('clients', list_clients)
+    server = await console.serve(path)
+    print ("Admin console on", path)
+    return server
+
+
+# Lets the croupier hold as many sockets as the system allows
+def raise_fd_limit():
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+async def main(listener=None):
+    print ("Starting table manager...")
+    if listener is None:
+        raise_fd_limit()
+        # Ready before the first registrations need it
+        security.revocation_index.warm_up()
+        server = await asyncio.start_server(
+            handle_connection,
+            IP,
+            SERVER_PORT,
+            backlog=BACKLOG,
+            reuse_address=True,
+        )
+    else:
+        server = await asyncio.start_server(handle_connection, sock=listener)
+
+    security.revocation_index.watch(CRL_REFRESH_INTERVAL)
+
+    if shard is not None:
+        shard.listen(adopt_client)
+        print ("Worker", shard.index, "of", shard.count)
+
+    if METRICS_PORT is not None:
+        metrics_port = METRICS_PORT + (shard.index if shard is not None else 0)
+        metrics_server = await metrics.registry.serve(IP, metrics_port)
+        print ("Metrics on port", metrics_port)
+
+    if ADMIN_SOCKET is not None:
+        admin_server = await start_admin()
+
+    print ("Listening on port",SERVER_PORT,"\n")
+    async with server:
+        await server.serve_forever()
 
-while True:
-    
-    if buffer:
-        (s, msg) = buffer.pop(0)
-        print("Processing:\n", data,"\n")
-        msg = json.loads(msg)
-        redirect_messages(msg , s)
 
+def run_worker(worker_shard, listener):
+    global shard
+    shard = worker_shard
+    asyncio.run(main(listener))
+
+
+if __name__ == "__main__":
+    workers = 1
+    if len(argv) > 1:
+        workers = int(argv[1])
+
+    if workers > 1:
+        raise_fd_limit()
+        # Connections wait in the backlog while the CRLs are loaded (unless
+        # they are read lazily), once, to be shared by the forked workers
+        listener = shards.listen_socket(SV_ADDR, BACKLOG)
+        security.revocation_index.load()
+        shards.run(workers, listener, run_worker)
     else:
-        readable, writable, errored = select.select(read_list, [], [])
-        for s in readable:
-            
-            #TODO
-            #try: except ConnectionResetError as cre
-
-            # New TCP connection
-            if s is sock:
-                client_socket, address = sock.accept()
-                print("Connection from", address)
-                read_list.append(client_socket)
-                pre_register_client(client_socket)
-                send_pub_key(client_socket)
-            
-            # Client sent a message
-            else:
-                received = s.recv (BUFFER_SIZE)
-                if received:
-                    data = received.decode().split(EOM)
-                    for m in data[1:-1]:
-                        if m:
-                            buffer.append((s,m))
-                    data = data[0]
-                    
-                    print("Received:\n", data,"\n")
-                    msg = json.loads(data)
-                    redirect_messages(msg, s)
-                else:
-                    if s in pre_registers:
-                        print("Unregistered user has disconnected")
-                        del pre_registers[s]
-                    elif s in clients:
-                        client_left_handler(s)
-                    print("Client has disconnected")
-                    s.close()
-                    read_list.remove (s)
-                    
-                
+        asyncio.run(main())
@@ -0,0 +1,137 @@
+import json
+import socket
+import asyncio
+import multiprocessing
+
+# Biggest handoff message (client state + unread bytes)
+MAX_HANDOFF = 256 * 1024
+
+
+#########################################################################
+## Shard of a multi-process croupier
+#
+# Every worker accepts from the same listening socket. Table ids carry the
+# index of the worker that owns the table (table_id % count), so when a
+# client asks for a table that lives elsewhere its socket is handed to the
+# owner over a unix socket and the owner keeps serving it from then on.
+#
+# The same sockets carry the changes to the open tables: every worker keeps
+# its own copy of the table list and tells the others what changed in its
+# tables, so listing them never waits on another process.
+
+class Shard:
+    def __init__(self, index, count, channels):
+        self.index = index
+        self.count = count
+        # channels[index] receives handoffs, the others send to that worker
+        self.channels = channels
+        # Open tables of every worker, shown in the table list
+        self.directory = {}
+
+
+    def owner(self, table_id):
+        return table_id % self.count
+
+
+    def is_local(self, table_id):
+        return self.owner(table_id) == self.index
+
+
+    # Turns a per worker counter into a table id owned by this worker
+    def table_id(self, counter):
+        return counter * self.count + self.index
+
+
+    def publish_table(self, table_id, info):
+        self.directory[table_id] = info
+        self.send_update(table_id, info)
+
+
+    def remove_table(self, table_id):
+        if self.directory.pop(table_id, None) is not None:
+            self.send_update(table_id, None)
+
+
+    # Tells the other workers about a table of this one (info None: gone)
+    def send_update(self, table_id, info):
+        payload = json.dumps({'table_id': table_id, 'info': info}).encode()
+        for i, channel in enumerate(self.channels):
+            if i != self.index:
+                channel.send(payload)
+
+
+    def update_directory(self, update):
+        if update['info'] is None:
+            self.directory.pop(update['table_id'], None)
+        else:
+            self.directory[update['table_id']] = update['info']
+
+
+    def open_tables(self):
+        return self.directory.values()
+
+
+    # Sends a connected socket and the client state to the table owner
+    def hand_off(self, table_id, state, sock):
+        payload = json.dumps(state).encode()
+        if len(payload) > MAX_HANDOFF:
+            raise ValueError("Handoff state too big")
+        channel = self.channels[self.owner(table_id)]
+        socket.send_fds(channel, [payload], [sock.fileno()])
+
+
+    # Calls adopt(state, sock) for every connection handed to this worker,
+    # and keeps the table list up to date with the other workers' changes
+    def listen(self, adopt):
+        loop = asyncio.get_running_loop()
+        channel = self.channels[self.index]
+        channel.setblocking(False)
+
+        def on_handoff():
+            while True:
+                try:
+                    payload, fds, _, _ = socket.recv_fds(channel, MAX_HANDOFF, 1)
+                except BlockingIOError:
+                    return
+                if not fds:
+                    self.update_directory(json.loads(payload))
+                    continue
+                sock = socket.socket(fileno=fds[0])
+                loop.create_task(adopt(json.loads(payload), sock))
+
+        loop.add_reader(channel.fileno(), on_handoff)
+
+
+def listen_socket(address, backlog):
+    sock = socket.create_server(address, backlog=backlog)
+    sock.setblocking(False)
+    return sock
+
+
+# Forks count workers running worker_main(shard, listener) and waits for them
+def run(count, listener, worker_main):
+    ctx = multiprocessing.get_context('fork')
+
+    pairs = [
+        socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        for _ in range(count)
+    ]
+
+    workers = []
+    for i in range(count):
+        channels = [
+            recv_end if j == i else send_end
+            for j, (recv_end, send_end) in enumerate(pairs)
+        ]
+        shard = Shard(i, count, channels)
+        p = ctx.Process(target=worker_main, args=(shard, listener), daemon=True)
+        p.start()
+        workers.append(p)
+
+    print("Started", count, "croupier workers")
+    try:
+        for p in workers:
+            p.join()
+    except KeyboardInterrupt:
+        for p in workers:
+            p.terminate()
@@ -0,0 +1,82 @@
+import struct
+
+# Every frame is a 4 byte big endian payload length followed by the payload
+HEADER = struct.Struct('!I')
+
+# Messages travel in signed frames: 1 byte kind, 2 byte signature length,
+# signature and the encoded message. The signature covers the message bytes
+# as sent, so receivers check it before decoding anything. Unsigned messages
+# have an empty signature.
+SIG_HEADER = struct.Struct('!BH')
+
+# Kinds of signature: ECDSA with the sender's key or a session MAC
+SIGNATURE = 0
+MAC = 1
+
+# Biggest payload accepted (deck relays are the largest messages)
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+class FrameError(Exception):
+    pass
+
+
+def encode_frame(payload):
+    if type(payload) is str:
+        payload = payload.encode()
+    if len(payload) > MAX_FRAME_SIZE:
+        raise FrameError("Frame too big: {} bytes".format(len(payload)))
+    return HEADER.pack(len(payload)) + payload
+
+
+def encode_signed_frame(payload, signature=b'', kind=SIGNATURE):
+    size = SIG_HEADER.size + len(signature) + len(payload)
+    if size > MAX_FRAME_SIZE:
+        raise FrameError("Frame too big: {} bytes".format(size))
+    return (HEADER.pack(size) + SIG_HEADER.pack(kind, len(signature))
+            + signature + payload)
+
+
+# Splits a signed frame into (kind, signature, payload)
+def unpack_signed(frame):
+    if len(frame) < SIG_HEADER.size:
+        raise FrameError("Frame too short")
+    kind, size = SIG_HEADER.unpack_from(frame)
+    start = SIG_HEADER.size
+    if start + size > len(frame):
+        raise FrameError("Signature longer than the frame")
+    return kind, frame[start:start + size], frame[start + size:]
+
+
+# Incremental decoder, feed it whatever recv returned and get back the
+# frames completed so far. Partial frames wait in the buffer for the rest.
+class FrameDecoder:
+    def __init__(self, max_size=MAX_FRAME_SIZE):
+        self.max_size = max_size
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+        frames = []
+        start = 0
+        available = len(self.buffer)
+
+        while available - start >= HEADER.size:
+            (size,) = HEADER.unpack_from(self.buffer, start)
+            if size > self.max_size:
+                raise FrameError("Frame too big: {} bytes".format(size))
+
+            end = start + HEADER.size + size
+            if end > available:
+                break
+
+            frames.append(bytes(self.buffer[start + HEADER.size:end]))
+            start = end
+
+        if start:
+            del self.buffer[:start]
+        return frames
+
+    # Bytes received that are not part of a whole frame yet
+    def pending(self):
+        return bytes(self.buffer)
@@ -0,0 +1,855 @@
+import os
+import sys
+import math
+import mmap
+import time
+import struct
+import hashlib
+import threading
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from urllib.parse import urlparse
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+
+# Revoked serial numbers of every CRL in a directory, loaded once and kept
+# in memory. Serials are grouped by issuer in sorted arrays of 64 bit
+# integers, looked up with a binary search. The few serials that do not fit
+# in 64 bits go to a set.
+#
+# Delta CRLs go on top of their issuer's base CRLs: what they revoke is
+# added and their removeFromCRL entries are taken off. watch() polls the
+# directory and ingests only the files added or changed since.
+#
+# A Bloom filter over (issuer, serial) sits in front of the index: almost
+# every certificate checked is not revoked and the filter says so without
+# touching the index. fp_rate sizes the filter for the serials loaded,
+# filter_size (bytes) fixes its size instead.
+
+
+class Revocation_Index:
+    def __init__(self, crl_dir, fp_rate=0.01, filter_size=None):
+        self.crl_dir = crl_dir
+        self.fp_rate = fp_rate
+        self.filter_size = filter_size
+        self.files = {}
+        self.skipped = {}
+        self.serials = {}
+        self.large = {}
+        self.filter = None
+        self.filter_negatives = 0
+        self.filter_false_positives = 0
+        self.load_time = None
+        # Goes up every time the revoked serials change
+        self.version = 0
+        self.ready = threading.Event()
+        self.lock = threading.Lock()
+        self.update_lock = threading.Lock()
+        self.started = False
+
+    # Loads the whole directory in a thread, lookups wait until it is done
+    def warm_up(self):
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        thread = threading.Thread(target=self.load, name='revocation', daemon=True)
+        thread.start()
+
+    # Waits for the index, loading it here if nobody did yet
+    def wait(self):
+        with self.lock:
+            load_now = not self.started
+            self.started = True
+        if load_now:
+            self.load()
+        self.ready.wait()
+
+    def load(self):
+        self.started = True
+        start = time.monotonic()
+
+        with self.update_lock:
+            for name, mtime in self.list_dir().items():
+                entry = read_crl_file(os.path.join(self.crl_dir, name), mtime)
+                if entry is None:
+                    self.skipped[name] = mtime
+                else:
+                    self.files[name] = entry
+
+            issuers = set(entry.issuer for entry in self.files.values())
+            for issuer in issuers:
+                self.rebuild(issuer)
+
+            bloom = Bloom_Filter(
+                sum(len(entry.serials) + len(entry.large) for entry in self.files.values()),
+                self.fp_rate,
+                self.filter_size)
+            for entry in self.files.values():
+                bloom.add_serials(entry.issuer, entry.serials)
+                bloom.add_serials(entry.issuer, entry.large)
+            self.filter = bloom
+
+        self.load_time = time.monotonic() - start
+        self.version += 1
+        self.ready.set()
+        print(self.report())
+
+    # File name -> mtime of the files in the CRL directory
+    def list_dir(self):
+        if not os.path.isdir(self.crl_dir):
+            print("No CRL directory:", self.crl_dir)
+            return {}
+        return {
+            e.name: e.stat().st_mtime
+            for e in os.scandir(self.crl_dir)
+            if e.is_file()
+        }
+
+    # Polls the directory every interval seconds and takes in what changed
+    def watch(self, interval):
+        def poll():
+            self.wait()
+            while True:
+                time.sleep(interval)
+                self.refresh()
+        thread = threading.Thread(target=poll, name='revocation-watch', daemon=True)
+        thread.start()
+
+    # Ingests the files added or modified since the last look, drops the
+    # ones deleted. Only those files are parsed.
+    def refresh(self):
+        self.wait()
+        current = self.list_dir()
+        with self.update_lock:
+            for name, mtime in sorted(current.items()):
+                known = self.files.get(name)
+                if known is not None and known.mtime == mtime:
+                    continue
+                if self.skipped.get(name) == mtime:
+                    continue
+                self.ingest(name, mtime)
+
+            for name in [n for n in self.files if n not in current]:
+                entry = self.files.pop(name)
+                self.rebuild(entry.issuer)
+                self.version += 1
+                print("CRL {} removed".format(name))
+
+    def ingest(self, name, mtime):
+        entry = read_crl_file(os.path.join(self.crl_dir, name), mtime)
+        if entry is None:
+            self.skipped[name] = mtime
+            return
+        self.skipped.pop(name, None)
+        old = self.files.get(name)
+        self.files[name] = entry
+
+        # A new delta goes on top of what its issuer already has, anything
+        # else (a replaced file) rebuilds the issuer from its files
+        if old is None and entry.delta:
+            self.apply_delta(entry)
+        else:
+            self.rebuild(entry.issuer)
+            if old is not None and old.issuer != entry.issuer:
+                self.rebuild(old.issuer)
+
+        # Revoked serials stay in the filter, the exact index has the last word
+        self.filter.add_serials(entry.issuer, entry.serials)
+        self.filter.add_serials(entry.issuer, entry.large)
+        self.version += 1
+        print("CRL {} ingested: {} revoked, {} taken off".format(
+            name, len(entry.serials) + len(entry.large), len(entry.removed)))
+
+    # Revoked serials of an issuer: everything its CRLs list, minus what
+    # the deltas took off (removeFromCRL)
+    def rebuild(self, issuer):
+        revoked = set()
+        removed = set()
+        for entry in self.files.values():
+            if entry.issuer == issuer:
+                revoked.update(entry.serials)
+                revoked.update(entry.large)
+                removed.update(entry.removed)
+        revoked -= removed
+        self.store(issuer, revoked)
+
+    def apply_delta(self, entry):
+        issuer = entry.issuer
+        serials = self.serials.get(issuer, array('Q'))
+        large = self.large.get(issuer, set())
+        added = [n for n in entry.serials if n not in entry.removed]
+        added += [n for n in entry.large if n not in entry.removed]
+
+        if entry.removed:
+            revoked = set(serials)
+            revoked.update(large)
+            revoked.update(added)
+            revoked -= entry.removed
+            self.store(issuer, revoked)
+        elif added:
+            merged = sorted(set(serials).union(n for n in added if n <= MASK_64))
+            big = large.union(n for n in added if n > MASK_64)
+            self.serials[issuer] = array('Q', merged)
+            if big:
+                self.large[issuer] = big
+
+    # New arrays replace the old ones, lookups running meanwhile keep theirs
+    def store(self, issuer, revoked):
+        small = sorted(n for n in revoked if n <= MASK_64)
+        if small or issuer in self.serials:
+            self.serials[issuer] = array('Q', small)
+        if len(small) != len(revoked):
+            self.large[issuer] = set(n for n in revoked if n > MASK_64)
+        else:
+            self.large.pop(issuer, None)
+
+    # issuer is a x509.Name (or its DER bytes)
+    def is_revoked(self, issuer, serial):
+        self.wait()
+        if type(issuer) is not bytes:
+            issuer = issuer.public_bytes()
+
+        if not self.filter.contains(issuer, serial):
+            self.filter_negatives += 1
+            return False
+
+        if serial > MASK_64:
+            revoked = serial in self.large.get(issuer, ())
+        else:
+            serials = self.serials.get(issuer, ())
+            i = bisect_left(serials, serial)
+            revoked = i < len(serials) and serials[i] == serial
+
+        if not revoked:
+            self.filter_false_positives += 1
+        return revoked
+
+    def is_cert_revoked(self, cert):
+        return self.is_revoked(cert.issuer, cert.serial_number)
+
+    def serial_count(self):
+        return (sum(len(s) for s in self.serials.values())
+                + sum(len(s) for s in self.large.values()))
+
+    # Bytes used by the index (arrays, sets and issuer names), and by the
+    # serials kept per file to rebuild issuers when files change
+    def memory_size(self):
+        size = sys.getsizeof(self.serials) + sys.getsizeof(self.large)
+        for issuer, serials in self.serials.items():
+            size += sys.getsizeof(issuer) + sys.getsizeof(serials)
+        for numbers in self.large.values():
+            size += sys.getsizeof(numbers) + sum(sys.getsizeof(n) for n in numbers)
+        for entry in self.files.values():
+            size += sys.getsizeof(entry.serials) + sys.getsizeof(entry.removed)
+        return size
+
+    # Lookups the filter answered alone and the ones it let through wrongly
+    def filter_stats(self):
+        return {
+            'negatives': self.filter_negatives,
+            'false_positives': self.filter_false_positives,
+            'expected_fp_rate': self.filter.false_positive_rate() if self.filter else None,
+            'size': self.filter.memory_size() if self.filter else 0,
+        }
+
+    def report(self):
+        report = "Revocation index: {} serials from {} issuers ({} CRLs), {:.1f} MiB, loaded in {:.1f} s".format(
+            self.serial_count(),
+            len(self.serials),
+            len(self.files),
+            self.memory_size() / (1024 * 1024),
+            self.load_time or 0)
+        if self.filter is not None:
+            report += "\n" + self.filter.report()
+        return report
+
+
+# Revocation checks that read only the CRL partitions certificates point
+# at: the URLs in a certificate's CRL Distribution Points (and Freshest CRL,
+# for deltas) are mapped to the file of the same name in the directory,
+# which is parsed the first time it is needed. Parsed partitions are kept
+# in an LRU and the least recently used go once they take more than
+# memory_budget bytes.
+#
+# A certificate with no distribution point, or whose distribution points
+# have no CRL of its issuer in the directory, is checked against fallback,
+# a Revocation_Index of the whole directory loaded the first time one shows
+# up. Without a fallback such a certificate counts as revoked: its status
+# is unknown. Self signed certificates are not checked.
+class Partitioned_Index:
+    def __init__(self, crl_dir, memory_budget=64 * 1024 * 1024, fallback=None):
+        self.crl_dir = crl_dir
+        self.memory_budget = memory_budget
+        self.fallback = fallback
+        self.partitions = OrderedDict()
+        self.memory = 0
+        self.loads = 0
+        self.evictions = 0
+        self.hits = 0
+        self.misses = 0
+        # Goes up every time a partition already read changes on disk
+        self.changes = 0
+        # Distribution points warned about not being in the directory
+        self.missing = set()
+        self.lock = threading.Lock()
+
+    @property
+    def version(self):
+        if self.fallback is not None and self.fallback.started:
+            return (self.changes, self.fallback.version)
+        return self.changes
+
+    # Nothing is read up front
+    def warm_up(self):
+        pass
+
+    def wait(self):
+        pass
+
+    def load(self):
+        pass
+
+    # Drops the partitions that changed on disk (read again when needed)
+    def watch(self, interval):
+        def poll():
+            while True:
+                time.sleep(interval)
+                self.refresh()
+        thread = threading.Thread(target=poll, name='revocation-watch', daemon=True)
+        thread.start()
+
+    def refresh(self):
+        with self.lock:
+            loaded = list(self.partitions.items())
+        for name, entry in loaded:
+            path = os.path.join(self.crl_dir, name)
+            mtime = os.path.getmtime(path) if os.path.isfile(path) else None
+            if entry is not None and entry.mtime == mtime:
+                continue
+            if entry is None and mtime is None:
+                continue
+            with self.lock:
+                if self.partitions.get(name, False) is entry:
+                    self.forget(name)
+                    self.changes += 1
+            print("CRL {} changed, read again when needed".format(name))
+        if self.fallback is not None and self.fallback.started:
+            self.fallback.refresh()
+
+    def is_cert_revoked(self, cert):
+        base = distribution_points(cert, x509.CRLDistributionPoints)
+        if not base:
+            if cert.issuer == cert.subject or self.fallback is None:
+                return False
+            return self.fallback.is_cert_revoked(cert)
+
+        issuer = cert.issuer.public_bytes()
+        serial = cert.serial_number
+        entries = [self.partition(name) for name in base]
+        deltas = set(distribution_points(cert, x509.FreshestCRL))
+        for entry in entries:
+            if entry is not None:
+                deltas.update(entry.freshest)
+        if not any(entry is not None and entry.issuer == issuer for entry in entries):
+            return self.unknown(cert, base)
+        entries += [self.partition(name) for name in sorted(deltas - set(base))]
+
+        revoked = False
+        for entry in entries:
+            # Only CRLs of the certificate's issuer count (no indirect CRLs)
+            if entry is None or entry.issuer != issuer:
+                continue
+            if serial in entry.removed:
+                return False
+            if entry.contains(serial):
+                revoked = True
+        return revoked
+
+    # No CRL of the certificate's issuer where its distribution points say
+    def unknown(self, cert, names):
+        missing = tuple(names)
+        if missing not in self.missing:
+            self.missing.add(missing)
+            print("No CRL of {} in {} ({}), {}".format(
+                cert.issuer.rfc4514_string(), self.crl_dir, ', '.join(names),
+                "checking all the CRLs" if self.fallback is not None else "taken as revoked"))
+        if self.fallback is None:
+            return True
+        return self.fallback.is_cert_revoked(cert)
+
+    # Parsed CRL file, None if it is not in the directory
+    def partition(self, name):
+        with self.lock:
+            if name in self.partitions:
+                self.partitions.move_to_end(name)
+                self.hits += 1
+                return self.partitions[name]
+            self.misses += 1
+
+        path = os.path.join(self.crl_dir, name)
+        entry = None
+        if os.path.isfile(path):
+            entry = read_crl_file(path, os.path.getmtime(path))
+
+        with self.lock:
+            if name not in self.partitions:
+                self.partitions[name] = entry
+                self.loads += 1
+                if entry is not None:
+                    self.memory += entry.memory_size()
+                while self.memory > self.memory_budget and len(self.partitions) > 1:
+                    self.forget(next(iter(self.partitions)))
+                    self.evictions += 1
+        return entry
+
+    def forget(self, name):
+        entry = self.partitions.pop(name)
+        if entry is not None:
+            self.memory -= entry.memory_size()
+
+    def stats(self):
+        return {
+            'partitions': len(self.partitions),
+            'memory': self.memory,
+            'loads': self.loads,
+            'evictions': self.evictions,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    def report(self):
+        return "Revocation partitions: {} loaded, {:.1f} MiB of {:.1f} MiB, {} evicted".format(
+            len(self.partitions),
+            self.memory / (1024 * 1024),
+            self.memory_budget / (1024 * 1024),
+            self.evictions)
+
+
+# Names of the local files for the URLs in a certificate's extension
+# (CRLDistributionPoints or FreshestCRL)
+def distribution_points(cert, extension):
+    try:
+        points = cert.extensions.get_extension_for_class(extension).value
+    except x509.ExtensionNotFound:
+        return []
+    names = []
+    for point in points:
+        for name in point.full_name or ():
+            if isinstance(name, x509.UniformResourceIdentifier):
+                file_name = os.path.basename(urlparse(name.value).path)
+                if file_name and file_name not in names:
+                    names.append(file_name)
+    return names
+
+
+# Revoked serials compiled ahead of time into one file (see compile_index),
+# mapped read only and searched in place: nothing is parsed at startup and
+# every process mapping the file shares the same pages. The file has a
+# header, a directory of issuers and, per issuer, its sorted serials as
+# fixed width records: 8 bytes for the ones that fit in 64 bits, 20 bytes
+# (big endian) for the rest.
+#
+# header: magic, format version, byte order of the 8 byte records, number
+# of issuers, generation (newest CRL mtime in ns)
+#
+# A file older than the CRL directory (crl_dir has a file newer than its
+# generation) would hide the revocations added since: fallback (the live
+# index) answers instead, until the file is compiled again.
+# issuer: length of its DER name, offset and count of the 8 byte records,
+# offset and count of the 20 byte records, followed by the DER name
+DB_MAGIC = b'CRLINDEX'
+DB_FORMAT = 1
+DB_HEADER = struct.Struct('<8sHBxIQ')
+DB_ISSUER = struct.Struct('<IQQQQ')
+LARGE_SIZE = 20
+
+
+class Compiled_Index:
+    def __init__(self, path, crl_dir=None, fallback=None):
+        self.path = path
+        self.crl_dir = crl_dir
+        self.fallback = fallback
+        self.issuers = {}
+        self.map = None
+        self.stat = None
+        self.generation = None
+        self.load_time = None
+        # Goes up every time a new file is mapped
+        self.maps = 0
+        # Set while the file is older than the CRL directory
+        self.stale = False
+        self.started = False
+        self.lock = threading.Lock()
+
+    @property
+    def version(self):
+        if self.stale and self.fallback is not None:
+            return (self.maps, self.fallback.version)
+        return self.maps
+
+    def warm_up(self):
+        self.wait()
+
+    def wait(self):
+        if not self.started:
+            self.load()
+
+    def load(self):
+        start = time.monotonic()
+        with self.lock:
+            with open(self.path, 'rb') as f:
+                st = os.fstat(f.fileno())
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            magic, version, big_endian, count, generation = DB_HEADER.unpack_from(data)
+            if magic != DB_MAGIC or version != DB_FORMAT:
+                raise ValueError("Not a revocation database: " + self.path)
+            if big_endian != (sys.byteorder == 'big'):
+                raise ValueError("Revocation database built with another byte order, compile it again")
+
+            view = memoryview(data)
+            issuers = {}
+            offset = DB_HEADER.size
+            for _ in range(count):
+                size, small_at, small_count, large_at, large_count = DB_ISSUER.unpack_from(data, offset)
+                offset += DB_ISSUER.size
+                issuer = bytes(data[offset:offset + size])
+                offset += size
+                issuers[issuer] = (
+                    view[small_at:small_at + 8 * small_count].cast('Q'),
+                    view[large_at:large_at + LARGE_SIZE * large_count])
+
+            # Lookups still running keep the old mapping alive
+            self.issuers = issuers
+            self.map = data
+            self.stat = (st.st_ino, st.st_mtime_ns, st.st_size)
+            self.generation = generation
+            self.maps += 1
+            self.started = True
+
+        self.load_time = time.monotonic() - start
+        print(self.report())
+        self.check_generation()
+
+    # Compares the file with the newest CRL in the directory
+    def check_generation(self):
+        if self.crl_dir is None or not os.path.isdir(self.crl_dir):
+            return
+        newest = int(max(
+            (e.stat().st_mtime for e in os.scandir(self.crl_dir) if e.is_file()),
+            default=0) * 10**9)
+        stale = newest > self.generation
+        if stale and not self.stale:
+            print("Revocation database {} is {:.0f} s older than {}, {}".format(
+                self.path, (newest - self.generation) / 10**9, self.crl_dir,
+                "checking the CRLs until it is compiled again" if self.fallback is not None
+                else "compile it again"))
+        elif self.stale and not stale:
+            print("Revocation database {} is up to date again".format(self.path))
+        self.stale = stale
+
+    # Maps the file again when the builder replaced it
+    def watch(self, interval):
+        def poll():
+            self.wait()
+            while True:
+                time.sleep(interval)
+                self.refresh()
+        thread = threading.Thread(target=poll, name='revocation-watch', daemon=True)
+        thread.start()
+
+    def refresh(self):
+        self.wait()
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            st = None
+        if st is not None and (st.st_ino, st.st_mtime_ns, st.st_size) != self.stat:
+            self.load()
+        else:
+            self.check_generation()
+        if self.stale and self.fallback is not None and self.fallback.started:
+            self.fallback.refresh()
+
+    # issuer is a x509.Name (or its DER bytes)
+    def is_revoked(self, issuer, serial):
+        self.wait()
+        if type(issuer) is not bytes:
+            issuer = issuer.public_bytes()
+        records = self.issuers.get(issuer)
+        if records is None:
+            return False
+
+        serials, large = records
+        if serial <= MASK_64:
+            i = bisect_left(serials, serial)
+            return i < len(serials) and serials[i] == serial
+        if serial.bit_length() > 8 * LARGE_SIZE:
+            return False
+        return _find_record(large, serial.to_bytes(LARGE_SIZE, 'big'))
+
+    def is_cert_revoked(self, cert):
+        self.wait()
+        if self.stale and self.fallback is not None:
+            return self.fallback.is_cert_revoked(cert)
+        return self.is_revoked(cert.issuer, cert.serial_number)
+
+    def serial_count(self):
+        return sum(
+            len(serials) + len(large) // LARGE_SIZE
+            for serials, large in self.issuers.values())
+
+    def report(self):
+        return "Revocation database {}: {} serials from {} issuers, {:.1f} MiB mapped in {:.3f} s".format(
+            self.path,
+            self.serial_count(),
+            len(self.issuers),
+            len(self.map) / (1024 * 1024) if self.map is not None else 0,
+            self.load_time or 0)
+
+
+# Binary search of a key among sorted fixed width records
+def _find_record(records, key):
+    low = 0
+    high = len(records) // LARGE_SIZE
+    while low < high:
+        middle = (low + high) // 2
+        record = records[middle * LARGE_SIZE:(middle + 1) * LARGE_SIZE].tobytes()
+        if record < key:
+            low = middle + 1
+        elif record > key:
+            high = middle
+        else:
+            return True
+    return False
+
+
+# Compiles the CRLs of a directory (deltas applied) into the file read by
+# Compiled_Index. It is written next to it and renamed into place, so
+# croupiers mapping the old one are not disturbed.
+def compile_index(crl_dir, path):
+    index = Revocation_Index(crl_dir)
+    index.load()
+
+    issuers = sorted(set(index.serials) | set(index.large))
+    records = []
+    for issuer in issuers:
+        small = index.serials.get(issuer, array('Q'))
+        large = sorted(index.large.get(issuer, ()))
+        if large and large[-1].bit_length() > 8 * LARGE_SIZE:
+            raise ValueError("Serial number longer than {} bytes".format(LARGE_SIZE))
+        records.append((issuer, small.tobytes(), b''.join(n.to_bytes(LARGE_SIZE, 'big') for n in large)))
+
+    # Records start 8 byte aligned, after the directory
+    offset = DB_HEADER.size + sum(DB_ISSUER.size + len(issuer) for issuer in issuers)
+    offset += -offset % 8
+    directory = []
+    for issuer, small, large in records:
+        directory.append(DB_ISSUER.pack(len(issuer), offset, len(small) // 8, offset + len(small), len(large) // LARGE_SIZE))
+        directory.append(issuer)
+        offset += len(small) + len(large)
+        offset += -offset % 8
+
+    # Files that are not CRLs count too: Compiled_Index looks at them all
+    mtimes = [e.mtime for e in index.files.values()] + list(index.skipped.values())
+    generation = int(max(mtimes, default=0) * 10**9)
+    header = DB_HEADER.pack(DB_MAGIC, DB_FORMAT, sys.byteorder == 'big', len(issuers), generation)
+    temp = path + '.tmp'
+    with open(temp, 'wb') as f:
+        f.write(header)
+        f.write(b''.join(directory))
+        for issuer, small, large in records:
+            f.write(bytes(-f.tell() % 8))
+            f.write(small)
+            f.write(large)
+    os.replace(temp, path)
+    print("Compiled {} serials from {} issuers into {} ({:.1f} MiB)".format(
+        index.serial_count(), len(issuers), path, os.path.getsize(path) / (1024 * 1024)))
+
+
+# Bloom filter of (issuer, serial) pairs, register blocked: each pair sets
+# hash_count bits inside a single 64 bit word, so adding and checking are
+# one word operation. The bit patterns come from a fixed table of masks.
+MASK_BITS = 14
+MASK_64 = (1 << 64) - 1
+
+
+class Bloom_Filter:
+    def __init__(self, capacity, fp_rate=0.01, size=None):
+        capacity = max(capacity, 1)
+        if size is not None:
+            word_count = max(1, size // 8)
+        else:
+            bits = -capacity * math.log(fp_rate) / math.log(2) ** 2
+            word_count = max(1, int(bits / 64))
+            while _best_hash_count(capacity, word_count)[1] > fp_rate:
+                word_count = int(word_count * 1.1) + 1
+
+        self.hash_count = _best_hash_count(capacity, word_count)[0]
+        self.words = array('Q', bytes(8 * word_count))
+        self.masks = _masks(self.hash_count)
+        self.count = 0
+
+    def add_serials(self, issuer, serials):
+        seed = _issuer_seed(issuer)
+        words = self.words
+        masks = self.masks
+        word_count = len(words)
+        low = (1 << MASK_BITS) - 1
+        for serial in serials:
+            h = _mix(serial, seed)
+            words[(h >> MASK_BITS) % word_count] |= masks[h & low]
+            self.count += 1
+
+    def contains(self, issuer, serial):
+        h = _mix(serial, _issuer_seed(issuer))
+        mask = self.masks[h & ((1 << MASK_BITS) - 1)]
+        return self.words[(h >> MASK_BITS) % len(self.words)] & mask == mask
+
+    # Expected false positive rate with the serials added so far
+    def false_positive_rate(self):
+        return _false_positive_rate(self.count, len(self.words), self.hash_count)
+
+    def memory_size(self):
+        return sys.getsizeof(self.words)
+
+    def report(self):
+        return "Bloom filter: {} serials, {:.1f} MiB, {:.1f} bits per serial, {} hashes, false positive rate {:.4%}".format(
+            self.count,
+            self.memory_size() / (1024 * 1024),
+            64 * len(self.words) / max(self.count, 1),
+            self.hash_count,
+            self.false_positive_rate())
+
+
+def _issuer_seed(issuer):
+    return int.from_bytes(hashlib.blake2b(issuer, digest_size=8).digest(), 'big')
+
+
+# splitmix64 finalizer of the serial mixed with the issuer's seed
+def _mix(serial, seed):
+    x = (serial ^ seed) & MASK_64
+    if serial > MASK_64:
+        x ^= hash(serial >> 64) & MASK_64
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & MASK_64
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & MASK_64
+    return x ^ (x >> 31)
+
+
+# Table of 64 bit masks with hash_count bits set each
+def _masks(hash_count):
+    masks = array('Q')
+    for i in range(1 << MASK_BITS):
+        mask = 0
+        x = i
+        while bin(mask).count('1') < hash_count:
+            x = _mix(x, 0x9e3779b97f4a7c15)
+            mask |= 1 << (x & 63)
+        masks.append(mask)
+    return masks
+
+
+# Each word gets a Poisson number of pairs, the rate is averaged over that
+def _false_positive_rate(count, word_count, hash_count):
+    mean = count / word_count
+    rate = 0
+    p = math.exp(-mean)
+    for j in range(int(mean + 10 * math.sqrt(mean) + 10)):
+        bit_set = 1 - (1 - hash_count / 64) ** j
+        rate += p * bit_set ** hash_count
+        p *= mean / (j + 1)
+    return rate
+
+
+def _best_hash_count(count, word_count):
+    return min(
+        ((k, _false_positive_rate(count, word_count, k)) for k in range(1, 17)),
+        key=lambda option: option[1])
+
+
+# What one CRL file contributed: revoked serials (array of the ones that
+# fit in 64 bits, tuple of the rest) and, for deltas, the serials taken off.
+# freshest has the files of the deltas that go on top of it.
+class CRL_Entry:
+    def __init__(self, mtime, issuer, delta, serials, large, removed, freshest=()):
+        self.mtime = mtime
+        self.issuer = issuer
+        self.delta = delta
+        self.serials = serials
+        self.large = large
+        self.removed = removed
+        self.freshest = freshest
+
+    # serials is sorted when read from the file
+    def contains(self, serial):
+        if serial > MASK_64:
+            return serial in self.large
+        i = bisect_left(self.serials, serial)
+        return i < len(self.serials) and self.serials[i] == serial
+
+    def memory_size(self):
+        return (sys.getsizeof(self.serials) + sys.getsizeof(self.large)
+                + sys.getsizeof(self.removed) + sys.getsizeof(self.issuer))
+
+
+def read_crl_file(path, mtime):
+    crl = load_crl(path)
+    if crl is None:
+        return None
+
+    try:
+        crl.extensions.get_extension_for_class(x509.DeltaCRLIndicator)
+        delta = True
+    except x509.ExtensionNotFound:
+        delta = False
+
+    revoked = []
+    removed = set()
+    if delta:
+        # Only deltas carry removeFromCRL entries, base CRLs skip the check
+        for r in crl:
+            try:
+                reason = r.extensions.get_extension_for_class(x509.CRLReason).value.reason
+            except x509.ExtensionNotFound:
+                reason = None
+            if reason == x509.ReasonFlags.remove_from_crl:
+                removed.add(r.serial_number)
+            else:
+                revoked.append(r.serial_number)
+    else:
+        revoked = [r.serial_number for r in crl]
+
+    return CRL_Entry(
+        mtime,
+        crl.issuer.public_bytes(),
+        delta,
+        array('Q', sorted(n for n in revoked if n <= MASK_64)),
+        tuple(n for n in revoked if n > MASK_64),
+        removed,
+        tuple(distribution_points(crl, x509.FreshestCRL)))
+
+
+# Parses a CRL file (DER or PEM), None if it is not one
+def load_crl(path):
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as f:
+        data = f.read()
+    try:
+        return x509.load_der_x509_crl(data, default_backend())
+    except ValueError:
+        pass
+    try:
+        return x509.load_pem_x509_crl(data, default_backend())
+    except ValueError:
+        print("Not a CRL:", path)
+        return None
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python3 revocation.py <CRL directory> <database file>")
+        sys.exit(1)
+    compile_index(sys.argv[1], sys.argv[2])
@@ -1,28 +1,91 @@
 import os
-import random
-import string
-import hashlib
-import binascii
-import unicodedata
+import hmac
+import threading
 from base64 import b64decode, b64encode
-from cryptography.exceptions import *
-from math import *
-from datetime import datetime
-from OpenSSL import crypto
-
-from Crypto.Cipher import AES
-from cryptography import x509
-from cryptography.x509.oid import NameOID
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.asymmetric import rsa, padding, ec
 from cryptography.hazmat.primitives import padding as prim_padding
-from cryptography.hazmat.primitives.serialization import Encoding
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 
+# Only what every client and the croupier need is imported here. x509
+# parsing, the certificate validation state (revocation, trust) and the
+# thread pool (asyncio) are imported the first time they are used.
+
 chosen_hash = hashes.SHA1()
 
+# Revoked certificates known by the croupier. With REVOCATION_LAZY only the
+# CRL partitions named in the certificates' distribution points are read,
+# when first needed, and kept while they fit in REVOCATION_MEMORY bytes.
+# Otherwise (and for certificates without distribution points) the whole
+# directory is loaded, with a Bloom filter in front sized for
+# REVOCATION_FP_RATE false positives, unless REVOCATION_FILTER_SIZE (bytes)
+# is given.
+#
+# When REVOCATION_DB was compiled from the directory (python3 revocation.py
+# CRL CRL.db) it is mapped instead, and shared by all the workers. While the
+# directory has CRLs newer than it, they are checked as above.
+REVOCATION_DB = "CRL.db"
+REVOCATION_LAZY = True
+REVOCATION_MEMORY = 64 * 1024 * 1024
+REVOCATION_FP_RATE = 0.01
+REVOCATION_FILTER_SIZE = None
+
+# Certificates trusted by the croupier
+TRUSTED_CERT_DIRS = [
+    "server_trusted_certs",
+    "server_trusted_certs/client_certs",
+]
+
+# Chains already validated, until the CRLs or the trusted certificates change
+CHAIN_CACHE_SIZE = 4096
+CHAIN_CACHE_TTL = 600
+
+# revocation_index, trust_store, path_builder and validation_cache are made
+# by load_validation, the first time one of them is used
+VALIDATION_STATE = ('revocation_index', 'trust_store', 'path_builder', 'validation_cache')
+validation_lock = threading.Lock()
+
+
+def load_validation():
+    if 'validation_cache' in globals():
+        return
+    with validation_lock:
+        if 'validation_cache' not in globals():
+            _make_validation()
+
+
+def _make_validation():
+    global revocation_index, trust_store, path_builder, validation_cache
+    import revocation
+    import trust
+
+    index = revocation.Revocation_Index(
+        "CRL",
+        fp_rate=REVOCATION_FP_RATE,
+        filter_size=REVOCATION_FILTER_SIZE)
+    if REVOCATION_LAZY:
+        index = revocation.Partitioned_Index(
+            "CRL",
+            REVOCATION_MEMORY,
+            fallback=index)
+    if os.path.isfile(REVOCATION_DB):
+        index = revocation.Compiled_Index(REVOCATION_DB, "CRL", fallback=index)
+
+    revocation_index = index
+    trust_store = trust.TrustStore(TRUSTED_CERT_DIRS)
+    path_builder = trust.Path_Builder(trust_store)
+    validation_cache = trust.Validation_Cache(CHAIN_CACHE_SIZE, CHAIN_CACHE_TTL)
+
+
+def __getattr__(name):
+    if name in VALIDATION_STATE:
+        load_validation()
+        return globals()[name]
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
 # Generate a RSA private key
 def RSA_generate_priv():
     return rsa.generate_private_key(
@@ -156,62 +219,37 @@ def rand_ciphered(p_siz=32, i_siz=16, s_siz=12):
 
 
 def validate_cert(cert, chain):
-    # Transform bytes into certificate
-    cert = x509.load_der_x509_certificate(cert, default_backend())
-    cert_name = cert.subject.get_attributes_for_oid(NameOID.COMMON_NAME)[0].value+".cer"
-
-    # Get list of trusted certificates by the server        
-    trusted_certs = [
-        f 
-        for f in os.listdir("server_trusted_certs") 
-        if os.path.isfile(os.path.join("server_trusted_certs", f))
-    ]
-    
-    # Get list of trusted certificates by server from the clients 
-    trusted_client_certs = [
-        f 
-        for f in os.listdir("server_trusted_certs/client_certs") 
-        if os.path.isfile(os.path.join("server_trusted_certs/client_certs", f))
-    ]
-
-    if cert_name in trusted_certs:
-        with open(os.path.join("server_trusted_certs", cert_name),"rb") as f:
-
-            if cert == x509.load_der_x509_certificate(f.read(), default_backend()):
-                crl_name = "CRL/cc_ec_cidadao_crl00"+cert_name[-5]+"_crl.crl"
-                with open(crl_name, "rb") as ff:
-                    crl = x509.load_der_x509_crl(ff.read(), default_backend())
-
-                if crl.get_revoked_certificate_by_serial_number(cert.serial_number) == None:
-                    print(" > CERTIFICATE \'{}\' IS TRUSTED".format(cert_name))
-                    return True
-                else:
-                    print("Certificate {} has expired".format(cert_name))
-                    return False
-                
-    elif cert_name in trusted_client_certs:
-        with open(os.path.join("server_trusted_certs/client_certs", cert_name),"rb") as f: 
-            if cert == x509.load_der_x509_certificate(f .read(), default_backend()):
-                print(" > CERTIFICATE \'{}\' IS TRUSTED".format(cert_name))
-                return True
-
-    else:
-        pass #print(" > CERTIFICATE \'{}\' NOT PART OF TRUSTED CERTIFICATES".format(cert_name))
-            
-    # Verify the chain
-    if len(chain) != 0:
-        try:
-            return validate_cert(chain[0],chain[1:])
-        except ValueError:
-            raise ValueError
-        except Exception as e:
-            raise e
-    else:
+    load_validation()
+    key = validation_cache.key(cert, chain)
+    trust_store.check()
+    revocation_index.wait()
+    version = (trust_store.version, revocation_index.version)
+    valid = validation_cache.get(key, version)
+    if valid is None:
+        valid = _validate_cert(cert, chain)
+        validation_cache.put(key, version, valid)
+    return valid
+
+
+def _validate_cert(cert, chain):
+    # Path from the certificate to one trusted by the server
+    path = path_builder.build(cert, chain)
+    if path is None:
         raise ValueError
 
-    # Add new certificate to server_trusted_certs folder
-    with open("server_trusted_certs/client_certs/"+cert_name, "wb") as f:
-        f.write(cert.public_bytes(Encoding.DER))
+    # Every certificate in the path is checked against its issuer's CRLs
+    for path_cert in path:
+        if revocation_index.is_cert_revoked(path_cert):
+            print("Certificate {} has been revoked".format(common_name(path_cert)))
+            return False
+
+    print(" > CERTIFICATE \'{}\' IS TRUSTED".format(common_name(path[-1])))
+    return True
+
+
+def common_name(cert):
+    from cryptography.x509.oid import NameOID
+    return cert.subject.get_attributes_for_oid(NameOID.COMMON_NAME)[0].value
 
 
 # Signs a message with private key
@@ -244,6 +282,8 @@ def validate_rsa_sign(msg_fields, signature, pub_key):
 
 # Validates a signature made with a citizen card
 def validate_cc_sign(msg, sig, certificate):
+    from cryptography import x509
+
     # Get key from certificate
     cert_der = x509.load_der_x509_certificate(certificate, default_backend())
     cc_key = cert_der.public_key()
@@ -252,7 +292,9 @@ def validate_cc_sign(msg, sig, certificate):
     hasher = hashes.Hash(chosen_hash, default_backend())
     # for field in msg_fields:
     #     hasher.update(field.encode())    
-    hasher.update(msg.encode())
+    if type(msg) is str:
+        msg = msg.encode()
+    hasher.update(msg)
     digest = hasher.finalize()
 
     # Verify
@@ -295,8 +337,10 @@ class Diffie_Hellman:
 
 
     def sign(self, msg):
+        if type(msg) is str:
+            msg = msg.encode()
         hashing = hashes.Hash(chosen_hash, default_backend())
-        hashing.update(msg.encode())
+        hashing.update(msg)
         digest = hashing.finalize()
 
         signature = self.private_key.sign(
@@ -355,6 +399,37 @@ class Diffie_Hellman:
         return decrypted.decode('utf-8')
 
 
+# Session mode offered by the croupier: after registration routine messages
+# are authenticated with HMACs instead of ECDSA signatures. Signatures are
+# kept for what has to be provable to others (plays).
+SESSION_MAC = 'mac'
+
+# MAC keys of a session, one per direction, derived from the ECDH exchange
+# between our Diffie_Hellman keys and the other side's public key
+class Session_MAC:
+    def __init__(self, dh, peer_public_key, croupier=False):
+        shared_key = dh.private_key.exchange(ec.ECDH(), peer_public_key)
+        keys = HKDF(
+            algorithm=hashes.SHA256(),
+            length=64,
+            salt=None,
+            info=b'session mac keys',
+            backend=default_backend()
+       ).derive(shared_key)
+
+        to_croupier, to_client = keys[:32], keys[32:]
+        if croupier:
+            self.send_key, self.recv_key = to_client, to_croupier
+        else:
+            self.send_key, self.recv_key = to_croupier, to_client
+
+    def sign(self, msg):
+        return hmac.digest(self.send_key, msg, 'sha256')
+
+    def valid_signature(self, msg, mac):
+        return hmac.compare_digest(hmac.digest(self.recv_key, msg, 'sha256'), mac)
+
+
 class DH_Params:
     def __init__(self, dh_json=None):
         if dh_json is not None:
@@ -389,8 +464,10 @@ class DH_Params:
         return b64encode(self.iv).decode('utf-8')
 
     def valid_signature(self, msg, signature):
+        if type(msg) is str:
+            msg = msg.encode()
         hashing = hashes.Hash(chosen_hash, default_backend())
-        hashing.update(msg.encode())
+        hashing.update(msg)
         digest = hashing.finalize()
 
         try:
@@ -402,3 +479,98 @@ class DH_Params:
             return False
 
         return True
+
+
+# Thread pool for the signature work of the croupier. OpenSSL releases the
+# GIL while signing and verifying, so they run in parallel with the event
+# loop and with each other. Jobs queued in the same loop iteration are
+# split in one chunk per thread, and each chunk reports back to the loop
+# once. Futures are resolved on the loop, so awaiting them in the order they
+# were queued keeps every connection's messages in order.
+#
+# With batch=False every job goes to the threads on its own and reports
+# back as soon as it is done, for slow jobs of uneven length (certificate
+# chains) that should not wait for the rest of their chunk.
+class Crypto_Pool:
+    def __init__(self, size=None, batch=True):
+        from concurrent.futures import ThreadPoolExecutor
+        if size is None:
+            size = os.cpu_count() or 1
+        self.size = size
+        self.executor = ThreadPoolExecutor(
+            max_workers=size,
+            thread_name_prefix='crypto'
+        )
+        self.batching = batch
+        self.batch = []
+
+        # Metrics
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.jobs = 0
+        self.batches = 0
+
+    # Queues func(*args), returns an asyncio future with its result
+    def submit(self, func, *args):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        self.queue_depth += 1
+        if self.queue_depth > self.max_queue_depth:
+            self.max_queue_depth = self.queue_depth
+
+        if not self.batching:
+            future = loop.run_in_executor(self.executor, func, *args)
+            future.add_done_callback(self.job_done)
+            return future
+
+        future = loop.create_future()
+        if not self.batch:
+            loop.call_soon(self.run_batch, loop)
+        self.batch.append((func, args, future))
+        return future
+
+    def job_done(self, future):
+        self.queue_depth -= 1
+        self.jobs += 1
+
+    def run_batch(self, loop):
+        batch = self.batch
+        self.batch = []
+        self.batches += 1
+
+        step = -(-len(batch) // self.size)
+        for start in range(0, len(batch), step):
+            chunk = batch[start:start + step]
+            job = self.executor.submit(_run_jobs, chunk)
+            job.add_done_callback(
+                lambda job, chunk=chunk: loop.call_soon_threadsafe(self.deliver, chunk, job))
+
+    def deliver(self, chunk, job):
+        for (func, args, future), (ok, value) in zip(chunk, job.result()):
+            self.queue_depth -= 1
+            self.jobs += 1
+            if future.cancelled():
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'queue_depth': self.queue_depth,
+            'max_queue_depth': self.max_queue_depth,
+            'jobs': self.jobs,
+            'batches': self.batches,
+        }
+
+
+def _run_jobs(chunk):
+    results = []
+    for func, args, future in chunk:
+        try:
+            results.append((True, func(*args)))
+        except Exception as e:
+            results.append((False, e))
+    return results
@@ -0,0 +1,48 @@
+import os
+import sys
+import importlib
+import unittest
+from unittest import mock
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import security
+
+
+# cc imported again as if PyKCS11 was not installed
+def import_cc_without_pykcs11():
+    with mock.patch.dict(sys.modules, {'PyKCS11': None}):
+        sys.modules.pop('cc', None)
+        return importlib.import_module('cc')
+
+
+class Test_Software_Token(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.cc = import_cc_without_pykcs11()
+        cls.ca = cls.cc.Software_CA(key_size=1024)
+
+    def test_sign_and_verify(self):
+        card = self.cc.CitizenCard(self.ca.token())
+        signature = card.sign(b'payload')
+        self.assertTrue(security.validate_cc_sign(b'payload', signature, card.certificate))
+        self.assertFalse(security.validate_cc_sign(b'other payload', signature, card.certificate))
+
+    def test_signed_by_its_own_key(self):
+        card = self.cc.CitizenCard(self.ca.token())
+        other = self.cc.CitizenCard(self.ca.token())
+        self.assertFalse(security.validate_cc_sign(b'payload', card.sign(b'payload'), other.certificate))
+
+    def test_chain(self):
+        card = self.cc.CitizenCard(self.ca.token(given_name="ANA"))
+        self.assertEqual(card.name, "ANA SOFTWARE")
+        path = self.cc.path_builder.build(
+            card.certificate, card.chain, is_anchor=lambda cert: cert == self.ca.root)
+        self.assertEqual(len(path), 4)
+
+    def test_card_needs_pykcs11(self):
+        with mock.patch.dict(sys.modules, {'PyKCS11': None}):
+            with self.assertRaises(ImportError):
+                self.cc.PKCS11_Backend()
+
+
+if __name__ == "__main__":
+    unittest.main()
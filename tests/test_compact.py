@@ -0,0 +1,102 @@
+import os
+import sys
+import json
+import unittest
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import compact
+import wire
+
+# Every size class of every type
+VALUES = [
+    None, True, False,
+    0, 1, 127, 128, 255, 256, 65535, 65536, 2 ** 32 - 1, 2 ** 32, 2 ** 64 - 1,
+    -1, -32, -33, -128, -129, -32768, -32769, -2 ** 31, -2 ** 31 - 1, -2 ** 63,
+    0.0, 1.5, -2.25,
+    '', 'a', 'x' * 31, 'x' * 32, 'x' * 255, 'x' * 256, 'x' * 65536, 'ção ♥',
+    b'', b'\x00\xff', bytes(255), bytes(256), bytes(65536),
+    [], list(range(15)), list(range(16)), list(range(65536)),
+    {}, {str(i): i for i in range(15)}, {str(i): i for i in range(16)},
+    {'intent': 'play_card', 'card': [3, 'H'], 'signature': b'\x01' * 71, 1: None},
+]
+
+
+# The encoding written here, even when the msgpack extension replaces it
+def pure_dumps(obj):
+    out = bytearray()
+    compact._pack(obj, out)
+    return bytes(out)
+
+
+def pure_loads(data):
+    obj, pos = compact._unpack(data, 0)
+    if pos != len(data):
+        raise ValueError("Trailing bytes after compact value")
+    return obj
+
+
+class Test_Compact(unittest.TestCase):
+    def test_round_trip(self):
+        for dumps, loads in ((pure_dumps, pure_loads), (compact.dumps, compact.loads)):
+            for value in VALUES:
+                self.assertEqual(loads(dumps(value)), value)
+
+    def test_tuples_are_lists(self):
+        self.assertEqual(pure_loads(pure_dumps((1, (2, 3)))), [1, [2, 3]])
+
+    def test_messagepack_layout(self):
+        self.assertEqual(pure_dumps({'a': 1}), b'\x81\xa1a\x01')
+        self.assertEqual(pure_dumps([None, True, False]), b'\x93\xc0\xc3\xc2')
+        self.assertEqual(pure_dumps(-1), b'\xff')
+        self.assertEqual(pure_dumps(200), b'\xcc\xc8')
+        self.assertEqual(pure_dumps(b'ab'), b'\xc4\x02ab')
+
+    def test_same_bytes_as_msgpack(self):
+        if compact.msgpack is None:
+            self.skipTest("msgpack is not installed")
+        for value in VALUES:
+            self.assertEqual(pure_dumps(value), compact.dumps(value))
+
+    def test_cannot_encode(self):
+        for value in (object(), {1, 2}, 2 ** 64, -2 ** 63 - 1):
+            with self.assertRaises((TypeError, ValueError)):
+                pure_dumps(value)
+
+    def test_truncated(self):
+        for dumps, loads in ((pure_dumps, pure_loads), (compact.dumps, compact.loads)):
+            for value in ('hello', 'x' * 300, b'bytes', 70000, 1.5, [1, 2, 3], {'a': 'b'}):
+                data = dumps(value)
+                for end in range(len(data)):
+                    with self.assertRaises(ValueError):
+                        loads(data[:end])
+
+    def test_trailing_bytes(self):
+        for loads in (pure_loads, compact.loads):
+            with self.assertRaises(ValueError):
+                loads(b'\x01\x02')
+
+    def test_unknown_type_byte(self):
+        with self.assertRaises(ValueError):
+            pure_loads(b'\xc1')
+
+
+class Test_Wire(unittest.TestCase):
+    def test_preferred(self):
+        self.assertIs(wire.choose(['json', 'compact']), wire.COMPACT)
+
+    def test_only_json(self):
+        self.assertIs(wire.choose(['json']), wire.JSON)
+
+    def test_nothing_in_common(self):
+        self.assertIs(wire.choose(['xml']), wire.DEFAULT)
+        self.assertIs(wire.get('xml'), wire.DEFAULT)
+
+    def test_encodings_round_trip(self):
+        message = {'intent': 'register', 'encoding': 'compact', 'chain': ['a', 'b'], 'n': 3}
+        for name in wire.names():
+            encoding = wire.get(name)
+            self.assertEqual(encoding.loads(encoding.dumps(message)), message)
+        self.assertEqual(json.loads(wire.JSON.dumps(message)), message)
+
+
+if __name__ == "__main__":
+    unittest.main()
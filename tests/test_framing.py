@@ -0,0 +1,86 @@
+import os
+import sys
+import unittest
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import framing
+from framing import FrameDecoder, FrameError
+
+
+class Test_Frames(unittest.TestCase):
+    def test_encode(self):
+        self.assertEqual(framing.encode_frame(b'abc'), b'\x00\x00\x00\x03abc')
+        self.assertEqual(framing.encode_frame('abc'), b'\x00\x00\x00\x03abc')
+        self.assertEqual(framing.encode_frame(b''), b'\x00\x00\x00\x00')
+
+    def test_encode_too_big(self):
+        with self.assertRaises(FrameError):
+            framing.encode_frame(bytes(framing.MAX_FRAME_SIZE + 1))
+
+    def test_signed_round_trip(self):
+        frame = framing.encode_signed_frame(b'payload', b'sig', framing.MAC)
+        [body] = FrameDecoder().feed(frame)
+        self.assertEqual(framing.unpack_signed(body), (framing.MAC, b'sig', b'payload'))
+
+    def test_unsigned(self):
+        [body] = FrameDecoder().feed(framing.encode_signed_frame(b'payload'))
+        self.assertEqual(framing.unpack_signed(body), (framing.SIGNATURE, b'', b'payload'))
+
+    def test_signed_too_big(self):
+        with self.assertRaises(FrameError):
+            framing.encode_signed_frame(bytes(framing.MAX_FRAME_SIZE), b'sig')
+
+    def test_unpack_short(self):
+        with self.assertRaises(FrameError):
+            framing.unpack_signed(b'\x00\x00')
+
+    def test_unpack_signature_past_the_end(self):
+        with self.assertRaises(FrameError):
+            framing.unpack_signed(framing.SIG_HEADER.pack(framing.SIGNATURE, 10) + b'short')
+
+
+class Test_Decoder(unittest.TestCase):
+    def test_several_frames_at_once(self):
+        data = b''.join(framing.encode_frame(p) for p in (b'one', b'', b'three'))
+        self.assertEqual(FrameDecoder().feed(data), [b'one', b'', b'three'])
+
+    def test_byte_by_byte(self):
+        data = framing.encode_frame(b'one') + framing.encode_frame(b'two')
+        decoder = FrameDecoder()
+        frames = []
+        for i in range(len(data)):
+            frames += decoder.feed(data[i:i + 1])
+        self.assertEqual(frames, [b'one', b'two'])
+        self.assertEqual(decoder.pending(), b'')
+
+    def test_partial_header(self):
+        decoder = FrameDecoder()
+        self.assertEqual(decoder.feed(b'\x00\x00'), [])
+        self.assertEqual(decoder.pending(), b'\x00\x00')
+        self.assertEqual(decoder.feed(b'\x00\x02h'), [])
+        self.assertEqual(decoder.feed(b'ix'), [b'hi'])
+        self.assertEqual(decoder.pending(), b'x')
+
+    def test_partial_payload_kept(self):
+        decoder = FrameDecoder()
+        frame = framing.encode_frame(b'hello')
+        self.assertEqual(decoder.feed(framing.encode_frame(b'a') + frame[:6]), [b'a'])
+        self.assertEqual(decoder.pending(), frame[:6])
+        self.assertEqual(decoder.feed(frame[6:]), [b'hello'])
+
+    def test_oversized_length(self):
+        decoder = FrameDecoder(max_size=8)
+        with self.assertRaises(FrameError):
+            decoder.feed(framing.HEADER.pack(9))
+
+    def test_oversized_length_after_a_frame(self):
+        decoder = FrameDecoder(max_size=8)
+        with self.assertRaises(FrameError):
+            decoder.feed(framing.encode_frame(b'ok') + framing.HEADER.pack(0xffffffff))
+
+    def test_largest_length(self):
+        decoder = FrameDecoder(max_size=8)
+        self.assertEqual(decoder.feed(framing.encode_frame(b'12345678')), [b'12345678'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,421 @@
+import os
+import sys
+import shutil
+import datetime
+import tempfile
+import unittest
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.serialization import Encoding
+from cryptography.hazmat.primitives.asymmetric import ec
+import revocation
+
+NOW = datetime.datetime.now(datetime.timezone.utc)
+LARGE = 2 ** 100 + 7
+
+
+def ca(cn):
+    return name(cn), ec.generate_private_key(ec.SECP256R1(), default_backend())
+
+
+def name(cn):
+    return x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, cn)])
+
+
+def points(extension, file_name):
+    return extension([x509.DistributionPoint(
+        full_name=[x509.UniformResourceIdentifier("http://crl.example/" + file_name)],
+        relative_name=None, reasons=None, crl_issuer=None)])
+
+
+# CRL of the issuer written as file_name in directory: a delta when number
+# is given, with the removed serials taken off (removeFromCRL)
+def write_crl(directory, file_name, issuer, revoked=(), removed=(), number=None, freshest=None):
+    issuer_name, key = issuer
+    builder = (x509.CertificateRevocationListBuilder()
+        .issuer_name(issuer_name)
+        .last_update(NOW)
+        .next_update(NOW + datetime.timedelta(days=1)))
+    for serial in revoked:
+        builder = builder.add_revoked_certificate(x509.RevokedCertificateBuilder()
+            .serial_number(serial).revocation_date(NOW).build())
+    for serial in removed:
+        builder = builder.add_revoked_certificate(x509.RevokedCertificateBuilder()
+            .serial_number(serial).revocation_date(NOW)
+            .add_extension(x509.CRLReason(x509.ReasonFlags.remove_from_crl), critical=False)
+            .build())
+    if number is not None:
+        builder = builder.add_extension(x509.DeltaCRLIndicator(number), critical=True)
+    if freshest is not None:
+        builder = builder.add_extension(points(x509.FreshestCRL, freshest), critical=False)
+    crl = builder.sign(key, hashes.SHA256(), default_backend())
+
+    path = os.path.join(directory, file_name)
+    with open(path, 'wb') as f:
+        f.write(crl.public_bytes(Encoding.DER))
+    return path
+
+
+# Certificate of the issuer pointing at its CRL files
+def certificate(issuer, serial, crl=None, delta=None):
+    issuer_name, key = issuer
+    builder = (x509.CertificateBuilder()
+        .subject_name(name("Citizen {}".format(serial)))
+        .issuer_name(issuer_name)
+        .public_key(key.public_key())
+        .serial_number(serial)
+        .not_valid_before(NOW - datetime.timedelta(days=1))
+        .not_valid_after(NOW + datetime.timedelta(days=1)))
+    if crl is not None:
+        builder = builder.add_extension(points(x509.CRLDistributionPoints, crl), critical=False)
+    if delta is not None:
+        builder = builder.add_extension(points(x509.FreshestCRL, delta), critical=False)
+    return builder.sign(key, hashes.SHA256(), default_backend())
+
+
+class Temp_Dir_Test(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+
+#########################################################################
+## Bloom filter
+
+class Test_Bloom_Filter(unittest.TestCase):
+    def test_no_false_negatives(self):
+        bloom = revocation.Bloom_Filter(10000)
+        serials = list(range(1, 10000 * 7919, 7919)) + [LARGE, revocation.MASK_64]
+        bloom.add_serials(b'issuer', serials)
+        for serial in serials:
+            self.assertTrue(bloom.contains(b'issuer', serial))
+
+    def test_false_positive_rate(self):
+        bloom = revocation.Bloom_Filter(10000, fp_rate=0.01)
+        bloom.add_serials(b'issuer', range(10000))
+        false_positives = sum(bloom.contains(b'issuer', n) for n in range(10000, 60000))
+        self.assertLess(false_positives / 50000, 0.02)
+        self.assertLess(bloom.false_positive_rate(), 0.011)
+
+    def test_issuers_kept_apart(self):
+        bloom = revocation.Bloom_Filter(10000)
+        bloom.add_serials(b'issuer', range(10000))
+        false_positives = sum(bloom.contains(b'other issuer', n) for n in range(10000))
+        self.assertLess(false_positives / 10000, 0.02)
+
+    def test_fixed_size(self):
+        bloom = revocation.Bloom_Filter(1000, size=1024)
+        self.assertEqual(len(bloom.words), 128)
+
+    def test_report(self):
+        bloom = revocation.Bloom_Filter(1000, size=1024)
+        bloom.add_serials(b'issuer', range(1024))
+        self.assertIn("8.0 bits per serial, {} hashes".format(bloom.hash_count), bloom.report())
+
+
+class Test_Index(Temp_Dir_Test):
+    def test_revoked(self):
+        issuer = ca("CA")
+        write_crl(self.dir, "ca.crl", issuer, revoked=[5, 10, LARGE])
+        index = revocation.Revocation_Index(self.dir)
+        for serial in (5, 10, LARGE):
+            self.assertTrue(index.is_revoked(issuer[0], serial))
+        for serial in (4, 6, LARGE + 1):
+            self.assertFalse(index.is_revoked(issuer[0], serial))
+        self.assertEqual(index.serial_count(), 3)
+
+    def test_other_issuer(self):
+        issuer = ca("CA")
+        write_crl(self.dir, "ca.crl", issuer, revoked=[5])
+        index = revocation.Revocation_Index(self.dir)
+        self.assertFalse(index.is_revoked(name("Other CA"), 5))
+
+    def test_filter_answers_first(self):
+        issuer = ca("CA")
+        write_crl(self.dir, "ca.crl", issuer, revoked=range(1, 1000))
+        index = revocation.Revocation_Index(self.dir)
+        for serial in range(1000, 2000):
+            self.assertFalse(index.is_revoked(issuer[0], serial))
+        stats = index.filter_stats()
+        self.assertEqual(stats['negatives'] + stats['false_positives'], 1000)
+        self.assertGreater(stats['negatives'], 900)
+
+    def test_not_a_crl(self):
+        with open(os.path.join(self.dir, "README"), 'w') as f:
+            f.write("not a CRL")
+        index = revocation.Revocation_Index(self.dir)
+        self.assertFalse(index.is_revoked(name("CA"), 1))
+        self.assertIn("README", index.skipped)
+
+
+#########################################################################
+## Delta CRLs
+
+class Test_Deltas(Temp_Dir_Test):
+    def setUp(self):
+        super().setUp()
+        self.issuer = ca("CA")
+        self.mtime = 1000000000
+
+    def write(self, file_name, **kwargs):
+        path = write_crl(self.dir, file_name, self.issuer, **kwargs)
+        # Every write is a change, however fast they come
+        self.mtime += 1
+        os.utime(path, (self.mtime, self.mtime))
+
+    def index(self):
+        index = revocation.Revocation_Index(self.dir)
+        index.wait()
+        return index
+
+    def revoked(self, index, serials):
+        return [n for n in serials if index.is_revoked(self.issuer[0], n)]
+
+    def test_loaded_on_top_of_the_base(self):
+        self.write("base.crl", revoked=[1, 2, 3])
+        self.write("delta.crl", revoked=[4, LARGE], removed=[2], number=1)
+        index = self.index()
+        self.assertEqual(self.revoked(index, [1, 2, 3, 4, 5, LARGE]), [1, 3, 4, LARGE])
+
+    def test_new_delta_adds(self):
+        self.write("base.crl", revoked=[1, 2])
+        index = self.index()
+        version = index.version
+        self.write("delta.crl", revoked=[7, LARGE], number=1)
+        index.refresh()
+        self.assertEqual(self.revoked(index, [1, 2, 7, LARGE]), [1, 2, 7, LARGE])
+        self.assertGreater(index.version, version)
+
+    def test_new_delta_removes(self):
+        self.write("base.crl", revoked=[1, 2, 3, LARGE])
+        index = self.index()
+        self.write("delta.crl", revoked=[9], removed=[2, LARGE], number=1)
+        index.refresh()
+        self.assertEqual(self.revoked(index, [1, 2, 3, 9, LARGE]), [1, 3, 9])
+
+    def test_new_delta_removes_only(self):
+        self.write("base.crl", revoked=[1, 2])
+        index = self.index()
+        self.write("delta.crl", removed=[1], number=1)
+        index.refresh()
+        self.assertEqual(self.revoked(index, [1, 2]), [2])
+
+    def test_base_replaced(self):
+        self.write("base.crl", revoked=[1, 2])
+        self.write("delta.crl", removed=[5], number=1)
+        index = self.index()
+        self.write("base.crl", revoked=[3, 4, 5])
+        index.refresh()
+        # What the delta took off stays off
+        self.assertEqual(self.revoked(index, [1, 2, 3, 4, 5]), [3, 4])
+
+    def test_delta_replaced(self):
+        self.write("base.crl", revoked=[1, 2])
+        self.write("delta.crl", revoked=[3], removed=[1], number=1)
+        index = self.index()
+        self.write("delta.crl", revoked=[4], number=2)
+        index.refresh()
+        self.assertEqual(self.revoked(index, [1, 2, 3, 4]), [1, 2, 4])
+
+    def test_file_removed(self):
+        self.write("base.crl", revoked=[1])
+        self.write("delta.crl", revoked=[2], number=1)
+        index = self.index()
+        os.unlink(os.path.join(self.dir, "delta.crl"))
+        index.refresh()
+        self.assertEqual(self.revoked(index, [1, 2]), [1])
+        self.assertNotIn("delta.crl", index.files)
+
+    def test_nothing_changed(self):
+        self.write("base.crl", revoked=[1])
+        index = self.index()
+        version = index.version
+        index.refresh()
+        self.assertEqual(index.version, version)
+
+
+#########################################################################
+## CRL partitions
+
+class Test_Partitions(Temp_Dir_Test):
+    def setUp(self):
+        super().setUp()
+        self.issuer = ca("CA")
+
+    def test_base(self):
+        write_crl(self.dir, "ca.crl", self.issuer, revoked=[5])
+        index = revocation.Partitioned_Index(self.dir)
+        self.assertTrue(index.is_cert_revoked(certificate(self.issuer, 5, "ca.crl")))
+        self.assertFalse(index.is_cert_revoked(certificate(self.issuer, 6, "ca.crl")))
+        self.assertEqual(index.stats()['loads'], 1)
+        self.assertEqual(index.stats()['hits'], 1)
+
+    def test_delta_of_the_certificate(self):
+        write_crl(self.dir, "ca.crl", self.issuer, revoked=[5, 6])
+        write_crl(self.dir, "ca_delta.crl", self.issuer, revoked=[7], removed=[6], number=1)
+        index = revocation.Partitioned_Index(self.dir)
+        for serial, revoked in ((5, True), (6, False), (7, True), (8, False)):
+            cert = certificate(self.issuer, serial, "ca.crl", "ca_delta.crl")
+            self.assertEqual(index.is_cert_revoked(cert), revoked)
+
+    def test_delta_of_the_base(self):
+        write_crl(self.dir, "ca.crl", self.issuer, revoked=[5, 6], freshest="ca_delta.crl")
+        write_crl(self.dir, "ca_delta.crl", self.issuer, revoked=[7], removed=[6], number=1)
+        index = revocation.Partitioned_Index(self.dir)
+        for serial, revoked in ((5, True), (6, False), (7, True)):
+            self.assertEqual(index.is_cert_revoked(certificate(self.issuer, serial, "ca.crl")), revoked)
+
+    def test_missing_delta(self):
+        write_crl(self.dir, "ca.crl", self.issuer, revoked=[5])
+        index = revocation.Partitioned_Index(self.dir)
+        self.assertFalse(index.is_cert_revoked(certificate(self.issuer, 6, "ca.crl", "ca_delta.crl")))
+
+    def test_missing_partition(self):
+        index = revocation.Partitioned_Index(self.dir)
+        self.assertTrue(index.is_cert_revoked(certificate(self.issuer, 6, "ca.crl")))
+
+    def test_partition_of_another_issuer(self):
+        write_crl(self.dir, "ca.crl", ca("Other CA"), revoked=[5])
+        index = revocation.Partitioned_Index(self.dir)
+        self.assertTrue(index.is_cert_revoked(certificate(self.issuer, 6, "ca.crl")))
+
+    def test_missing_partition_with_fallback(self):
+        write_crl(self.dir, "elsewhere.crl", self.issuer, revoked=[5])
+        index = revocation.Partitioned_Index(
+            self.dir, fallback=revocation.Revocation_Index(self.dir))
+        self.assertTrue(index.is_cert_revoked(certificate(self.issuer, 5, "ca.crl")))
+        self.assertFalse(index.is_cert_revoked(certificate(self.issuer, 6, "ca.crl")))
+
+    def test_no_distribution_points(self):
+        write_crl(self.dir, "ca.crl", self.issuer, revoked=[5])
+        self.assertFalse(revocation.Partitioned_Index(self.dir).is_cert_revoked(
+            certificate(self.issuer, 5)))
+        index = revocation.Partitioned_Index(
+            self.dir, fallback=revocation.Revocation_Index(self.dir))
+        self.assertTrue(index.is_cert_revoked(certificate(self.issuer, 5)))
+
+    def test_memory_budget(self):
+        issuers = [ca("CA {}".format(i)) for i in range(3)]
+        for i, issuer in enumerate(issuers):
+            write_crl(self.dir, "ca{}.crl".format(i), issuer, revoked=range(1, 1000))
+        index = revocation.Partitioned_Index(self.dir, memory_budget=1)
+        for i, issuer in enumerate(issuers):
+            self.assertTrue(index.is_cert_revoked(certificate(issuer, 5, "ca{}.crl".format(i))))
+        self.assertEqual(len(index.partitions), 1)
+        self.assertEqual(index.evictions, 2)
+
+    def test_changed_on_disk(self):
+        path = write_crl(self.dir, "ca.crl", self.issuer, revoked=[5])
+        os.utime(path, (1000000000, 1000000000))
+        index = revocation.Partitioned_Index(self.dir)
+        cert = certificate(self.issuer, 6, "ca.crl")
+        self.assertFalse(index.is_cert_revoked(cert))
+        write_crl(self.dir, "ca.crl", self.issuer, revoked=[5, 6])
+        index.refresh()
+        self.assertEqual(index.version, 1)
+        self.assertTrue(index.is_cert_revoked(cert))
+
+
+
+#########################################################################
+## Compiled index
+
+class Test_Compiled_Index(Temp_Dir_Test):
+    def setUp(self):
+        super().setUp()
+        self.crl_dir = os.path.join(self.dir, "CRL")
+        os.mkdir(self.crl_dir)
+        self.path = os.path.join(self.dir, "CRL.db")
+        self.issuer = ca("CA")
+
+    # CRL written with an mtime older than anything written afterwards
+    def write_old_crl(self, *args, **kwargs):
+        path = write_crl(self.crl_dir, *args, **kwargs)
+        os.utime(path, (1000000000, 1000000000))
+
+    def compile(self):
+        revocation.compile_index(self.crl_dir, self.path)
+
+    def test_same_as_the_index(self):
+        other = ca("Other CA")
+        self.write_old_crl("ca.crl", self.issuer, revoked=[1, 5, 9, LARGE, 2 ** 64], freshest="ca_delta.crl")
+        self.write_old_crl("ca_delta.crl", self.issuer, revoked=[7], removed=[5], number=2)
+        self.write_old_crl("other.crl", other, revoked=range(3, 3000, 3))
+        self.compile()
+        compiled = revocation.Compiled_Index(self.path, self.crl_dir)
+        index = revocation.Revocation_Index(self.crl_dir)
+        for issuer in (self.issuer, other):
+            for serial in list(range(3100)) + [LARGE, LARGE + 1, 2 ** 64, revocation.MASK_64]:
+                self.assertEqual(
+                    compiled.is_revoked(issuer[0], serial),
+                    index.is_revoked(issuer[0], serial), serial)
+        self.assertEqual(compiled.serial_count(), index.serial_count())
+        self.assertFalse(compiled.stale)
+
+    def test_large_serials(self):
+        serials = [revocation.MASK_64, 2 ** 64, LARGE, 2 ** 158 + 1]
+        self.write_old_crl("ca.crl", self.issuer, revoked=serials)
+        self.compile()
+        index = revocation.Compiled_Index(self.path)
+        for serial in serials:
+            self.assertTrue(index.is_revoked(self.issuer[0], serial))
+        for serial in (revocation.MASK_64 - 1, 2 ** 64 + 1, LARGE - 1, 2 ** 158, 2 ** 200):
+            self.assertFalse(index.is_revoked(self.issuer[0], serial))
+        self.assertEqual(index.serial_count(), 4)
+
+    def test_unknown_issuer(self):
+        self.write_old_crl("ca.crl", self.issuer, revoked=[5])
+        self.compile()
+        index = revocation.Compiled_Index(self.path)
+        self.assertFalse(index.is_revoked(name("Other CA"), 5))
+        self.assertFalse(index.is_cert_revoked(certificate(ca("Other CA"), 5)))
+        self.assertTrue(index.is_cert_revoked(certificate(self.issuer, 5)))
+
+    def test_file_replaced(self):
+        self.write_old_crl("ca.crl", self.issuer, revoked=[5])
+        self.compile()
+        index = revocation.Compiled_Index(self.path, self.crl_dir)
+        self.assertFalse(index.is_revoked(self.issuer[0], 6))
+        self.write_old_crl("ca.crl", self.issuer, revoked=[5, 6])
+        self.compile()
+        index.refresh()
+        self.assertEqual(index.version, 2)
+        self.assertTrue(index.is_revoked(self.issuer[0], 6))
+
+    def test_older_than_the_directory(self):
+        self.write_old_crl("ca.crl", self.issuer, revoked=[5])
+        self.compile()
+        index = revocation.Compiled_Index(
+            self.path, self.crl_dir, fallback=revocation.Revocation_Index(self.crl_dir))
+        index.wait()
+        write_crl(self.crl_dir, "ca.crl", self.issuer, revoked=[5, 6])
+        index.refresh()
+        self.assertTrue(index.stale)
+        self.assertTrue(index.is_cert_revoked(certificate(self.issuer, 6)))
+
+        # The CRLs are still followed while the file is not compiled again
+        write_crl(self.crl_dir, "ca.crl", self.issuer, revoked=[5, 6, 7])
+        version = index.version
+        index.refresh()
+        self.assertNotEqual(index.version, version)
+        self.assertTrue(index.is_cert_revoked(certificate(self.issuer, 7)))
+
+        self.compile()
+        index.refresh()
+        self.assertFalse(index.stale)
+        self.assertTrue(index.is_cert_revoked(certificate(self.issuer, 7)))
+
+    def test_older_without_fallback(self):
+        self.write_old_crl("ca.crl", self.issuer, revoked=[5])
+        self.compile()
+        write_crl(self.crl_dir, "ca.crl", self.issuer, revoked=[5, 6])
+        index = revocation.Compiled_Index(self.path, self.crl_dir)
+        self.assertTrue(index.is_cert_revoked(certificate(self.issuer, 5)))
+        self.assertTrue(index.stale)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,322 @@
+import os
+import sys
+import shutil
+import datetime
+import tempfile
+import unittest
+from unittest import mock
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.serialization import Encoding
+from cryptography.hazmat.primitives.asymmetric import ec
+import trust
+
+NOW = datetime.datetime.now(datetime.timezone.utc)
+DAY = datetime.timedelta(days=1)
+
+
+def new_key():
+    return ec.generate_private_key(ec.SECP256R1(), default_backend())
+
+
+# Certificate of cn with key, issued by issuer ((certificate, key), self
+# signed when None). CAs get keyCertSign unless cert_sign says otherwise,
+# key_usage False leaves KeyUsage out.
+def certificate(cn, key, issuer=None, ca=False, path_length=None, key_usage=True,
+                cert_sign=None, not_before=NOW - DAY, not_after=NOW + DAY):
+    subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, cn)])
+    if issuer is None:
+        issuer_name, issuer_key = subject, key
+    else:
+        issuer_name, issuer_key = issuer[0].subject, issuer[1]
+    builder = (x509.CertificateBuilder()
+        .subject_name(subject)
+        .issuer_name(issuer_name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(not_before)
+        .not_valid_after(not_after)
+        .add_extension(x509.BasicConstraints(ca=ca, path_length=path_length), critical=True)
+        .add_extension(x509.SubjectKeyIdentifier.from_public_key(key.public_key()), critical=False)
+        .add_extension(x509.AuthorityKeyIdentifier.from_issuer_public_key(issuer_key.public_key()), critical=False))
+    if key_usage:
+        builder = builder.add_extension(x509.KeyUsage(
+            digital_signature=not ca, content_commitment=False,
+            key_encipherment=False, data_encipherment=False, key_agreement=False,
+            key_cert_sign=ca if cert_sign is None else cert_sign, crl_sign=ca,
+            encipher_only=False, decipher_only=False), critical=True)
+    return builder.sign(issuer_key, hashes.SHA256(), default_backend())
+
+
+def der(cert):
+    return cert.public_bytes(Encoding.DER)
+
+
+def write_cert(directory, file_name, cert, encoding=Encoding.DER):
+    path = os.path.join(directory, file_name)
+    with open(path, 'wb') as f:
+        f.write(cert.public_bytes(encoding))
+    return path
+
+
+class Temp_Dir_Test(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        # Every call looks at the directory again
+        patcher = mock.patch.object(trust, 'CHECK_INTERVAL', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+#########################################################################
+## Trust store
+
+class Test_Trust_Store(Temp_Dir_Test):
+    def setUp(self):
+        super().setUp()
+        self.root_key = new_key()
+        self.root = certificate("Root", self.root_key, ca=True)
+
+    def test_trusted(self):
+        write_cert(self.dir, "root.cer", self.root)
+        store = trust.TrustStore([self.dir])
+        self.assertTrue(store.is_trusted(self.root))
+        self.assertTrue(store.is_trusted(der(self.root)))
+        self.assertFalse(store.is_trusted(certificate("Root", self.root_key, ca=True,
+                                                      not_after=NOW + 2 * DAY)))
+
+    def test_pem_and_other_files(self):
+        write_cert(self.dir, "root.pem", self.root, Encoding.PEM)
+        with open(os.path.join(self.dir, "README"), 'w') as f:
+            f.write("not a certificate")
+        store = trust.TrustStore([self.dir, os.path.join(self.dir, "missing")])
+        self.assertEqual(store.certificates(), [self.root])
+
+    def test_several_directories(self):
+        other = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, other)
+        second = certificate("Second Root", new_key(), ca=True)
+        write_cert(self.dir, "root.cer", self.root)
+        write_cert(other, "second.cer", second)
+        store = trust.TrustStore([self.dir, other])
+        self.assertTrue(store.is_trusted(self.root))
+        self.assertTrue(store.is_trusted(second))
+
+    def test_reloaded_when_changed(self):
+        store = trust.TrustStore([self.dir])
+        self.assertFalse(store.is_trusted(self.root))
+        version = store.version
+
+        path = write_cert(self.dir, "root.cer", self.root)
+        self.assertTrue(store.is_trusted(self.root))
+        self.assertGreater(store.version, version)
+
+        version = store.version
+        self.assertTrue(store.is_trusted(self.root))
+        self.assertEqual(store.version, version)
+
+        os.unlink(path)
+        self.assertFalse(store.is_trusted(self.root))
+        self.assertGreater(store.version, version)
+
+    def test_not_looked_at_again_too_soon(self):
+        store = trust.TrustStore([self.dir])
+        with mock.patch.object(trust, 'CHECK_INTERVAL', 3600):
+            store.check()
+            write_cert(self.dir, "root.cer", self.root)
+            self.assertFalse(store.is_trusted(self.root))
+
+    def test_issuers_of(self):
+        write_cert(self.dir, "root.cer", self.root)
+        store = trust.TrustStore([self.dir])
+        leaf = certificate("Leaf", new_key(), (self.root, self.root_key))
+        self.assertEqual(store.issuers_of(leaf), [self.root])
+        # An unknown key id falls back to the issuer name
+        other_key = new_key()
+        rekeyed = certificate("Leaf", new_key(), (certificate("Root", other_key, ca=True), other_key))
+        self.assertEqual(store.issuers_of(rekeyed), [self.root])
+        other_key = new_key()
+        stranger = certificate("Leaf", new_key(), (certificate("Other Root", other_key, ca=True), other_key))
+        self.assertEqual(store.issuers_of(stranger), [])
+
+
+#########################################################################
+## Validation cache
+
+class Test_Validation_Cache(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch.object(trust.time, 'monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_hit_and_miss(self):
+        cache = trust.Validation_Cache()
+        key = cache.key(b'cert', [b'ca'])
+        self.assertIsNone(cache.get(key, 1))
+        cache.put(key, 1, True)
+        self.assertIs(cache.get(key, 1), True)
+        cache.put(cache.key(b'other', []), 1, False)
+        self.assertIs(cache.get(cache.key(b'other', []), 1), False)
+        self.assertEqual(cache.stats(), {'entries': 2, 'hits': 2, 'misses': 1})
+
+    def test_ttl(self):
+        cache = trust.Validation_Cache(ttl=60)
+        cache.put(b'key', 1, True)
+        self.now += 59
+        self.assertIs(cache.get(b'key', 1), True)
+        self.now += 1
+        self.assertIsNone(cache.get(b'key', 1))
+        self.assertEqual(cache.stats()['entries'], 0)
+
+    def test_other_version(self):
+        cache = trust.Validation_Cache()
+        cache.put(b'key', 1, True)
+        self.assertIsNone(cache.get(b'key', 2))
+        # Dropped, the old version does not get it back
+        self.assertIsNone(cache.get(b'key', 1))
+        cache.put(b'key', (2, 5), False)
+        self.assertIs(cache.get(b'key', (2, 5)), False)
+        self.assertIsNone(cache.get(b'key', (2, 6)))
+
+    def test_least_recently_used_goes_first(self):
+        cache = trust.Validation_Cache(size=2)
+        cache.put(b'a', 1, True)
+        cache.put(b'b', 1, True)
+        cache.get(b'a', 1)
+        cache.put(b'c', 1, True)
+        self.assertIs(cache.get(b'a', 1), True)
+        self.assertIsNone(cache.get(b'b', 1))
+        self.assertIs(cache.get(b'c', 1), True)
+
+    def test_key(self):
+        key = trust.Validation_Cache.key
+        self.assertEqual(key(b'cert', [b'a', b'b']), key(b'cert', (b'a', b'b')))
+        self.assertNotEqual(key(b'cert', [b'a', b'b']), key(b'cert', [b'b', b'a']))
+        self.assertNotEqual(key(b'cert', [b'a']), key(b'cer', [b'ta']))
+        self.assertNotEqual(key(b'cert', []), key(b'cert', [b'']))
+
+
+#########################################################################
+## Path building
+
+class Test_Path_Builder(Temp_Dir_Test):
+    def setUp(self):
+        super().setUp()
+        self.root = self.ca("Root")
+        write_cert(self.dir, "root.cer", self.root[0])
+        self.builder = trust.Path_Builder(trust.TrustStore([self.dir]))
+
+    def ca(self, cn, issuer=None, **kwargs):
+        key = new_key()
+        return certificate(cn, key, issuer, ca=True, **kwargs), key
+
+    def leaf(self, issuer, **kwargs):
+        return certificate("Citizen", new_key(), issuer, **kwargs)
+
+    def build(self, leaf, *chain):
+        return self.builder.build(der(leaf), [der(c) for c in chain])
+
+    def test_path(self):
+        intermediate = self.ca("Intermediate", self.root, path_length=0)
+        leaf = self.leaf(intermediate)
+        self.assertEqual(self.build(leaf, intermediate[0]), [leaf, intermediate[0], self.root[0]])
+
+    def test_chain_in_any_order(self):
+        first = self.ca("First", self.root)
+        second = self.ca("Second", first)
+        leaf = self.leaf(second)
+        path = self.build(leaf, self.root[0], first[0], second[0])
+        self.assertEqual(path, [leaf, second[0], first[0], self.root[0]])
+
+    def test_anchor_itself(self):
+        self.assertEqual(self.build(self.root[0]), [self.root[0]])
+
+    def test_missing_intermediate(self):
+        intermediate = self.ca("Intermediate", self.root)
+        self.assertIsNone(self.build(self.leaf(intermediate)))
+
+    def test_untrusted_root(self):
+        other = self.ca("Other Root")
+        self.assertIsNone(self.build(self.leaf(other), other[0]))
+
+    def test_forged_signature(self):
+        intermediate = self.ca("Intermediate", self.root)
+        impostor = (intermediate[0], new_key())
+        self.assertIsNone(self.build(self.leaf(impostor), intermediate[0]))
+
+    def test_issuer_not_a_ca(self):
+        citizen_key = new_key()
+        citizen = certificate("Intermediate", citizen_key, self.root)
+        self.assertIsNone(self.build(self.leaf((citizen, citizen_key)), citizen))
+
+    def test_issuer_without_cert_sign(self):
+        intermediate = self.ca("Intermediate", self.root, cert_sign=False)
+        self.assertIsNone(self.build(self.leaf(intermediate), intermediate[0]))
+
+    def test_issuer_without_key_usage(self):
+        intermediate = self.ca("Intermediate", self.root, key_usage=False)
+        self.assertIsNone(self.build(self.leaf(intermediate), intermediate[0]))
+
+    def test_path_length(self):
+        first = self.ca("First", self.root, path_length=0)
+        second = self.ca("Second", first)
+        self.assertIsNone(self.build(self.leaf(second), first[0], second[0]))
+
+        first = self.ca("First", self.root, path_length=1)
+        second = self.ca("Second", first, path_length=0)
+        leaf = self.leaf(second)
+        self.assertEqual(self.build(leaf, first[0], second[0]), [leaf, second[0], first[0], self.root[0]])
+
+    def test_expired_or_not_yet_valid_leaf(self):
+        intermediate = self.ca("Intermediate", self.root)
+        for dates in ({'not_after': NOW - DAY / 2}, {'not_before': NOW + DAY / 2}):
+            self.assertIsNone(self.build(self.leaf(intermediate, **dates), intermediate[0]))
+
+    def test_expired_issuer(self):
+        intermediate = self.ca("Intermediate", self.root, not_after=NOW - DAY / 2)
+        self.assertIsNone(self.build(self.leaf(intermediate), intermediate[0]))
+
+    def test_valid_issuer_among_candidates(self):
+        # Same name and key, one of them expired: the other one is taken
+        key = new_key()
+        expired = certificate("Intermediate", key, self.root, ca=True, not_after=NOW - DAY / 2)
+        current = certificate("Intermediate", key, self.root, ca=True)
+        leaf = self.leaf((current, key))
+        self.assertEqual(self.build(leaf, expired, current), [leaf, current, self.root[0]])
+
+    def test_max_depth(self):
+        issuer = self.root
+        chain = []
+        for i in range(4):
+            issuer = self.ca("CA {}".format(i), issuer)
+            chain.append(issuer[0])
+        leaf = self.leaf(issuer)
+        # Five links up to the root
+        self.builder.max_depth = 5
+        self.assertIsNotNone(self.build(leaf, *chain))
+        self.builder.max_depth = 4
+        self.assertIsNone(self.build(leaf, *chain))
+
+    def test_custom_anchor(self):
+        intermediate = self.ca("Intermediate", self.root)
+        leaf = self.leaf(intermediate)
+        path = self.builder.build(der(leaf), [der(intermediate[0])],
+                                  is_anchor=lambda cert: cert == intermediate[0])
+        self.assertEqual(path, [leaf, intermediate[0]])
+
+    def test_links_checked_once(self):
+        intermediate = self.ca("Intermediate", self.root)
+        leaf = self.leaf(intermediate)
+        self.build(leaf, intermediate[0])
+        with mock.patch.object(trust, 'verify_signature') as verify:
+            self.assertIsNotNone(self.build(leaf, intermediate[0]))
+            verify.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,203 @@
+import os
+import sys
+import json
+import time
+import threading
+from statistics import median
+
+# Timeline of a table as one side saw it (the croupier or a player): the
+# phases the table went through, each with when it started and ended and
+# the messages and bytes exchanged with the other side meanwhile. When the
+# table is over its timeline is appended to a file as JSON lines, one per
+# phase and a last one (phase null) for the whole table with its outcome:
+#
+#   {"table_id": 3, "side": "player", "player": 1, "phase": "card_selection",
+#    "start": 1700000000.12, "end": 1700000001.48, "duration": 1.36,
+#    "messages_in": 96, "messages_out": 31, "bytes_in": 81234, "bytes_out": 40121}
+#
+# Times are seconds since the epoch, so the timelines of the croupier and of
+# the players of a table can be put side by side.
+#
+# Phases of a player are the steps of client/table.py (wait_in_lobby,
+# player_auth, player_confirmation, deck_encrypting, card_selection,
+# commit_deck, share_deck_key, verify_equal_info, play). The croupier only
+# relays most of those, it sees: wait_in_lobby (table OPEN),
+# player_confirmation (FULL, the players' authentication goes on meanwhile),
+# shuffle (from SHUFFLE until the first validate_pre_game),
+# verify_equal_info and play.
+#
+# usage: python3 tracing.py TRACES.jsonl...   (time per phase over all tables)
+
+# Timelines written by the threads of a process go out one at a time
+write_lock = threading.Lock()
+
+COUNTS = ['messages_in', 'messages_out', 'bytes_in', 'bytes_out']
+
+
+class Timeline:
+    def __init__(self, table_id, side, path=None, player=None):
+        self.table_id = table_id
+        self.side = side
+        self.player = player
+        # Where the timeline goes when the table is over, None: kept only
+        self.path = path
+        self.started = time.time()
+        self.spans = []
+        self.current = None
+        self.outcome = None
+        self.ended = None
+
+    def enter(self, phase):
+        if self.ended is not None:
+            return
+        now = time.time()
+        self.close_span(now)
+        self.current = {
+            'phase': phase,
+            'start': now,
+            'messages_in': 0,
+            'messages_out': 0,
+            'bytes_in': 0,
+            'bytes_out': 0,
+        }
+
+    def phase(self):
+        if self.current is None:
+            return None
+        return self.current['phase']
+
+    def count_in(self, size, messages=1):
+        span = self.current
+        if span is not None:
+            span['messages_in'] += messages
+            span['bytes_in'] += size
+
+    def count_out(self, size, messages=1):
+        span = self.current
+        if span is not None:
+            span['messages_out'] += messages
+            span['bytes_out'] += size
+
+    # The table is over (or this side left it), later calls do nothing
+    def end(self, outcome):
+        if self.ended is not None:
+            return
+        self.ended = time.time()
+        self.close_span(self.ended)
+        self.outcome = outcome
+        if self.path is not None:
+            self.write(self.path)
+
+    def close_span(self, now):
+        if self.current is not None:
+            self.current['end'] = now
+            self.current['duration'] = now - self.current['start']
+            self.spans.append(self.current)
+            self.current = None
+
+    def records(self):
+        head = {'table_id': self.table_id, 'side': self.side}
+        if self.player is not None:
+            head['player'] = self.player
+
+        records = []
+        for span in self.spans:
+            record = dict(head)
+            for key in ('phase', 'start', 'end', 'duration'):
+                record[key] = span[key]
+            for key in COUNTS:
+                record[key] = span[key]
+            records.append(record)
+
+        total = dict(head)
+        total['phase'] = None
+        total['start'] = self.started
+        total['end'] = self.ended
+        total['duration'] = self.ended - self.started
+        for key in COUNTS:
+            total[key] = sum(span[key] for span in self.spans)
+        total['outcome'] = self.outcome
+        records.append(total)
+        return records
+
+    # Appended in a single write, so the timelines of different tables (and
+    # processes) do not mix
+    def write(self, path):
+        data = ''.join(json.dumps(record) + '\n' for record in self.records())
+        with write_lock:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(path, 'a') as f:
+                f.write(data)
+
+
+#########################################################################
+## Summary of trace files
+
+def load(paths):
+    records = []
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    records.append(json.loads(line))
+    return records
+
+
+# (side, phase) -> durations, messages and bytes, in the order phases come
+def by_phase(records):
+    phases = {}
+    for r in records:
+        if r['phase'] is None:
+            continue
+        entry = phases.setdefault((r['side'], r['phase']), {
+            'durations': [], 'messages': 0, 'bytes': 0})
+        entry['durations'].append(r['duration'])
+        entry['messages'] += r['messages_in'] + r['messages_out']
+        entry['bytes'] += r['bytes_in'] + r['bytes_out']
+    return phases
+
+
+# side -> seconds from the start of each timeline until the play phase
+def time_to_play(records):
+    started = {}
+    times = {}
+    for r in records:
+        key = (r['side'], r['table_id'], r.get('player'))
+        started.setdefault(key, r['start'])
+        if r['phase'] == 'play':
+            times.setdefault(r['side'], []).append(r['start'] - started[key])
+        elif r['phase'] is None:
+            del started[key]
+    return times
+
+
+def print_summary(records):
+    timelines = [r for r in records if r['phase'] is None]
+    print("{} timelines".format(len(timelines)))
+    for side, times in sorted(time_to_play(records).items()):
+        print("Until play ({}): p50 {:.1f} ms, max {:.1f} ms".format(
+            side, median(times) * 1000, max(times) * 1000))
+    print()
+    print("{:<10} {:<20} {:>6} {:>10} {:>10} {:>8} {:>10} {:>12}".format(
+        "side", "phase", "count", "p50 ms", "max ms", "share", "messages", "bytes"))
+
+    totals = {}
+    phases = by_phase(records)
+    for (side, phase), entry in phases.items():
+        totals[side] = totals.get(side, 0) + sum(entry['durations'])
+    for (side, phase), entry in phases.items():
+        durations = entry['durations']
+        print("{:<10} {:<20} {:>6} {:>10.1f} {:>10.1f} {:>8.1%} {:>10} {:>12}".format(
+            side, phase, len(durations),
+            median(durations) * 1000, max(durations) * 1000,
+            sum(durations) / totals[side] if totals[side] else 0,
+            entry['messages'], entry['bytes']))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python3 tracing.py TRACES.jsonl...")
+        sys.exit(1)
+    print_summary(load(sys.argv[1:]))
@@ -0,0 +1,312 @@
+import os
+import time
+import hashlib
+import datetime
+import threading
+from collections import OrderedDict
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding, rsa, ec
+from cryptography.exceptions import InvalidSignature
+
+# Trusted certificates (anchors) read from one or more directories. They are
+# parsed once and indexed by SHA-256 fingerprint, subject and key id, so asking
+# whether a certificate is trusted is a dictionary lookup. The directories
+# are looked at again (file names and mtimes) at most every CHECK_INTERVAL
+# seconds and reloaded when something changed.
+
+CHECK_INTERVAL = 1
+
+
+# Certificates indexed by fingerprint, subject and subject key identifier
+class Cert_Pool:
+    def __init__(self, certs=()):
+        self.by_fingerprint = {}
+        self.by_subject = {}
+        self.by_key_id = {}
+        for cert in certs:
+            self.add(cert)
+
+    def add(self, cert):
+        fingerprint = cert.fingerprint(hashes.SHA256())
+        if fingerprint in self.by_fingerprint:
+            return
+        self.by_fingerprint[fingerprint] = cert
+        self.by_subject.setdefault(cert.subject.public_bytes(), []).append(cert)
+        key_id = subject_key_id(cert)
+        if key_id is not None:
+            self.by_key_id.setdefault(key_id, []).append(cert)
+
+    def __contains__(self, cert):
+        return cert.fingerprint(hashes.SHA256()) in self.by_fingerprint
+
+    # Certificates that may have issued cert: by the authority key
+    # identifier when it has one, by issuer name otherwise
+    def issuers_of(self, cert):
+        key_id = authority_key_id(cert)
+        if key_id is not None and key_id in self.by_key_id:
+            return self.by_key_id[key_id]
+        return self.by_subject.get(cert.issuer.public_bytes(), [])
+
+
+class TrustStore:
+    def __init__(self, dirs):
+        self.dirs = list(dirs)
+        self.pool = Cert_Pool()
+        self.snapshot = None
+        self.checked = 0
+        # Goes up every time the trusted certificates change
+        self.version = 0
+        self.lock = threading.Lock()
+
+    # x509 certificate or its DER bytes
+    def is_trusted(self, cert):
+        self.check()
+        if type(cert) is bytes:
+            cert = x509.load_der_x509_certificate(cert, default_backend())
+        return cert in self.pool
+
+    def issuers_of(self, cert):
+        self.check()
+        return self.pool.issuers_of(cert)
+
+    def certificates(self):
+        self.check()
+        return list(self.pool.by_fingerprint.values())
+
+    def check(self):
+        now = time.monotonic()
+        if self.snapshot is not None and now - self.checked < CHECK_INTERVAL:
+            return
+        with self.lock:
+            if self.snapshot is not None and now - self.checked < CHECK_INTERVAL:
+                return
+            snapshot = self.scan()
+            if snapshot != self.snapshot:
+                self.load(snapshot)
+            self.checked = now
+
+    # (path, mtime) of every file in the directories
+    def scan(self):
+        files = []
+        for d in self.dirs:
+            if not os.path.isdir(d):
+                continue
+            for e in os.scandir(d):
+                if e.is_file():
+                    files.append((e.path, e.stat().st_mtime_ns))
+        return sorted(files)
+
+    def load(self, snapshot):
+        pool = Cert_Pool()
+        for path, mtime in snapshot:
+            cert = load_certificate(path)
+            if cert is not None:
+                pool.add(cert)
+
+        self.pool = pool
+        self.snapshot = snapshot
+        self.version += 1
+
+
+# Builds certification paths from a certificate up to an anchor of a
+# trust store, following the issuer graph: each certificate links to the
+# certificates whose subject key identifier is its authority key identifier
+# (or, lacking those, whose subject is its issuer). Candidates come from the
+# trust store and the chain sent along. Certificates are parsed once and
+# each link's signature is checked once, both kept in LRU caches.
+#
+# Only CAs issue: an issuer needs BasicConstraints ca=True, KeyUsage with
+# keyCertSign and a pathLen (if any) that allows the CAs below it. Every
+# certificate of the path has to be within its validity dates.
+class Path_Builder:
+    def __init__(self, store, max_depth=8, cache_size=4096):
+        self.store = store
+        self.max_depth = max_depth
+        self.cache_size = cache_size
+        self.parsed = OrderedDict()
+        self.links = OrderedDict()
+        self.lock = threading.Lock()
+
+    def parse(self, der):
+        with self.lock:
+            cert = self.parsed.get(der)
+            if cert is not None:
+                self.parsed.move_to_end(der)
+                return cert
+        cert = x509.load_der_x509_certificate(der, default_backend())
+        with self.lock:
+            self._remember(self.parsed, der, cert)
+        return cert
+
+    # Was cert signed by issuer? Checked once per pair of certificates
+    def check_link(self, cert, issuer):
+        key = (cert.fingerprint(hashes.SHA256()), issuer.fingerprint(hashes.SHA256()))
+        with self.lock:
+            valid = self.links.get(key)
+        if valid is None:
+            valid = cert.issuer == issuer.subject and verify_signature(cert, issuer)
+            with self.lock:
+                self._remember(self.links, key, valid)
+        return valid
+
+    def _remember(self, cache, key, value):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > self.cache_size:
+            cache.popitem(last=False)
+
+    # Path from cert (x509 or DER) to an anchor as a list of certificates,
+    # None when there is none. is_anchor defaults to the trust store.
+    def build(self, cert, chain=(), is_anchor=None):
+        if type(cert) is bytes:
+            cert = self.parse(cert)
+        if is_anchor is None:
+            is_anchor = self.store.is_trusted
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if not valid_at(cert, now):
+            return None
+        pool = Cert_Pool(
+            self.parse(c) if type(c) is bytes else c
+            for c in chain)
+        return self._extend([cert], pool, is_anchor, now)
+
+    def _extend(self, path, pool, is_anchor, now):
+        cert = path[-1]
+        if is_anchor(cert):
+            return path
+        if len(path) > self.max_depth:
+            return None
+
+        for issuer in self.store.issuers_of(cert) + pool.issuers_of(cert):
+            if issuer in path or not valid_at(issuer, now):
+                continue
+            # The CAs already in the path below this issuer
+            if not can_issue(issuer, len(path) - 1):
+                continue
+            if not self.check_link(cert, issuer):
+                continue
+            found = self._extend(path + [issuer], pool, is_anchor, now)
+            if found is not None:
+                return found
+        return None
+
+
+# Outcome of validating a certificate with its chain, kept for ttl seconds
+# and dropped sooner when what it was decided with changed: the caller
+# passes a version (trust store, CRLs) and entries from another version
+# are stale. The least recently used entries go first when full.
+class Validation_Cache:
+    def __init__(self, size=4096, ttl=600):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(cert, chain):
+        digest = hashlib.sha256()
+        for der in [cert] + list(chain):
+            digest.update(len(der).to_bytes(4, 'big'))
+            digest.update(der)
+        return digest.digest()
+
+    # Cached result, None when there is none (or it is stale)
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                result, expires, entry_version = entry
+                if entry_version == version and time.monotonic() < expires:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return result
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, version, result):
+        with self.lock:
+            self.entries[key] = (result, time.monotonic() + self.ttl, version)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+# Parses a certificate file (DER or PEM), None if it is not one
+def load_certificate(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    try:
+        return x509.load_der_x509_certificate(data, default_backend())
+    except ValueError:
+        pass
+    try:
+        return x509.load_pem_x509_certificate(data, default_backend())
+    except ValueError:
+        return None
+
+
+def subject_key_id(cert):
+    try:
+        return cert.extensions.get_extension_for_class(
+            x509.SubjectKeyIdentifier).value.digest
+    except x509.ExtensionNotFound:
+        return None
+
+
+def authority_key_id(cert):
+    try:
+        return cert.extensions.get_extension_for_class(
+            x509.AuthorityKeyIdentifier).value.key_identifier
+    except x509.ExtensionNotFound:
+        return None
+
+
+def valid_at(cert, now):
+    return cert.not_valid_before_utc <= now <= cert.not_valid_after_utc
+
+
+# Whether cert is a CA allowed to sign certificates with cas_below CA
+# certificates under it in the path
+def can_issue(cert, cas_below):
+    try:
+        constraints = cert.extensions.get_extension_for_class(x509.BasicConstraints).value
+        usage = cert.extensions.get_extension_for_class(x509.KeyUsage).value
+    except x509.ExtensionNotFound:
+        return False
+    if not constraints.ca or not usage.key_cert_sign:
+        return False
+    return constraints.path_length is None or cas_below <= constraints.path_length
+
+
+# Checks the signature of cert with the public key of issuer
+def verify_signature(cert, issuer):
+    key = issuer.public_key()
+    try:
+        if isinstance(key, rsa.RSAPublicKey):
+            key.verify(
+                cert.signature,
+                cert.tbs_certificate_bytes,
+                padding.PKCS1v15(),
+                cert.signature_hash_algorithm)
+        elif isinstance(key, ec.EllipticCurvePublicKey):
+            key.verify(
+                cert.signature,
+                cert.tbs_certificate_bytes,
+                ec.ECDSA(cert.signature_hash_algorithm))
+        else:
+            return False
+    except (InvalidSignature, ValueError):
+        return False
+    return True
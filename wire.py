@@ -0,0 +1,46 @@
+import json
+import compact
+
+# Message encodings both sides can agree on during registration.
+# The croupier offers its list in the first message and the client picks
+# one in the 'encoding' field of its register message.
+
+
+class Encoding:
+    def __init__(self, name, dumps, loads):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+
+
+def _json_dumps(obj):
+    return json.dumps(obj).encode()
+
+
+JSON = Encoding('json', _json_dumps, json.loads)
+COMPACT = Encoding('compact', compact.dumps, compact.loads)
+
+# By order of preference
+ENCODINGS = {
+    COMPACT.name: COMPACT,
+    JSON.name: JSON,
+}
+
+# Used until the encoding is negotiated
+DEFAULT = JSON
+
+
+def names():
+    return list(ENCODINGS)
+
+
+def get(name):
+    return ENCODINGS.get(name, DEFAULT)
+
+
+# Picks our preferred encoding among the ones offered by the other side
+def choose(offered):
+    for name in ENCODINGS:
+        if name in offered:
+            return ENCODINGS[name]
+    return DEFAULT